@@ -0,0 +1,187 @@
+import json
+import os
+import numpy as np
+
+#######################################################################
+# Processing of the encoder angles of the Arduino, between the serial reader
+# and the result writer.
+# - AngleProcessor: reduces the block of values of one button press (100
+#   angles in degree) to one angle. The values are unwrapped around their
+#   circular mean (no jump at 0/360 deg), outliers further than n_mad
+#   (scaled) median absolute deviations from the median are rejected and the
+#   rest is averaged. Works on one block or on many blocks at once (e.g. to
+#   reprocess a whole session).
+# - EncoderMapping: linear mapping of the encoder angle to the elevation,
+#   elevation = offset + gain * angle (default: 90 - angle, the conversion of
+#   the original analysis). Can be fitted to angles measured at known
+#   elevations (python mapping_test.py -e) and is saved next to the results
+#   of every session (<results>_encoder.json).
+# - the raw blocks of a session are stored in <results>_samples.log (see
+#   TrialScheduler), so the responses can be processed again later with
+#   reprocess_session().
+#######################################################################
+
+
+def wrap_angle(angles):
+    """ Wraps angles in degree into [-180, 180) """
+    return (np.asarray(angles, dtype=np.float64) + 180) % 360 - 180
+
+
+def circular_mean(angles, axis=-1):
+    """ Mean direction of angles in degree along axis, in [-180, 180] """
+    radians = np.deg2rad(angles)
+    return np.rad2deg(np.arctan2(np.sin(radians).mean(axis), np.cos(radians).mean(axis)))
+
+
+def _median(values):
+    """ Median along the last axis (np.partition is faster than np.median for a single block) """
+    if values.ndim > 1:
+        return np.median(values, axis=-1)
+    n = values.shape[-1]
+    values = np.partition(values, [(n - 1) // 2, n // 2], axis=-1)
+    return 0.5 * (values[..., (n - 1) // 2] + values[..., n // 2])
+
+
+def line_to_elevation(line_number):
+    # distance between speakers: 11.25 deg; offset of -45 deg, since only the lower 10 speakers are used
+    return np.asarray(line_number) * 11.25 - 45
+
+
+class AngleProcessor():
+
+    def __init__(self, n_mad=3.5, min_tolerance=2.0):
+        # values further than n_mad * MAD (at least min_tolerance degree) from the median are outliers
+        self.n_mad = n_mad
+        self.min_tolerance = min_tolerance
+
+    def process(self, blocks):
+        """ Returns the angle of each block (last axis: values of one button press) in [-180, 180) and the
+            number of rejected values
+        """
+        blocks = np.asarray(blocks, dtype=np.float64)
+        center = circular_mean(blocks)[..., None]
+        # unwrapped around the circular mean
+        deviations = wrap_angle(blocks - center)
+        median = _median(deviations)[..., None]
+        distances = np.abs(deviations - median)
+        # 1.4826: MAD of normally distributed values -> standard deviation
+        mad = 1.4826 * _median(distances)[..., None]
+        inliers = distances <= np.maximum(self.n_mad * mad, self.min_tolerance)
+        mean = np.sum(deviations, axis=-1, where=inliers) / inliers.sum(axis=-1)
+        return wrap_angle(center[..., 0] + mean), np.sum(~inliers, axis=-1)
+
+    def estimate(self, block):
+        """ Angle of a single block """
+        return float(self.process(block)[0])
+
+
+class EncoderMapping():
+
+    def __init__(self, mapping_file='encoder_mapping.json', offset=90.0, gain=-1.0):
+        self.mapping_file = mapping_file
+        self.offset = offset
+        self.gain = gain
+        # standard deviation of the residuals of fit()
+        self.residual_sd = None
+        if mapping_file is not None and os.path.exists(mapping_file):
+            self.load()
+
+    def load(self):
+        with open(self.mapping_file) as f:
+            mapping = json.load(f)
+        self.offset, self.gain, self.residual_sd = mapping['offset'], mapping['gain'], mapping.get('residual_sd')
+
+    def save(self, file_name=None):
+        """ Saves the mapping (to file_name, e.g. next to the results of a session, default: mapping_file) """
+        with open(self.mapping_file if file_name is None else file_name, 'w') as f:
+            json.dump({'offset': self.offset, 'gain': self.gain, 'residual_sd': self.residual_sd}, f, indent=2)
+
+    def to_elevation(self, angles):
+        return self.offset + self.gain * wrap_angle(angles)
+
+    def to_angle(self, elevations):
+        return wrap_angle((np.asarray(elevations, dtype=np.float64) - self.offset) / self.gain)
+
+    def fit(self, angles, elevations):
+        """ Fits offset and gain to angles measured with the handle pointing at the given elevations """
+        angles = wrap_angle(angles)
+        elevations = np.asarray(elevations, dtype=np.float64)
+        if len(np.unique(elevations)) < 2:
+            raise ValueError('At least two different elevations are needed to fit the encoder mapping')
+        self.gain, self.offset = np.polyfit(angles, elevations, 1)
+        self.gain, self.offset = float(self.gain), float(self.offset)
+        self.residual_sd = float(np.std(elevations - self.to_elevation(angles)))
+        return self.residual_sd
+
+
+def session_files(results_file):
+    """ Returns the names of the sample log and the encoder mapping of a results file """
+    base_name = os.path.splitext(results_file)[0]
+    return base_name + '_samples.log', base_name + '_encoder.json'
+
+
+def sample_header(n_values):
+    """ Columns of the sample log: trial, condition and the values of the response """
+    return ['trial', 'condition'] + ['value_' + str(i) for i in range(n_values)]
+
+
+def read_samples(sample_file):
+    """ Reads the raw blocks of a session. Returns trial numbers, conditions and blocks (trials x values). """
+    from ResultWriter import read_columns
+    columns = read_columns(sample_file)
+    values = [name for name in columns if name.startswith('value_')]
+    return columns['trial'], columns['condition'], np.column_stack([columns[name] for name in values])
+
+
+def reprocess_session(results_file, processor=None, mapping=None):
+    """ Processes the raw blocks of a session again (e.g. with other outlier settings or a new encoder
+        mapping). Returns trial numbers, conditions, angles and elevations. The mapping of the session is used,
+        if no mapping is given.
+    """
+    sample_file, mapping_file = session_files(results_file)
+    processor = AngleProcessor() if processor is None else processor
+    mapping = EncoderMapping(mapping_file) if mapping is None else mapping
+    trials, conditions, blocks = read_samples(sample_file)
+    angles = processor.process(blocks)[0]
+    return trials, conditions, angles, mapping.to_elevation(angles)
+
+
+# Just for testing: noisy blocks around 0/360 deg with outliers
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng(0)
+    true_angles = rng.uniform(-60, 60, 1000)
+    blocks = true_angles[:, None] + rng.normal(0, 0.5, (1000, 100))
+    # encoder counts from 0 to 360, single samples are garbage (e.g. transmission errors)
+    blocks %= 360
+    outliers = rng.random(blocks.shape) < 0.03
+    blocks[outliers] = rng.uniform(0, 360, outliers.sum())
+
+    processor = AngleProcessor()
+    angles, n_rejected = processor.process(blocks)
+    errors = wrap_angle(angles - true_angles)
+    naive_errors = wrap_angle(blocks.mean(axis=1) - true_angles)
+    print('error: robust {0:.3f} deg (max {1:.3f}), arithmetic mean {2:.1f} deg (max {3:.1f}), rejected: {4:.1f} '
+          'values per block'.format(np.abs(errors).mean(), np.abs(errors).max(), np.abs(naive_errors).mean(),
+                                    np.abs(naive_errors).max(), n_rejected.mean()))
+    assert np.abs(errors).max() < 0.5
+
+    timings = []
+    for block in blocks:
+        ts = time.perf_counter()
+        processor.estimate(block)
+        timings.append(time.perf_counter() - ts)
+    ts = time.perf_counter()
+    processor.process(blocks)
+    print('one block: {0:.1f} us, all blocks at once: {1:.2f} us per block'.format(
+        np.median(timings) * 1e6, (time.perf_counter() - ts) / len(blocks) * 1e6))
+
+    # the default mapping is the conversion of the original analysis
+    mapping = EncoderMapping(None)
+    raw = rng.uniform(0, 135, 100)
+    assert np.allclose(mapping.to_elevation(raw), np.abs(raw - 360) - 270)
+    assert np.allclose(mapping.to_angle(mapping.to_elevation(raw)), raw)
+    elevations = line_to_elevation(np.arange(13))
+    mapping.fit(90 - elevations * 1.02 + 3 + rng.normal(0, 0.1, 13), elevations)
+    assert np.isclose(mapping.gain, -1 / 1.02, atol=0.01)
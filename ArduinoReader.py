@@ -1,55 +1,265 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import serial
+import asyncio
+import threading
 import time
+from collections import namedtuple
+from concurrent.futures import Future
+from AngleProcessing import AngleProcessor
 
 ########################################################################################
 # Arduino class for connection and readout of values over serial port
 # - port changes depending on the operating system
 # - if you just want to test your code, without arduino, initialize ArduinoReader with
 #   dummy=True. Thereby, no real arduino is needed
+# - with background=True a thread reads the serial port continuously and parses the
+#   values into a ring buffer, so get_data() returns as soon as the last value arrived.
+# - with binary=True the Arduino is expected to send packed frames instead of text lines:
+#   FRAME_HEADER (2 bytes) followed by the value as little endian float32 (4 bytes).
+#   Use a higher baud rate (e.g. 115200) for this.
+# - request_response() / get_response() wait for the response without blocking. The
+#   arrival of the first byte of the response is timestamped with time.perf_counter_ns().
+#   Without the background reader, the responses are read one after the other (get_data()
+#   waits until a requested response is read and vice versa).
+# - if a TimingLog is given, the duration of the readout and the serial transfer are recorded.
+# - the values of a button press are reduced to one angle by the AngleProcessor (circular
+#   mean without outliers). The raw values are handed out with the response (samples).
 #
 # Author: Timo Oess 2020
 #########################################################################################
 
+FRAME_HEADER = b'\xa5\x5a'
+FRAME_SIZE = len(FRAME_HEADER) + 4
+
+# response of the participant: angle, arrival of the first and the last byte (time.perf_counter_ns) and the raw values
+Response = namedtuple('Response', ['angle', 'first_byte_ns', 'last_byte_ns', 'samples'], defaults=[None])
+
+
+def parse_text(data):
+    """ Parses all complete lines of data into floats.
+        Returns the values and the remaining bytes of an incomplete line.
+    """
+    end = data.rfind(b'\n') + 1
+    try:
+        values = np.array(data[:end].split(), dtype=np.float64)
+    except ValueError:
+        # skip lines that are not numbers (e.g. garbage after connecting)
+        values = []
+        for token in data[:end].split():
+            try:
+                values.append(float(token))
+            except ValueError:
+                pass
+        values = np.array(values, dtype=np.float64)
+    return values, data[end:]
+
+
+def parse_frames(data):
+    """ Parses all complete binary frames of data into floats.
+        Returns the values and the remaining bytes of an incomplete frame. Corrupted bytes are skipped.
+    """
+    values = []
+    while True:
+        start = data.find(FRAME_HEADER)
+        if start == -1:
+            # keep the last byte, it might be the first byte of the next header
+            return np.concatenate(values) if values else np.zeros(0), data[-1:]
+
+        n_frames = (len(data) - start) // FRAME_SIZE
+        frames = np.frombuffer(data, dtype=np.uint8, count=n_frames * FRAME_SIZE, offset=start).reshape(n_frames, FRAME_SIZE)
+        valid = (frames[:, 0] == FRAME_HEADER[0]) & (frames[:, 1] == FRAME_HEADER[1])
+        # all frames up to the first corrupted one can be used
+        n_valid = n_frames if valid.all() else np.argmin(valid)
+        values.append(frames[:n_valid, len(FRAME_HEADER):].copy().view('<f4').ravel().astype(np.float64))
+
+        data = data[start + n_valid * FRAME_SIZE:]
+        if n_valid == n_frames:
+            return np.concatenate(values), data
+        # skip the corrupted byte and search for the next header
+        data = data[1:]
+
 
 class ArduinoReader:
 
     # Initializes the arduino on given port
-    def __init__(self, port='/dev/ttyUSB0', baud_rate=9600, dummy=False,):
+    def __init__(self, port='/dev/ttyUSB0', baud_rate=9600, dummy=False, background=False, binary=False,
+                 n_values=100, buffer_size=4096, timing_log=None, processor=None):
         self.dummy = dummy
+        self.timing_log = timing_log
+        # reduces the values of a button press to one angle
+        self.processor = AngleProcessor() if processor is None else processor
+        self.background = background
+        self.binary = binary
+        # Arduino sends n_values values after every button press
+        self.n_values = n_values
         if not self.dummy:
-            self.ser = serial.Serial(port, baud_rate)
+            # in background mode, the read thread needs a timeout to be able to stop
+            self.ser = serial.Serial(port, baud_rate, timeout=0.05 if background else None)
             time.sleep(2)
+
+            if self.background:
+                # ring buffer of the received values
+                self.buffer = np.zeros(buffer_size)
+                self.n_received = 0
+                self.new_data = threading.Condition()
+                # requested responses that are not complete yet, see request_response()
+                self.pending = []
+                # exception of the read thread (e.g. the cable was unplugged), raised by get_data()
+                self.error = None
+                self.running = True
+                self.read_thread = threading.Thread(target=self._read_loop, daemon=True)
+                self.read_thread.start()
+            else:
+                # the thread of request_response() and get_data() must not read the port at the same time
+                self.read_lock = threading.Lock()
         else:
             print('Attention! Dummy Arduino Reader is used')
+            # time until the dummy response is given in seconds
+            self.dummy_response_time = 2
+
+    def _read_loop(self):
+        try:
+            self._read_values()
+        except Exception as e:
+            # no more values are received: all waiting responses fail with the error
+            with self.new_data:
+                self.error = e
+                for pending in self.pending:
+                    pending['future'].set_exception(e)
+                self.pending = []
+                self.new_data.notify_all()
+
+    def _read_values(self):
+        """ Reads all available bytes from the serial port and puts the parsed values into the ring buffer """
+        remaining = b''
+        while self.running:
+            chunk = self.ser.read(max(1, self.ser.in_waiting))
+            if not chunk:
+                continue
+            chunk_ns = time.perf_counter_ns()
+
+            if self.binary:
+                values, remaining = parse_frames(remaining + chunk)
+            else:
+                values, remaining = parse_text(remaining + chunk)
+
+            with self.new_data:
+                for pending in self.pending:
+                    if pending['first_byte_ns'] is None:
+                        pending['first_byte_ns'] = chunk_ns
+
+                if len(values) > 0:
+                    indices = np.arange(self.n_received, self.n_received + len(values)) % len(self.buffer)
+                    self.buffer[indices] = values
+                    self.n_received += len(values)
+                    self.new_data.notify_all()
+
+                    # hand out all responses that are complete now
+                    complete = [pending for pending in self.pending if self.n_received >= pending['start'] + self.n_values]
+                    for pending in complete:
+                        self.pending.remove(pending)
+                        indices = np.arange(pending['start'], pending['start'] + self.n_values) % len(self.buffer)
+                        samples = self.buffer[indices]
+                        if self.timing_log is not None:
+                            self.timing_log.record('ArduinoReader', 'transfer', pending['first_byte_ns'], chunk_ns)
+                        pending['future'].set_result(Response(self.processor.estimate(samples), pending['first_byte_ns'],
+                                                              chunk_ns, samples))
+
+    def request_response(self, callback=None):
+        """ Starts waiting for the next response (the next 100 values) without blocking.
+            Values that were received before are ignored. Returns a concurrent.futures.Future, whose result
+            is a Response. If callback is given, it is called with the future as soon as the response is complete.
+        """
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        if self.dummy:
+            # random dummy response after dummy_response_time seconds
+            def respond():
+                now = time.perf_counter_ns()
+                samples = self.dummy_samples()
+                future.set_result(Response(self.processor.estimate(samples), now, now, samples))
+            threading.Timer(self.dummy_response_time, respond).start()
+        elif self.background:
+            with self.new_data:
+                if self.error is not None:
+                    future.set_exception(self.error)
+                    return future
+                self.pending.append({'future': future, 'start': self.n_received, 'first_byte_ns': None})
+        else:
+            # without the background reader, the first byte can only be timestamped when its line is read
+            def read():
+                try:
+                    with self.read_lock:
+                        self.ser.flushInput()
+                        values = []
+                        for i in range(self.n_values):
+                            values.append(float(self.ser.readline().decode().rstrip()))
+                            if i == 0:
+                                first_byte_ns = time.perf_counter_ns()
+                        last_byte_ns = time.perf_counter_ns()
+                    if self.timing_log is not None:
+                        self.timing_log.record('ArduinoReader', 'transfer', first_byte_ns, last_byte_ns)
+                    samples = np.array(values)
+                    response = Response(self.processor.estimate(samples), first_byte_ns, last_byte_ns, samples)
+                except Exception as e:
+                    # e.g. a garbled line or a serial error: raised by future.result() in the thread of the experiment
+                    future.set_exception(e)
+                    return
+                future.set_result(response)
+            threading.Thread(target=read, daemon=True).start()
+
+        return future
+
+    def dummy_samples(self):
+        """ Random dummy values of a button press (n_values values around a random angle) """
+        return np.random.uniform(0, 135) + np.random.normal(0, 0.5, self.n_values)
+
+    async def get_response(self):
+        """ Waits for the next response (see request_response()) in an asyncio event loop """
+        return await asyncio.wrap_future(self.request_response())
 
     def get_data(self):
-        """ Reads the data (100 values) on the given port, calculates the mean
-            and returns it.
+        """ Reads the data (100 values) on the given port, reduces them to one angle
+            (see AngleProcessor) and returns it.
             This method blocks the rest of the execution until data is received.
         """
+        start_ns = time.perf_counter_ns()
         if not self.dummy:
-            # flush the serial buffer so that repeated butten presses are ignored
-            self.ser.flushInput()
-
-            list = []
-            # Arduino sends 100 values. So read 100 values.
-            for i in range(100):
-                b = self.ser.readline()         # read a byte string
-                string_n = b.decode()  # decode byte string into Unicode
-                string = string_n.rstrip()  # remove \n and \r
-                flt = float(string)        # convert string to float
-                list.append(flt)
+            if self.background:
+                # values that were received before are ignored (like flushing the serial buffer)
+                with self.new_data:
+                    start = self.n_received
+                    self.new_data.wait_for(lambda: self.error is not None or self.n_received >= start + self.n_values)
+                    if self.error is not None:
+                        raise self.error
+                    indices = np.arange(start, start + self.n_values) % len(self.buffer)
+                    list = self.buffer[indices]
+            else:
+                with self.read_lock:
+                    # flush the serial buffer so that repeated butten presses are ignored
+                    self.ser.flushInput()
+
+                    list = []
+                    # Arduino sends 100 values. So read 100 values.
+                    for i in range(self.n_values):
+                        b = self.ser.readline()         # read a byte string
+                        string_n = b.decode()  # decode byte string into Unicode
+                        string = string_n.rstrip()  # remove \n and \r
+                        flt = float(string)        # convert string to float
+                        list.append(flt)
 
         else:
             # Returns a random dummy output
             print('Dummy readout data')
-            list = np.random.randint(0, 135, 10)
-            time.sleep(2)
+            list = self.dummy_samples()
+            time.sleep(self.dummy_response_time)
 
-        # Take the mean of the data
-        angle = sum(list) / len(list)
+        # circular mean of the data without outliers
+        angle = self.processor.estimate(list)
+        if self.timing_log is not None:
+            self.timing_log.record('ArduinoReader', 'read', start_ns)
         print('Estimated Anlge: ' + str(angle))
         return angle
 
@@ -64,6 +274,9 @@ class ArduinoReader:
     def close(self):
         """ Closes the serial connection """
         if not self.dummy:
+            if self.background:
+                self.running = False
+                self.read_thread.join()
             self.ser.close()
 
 
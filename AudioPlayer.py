@@ -1,12 +1,38 @@
-import sounddevice as sd
 import soundfile as sf
+import numpy as np
 import logging
+import time
+from OutputStreamEngine import OutputStreamEngine
+from SpeakerRouting import SpeakerRouter, load_routing
+from DeviceRegistry import get_registry
+from StimulusSynthesis import StimulusCache
+from StimulusStream import StimulusStream
 
 #######################################################################
 # This class initalizes an audio player for the Fireface 802.
 # It can also record data.
 # - if you just want to test your code, without sound card, initialize AudioPlayer with
 #   dummy=True. Thereby, no soundcard is needed.
+# - with persistent_stream=True one output stream per device is opened once
+#   (see OutputStreamEngine) instead of opening a new stream for every sound.
+# - speakers are mapped to devices and channels by the routing table speaker_routing.json.
+#   With multichannel=True the Fireface is opened as one multichannel device and
+#   every speaker is one channel of it (see SpeakerRouting).
+# - devices are looked up in the process-wide DeviceRegistry, so creating
+#   another AudioPlayer does not enumerate all devices again.
+# - stimuli can also be synthesized (see use_synthesized_stimuli()), then a new
+#   noise token is used in every trial, without reading any file.
+# - if a TimingLog is given, loading and playback times and the status of the
+#   audio stream (e.g. underflows) are recorded.
+# - the level of every speaker is corrected with the gains of a LevelCalibration and
+#   the overall level can be changed with set_level() (e.g. hearing threshold test).
+#   The gain is applied while the sound is copied into the output buffer, the
+#   stimuli are never changed or read again.
+# - with persistent_stream=True, audio files that do not fit into the ring buffer of the
+#   output stream (buffer_seconds, set_audio_file()) are not read into memory but streamed
+#   block by block from the memory-mapped file (see StimulusStream), so playback starts at once.
+# - sounddevice is only imported when a sound is played or recorded without a
+#   stream_factory, so the simulated hardware (HardwareSimulator) needs no audio library.
 #
 # Author: Timo Oess 2020
 #######################################################################
@@ -14,26 +40,53 @@ import logging
 
 class AudioPlayer():
 
-    def __init__(self, file_to_play=None, dummy=False):
+    def __init__(self, file_to_play=None, dummy=False, persistent_stream=False, stream_factory=None,
+                 multichannel=False, routing_file='speaker_routing.json', registry=None,
+                 timing_log=None, calibration=None, buffer_seconds=10):
         log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         logging.basicConfig(level=logging.INFO, format=log_fmt)
         self.logger = logging.getLogger(__name__)
 
         self.dummy = dummy
+        # preloaded stimuli, see load_stimuli()
+        self.stimuli = {}
+        self.stimuli_fs = None
+        # parameters of synthesized stimuli, see use_synthesized_stimuli()
+        self.synthesis_parameters = {}
+        self.stimulus_cache = None
+        # long-lived output streams, one per device, see open_streams()
+        self.persistent_stream = persistent_stream
+        self.stream_factory = stream_factory
+        self.engines = {}
+        self.onset_latency = None
+        self.multichannel = multichannel
+        self._output_matrix = None
+        self.timing_log = timing_log
+        # per-speaker gains (LevelCalibration) and overall level in dB
+        self.calibration = calibration
+        self.level_db = 0.0
+        self._gain_buffer = None
+        # size of the ring buffer of the output streams, longer audio files are streamed (see set_audio_file())
+        self.buffer_seconds = buffer_seconds
+        self.audio_stream = None
         if not self.dummy:
-            # try to get the output devices
-            try:
-                self.devices = sd.query_devices()
-            except:
-                self.logger.error("No Output device found")
+            # the output devices are enumerated only once per process
+            self.devices = registry if registry is not None else get_registry()
             # get all the operating system specific device numbers for Fireface only
             self.device_numbers = self.get_device_numbers()
 
+            # mapping of speakers to devices and channels
+            self.router = SpeakerRouter(load_routing(routing_file))
+            if self.multichannel:
+                self.multichannel_device = self.devices.resolve(
+                    'multichannel_' + self.router.multichannel_device,
+                    lambda registry: [self.router.find_multichannel_device(registry)])[0]
+                self.logger.info('Multichannel device: ' + str(self.multichannel_device) + '  ' +
+                                 str(self.devices[self.multichannel_device]['name']))
+
             # check if there is a file to playback
             if file_to_play is not None:
-                self.file_to_play = file_to_play
-                self.logger.info("Reading file: " + self.file_to_play)
-                self.audio_data, self.fs = sf.read(self.file_to_play, dtype='float32')
+                self.set_audio_file(file_to_play)
             else:
                 self.file_to_play = None
                 self.audio_data = None
@@ -47,21 +100,229 @@ class AudioPlayer():
         """
 
         if not self.dummy:
+            start_ns = time.perf_counter_ns()
             self.logger.info('DeviceNumber: ' + str(self.output_device) + '    ChannelNumber: ' +
                              str(self.output_channel) + '    Name: ' + str(self.devices[self.output_device]['name']))
-            # play the sound
-            sd.play(self.audio_data, self.fs, mapping=self.output_channel, device=self.output_device)
-            if not async_rec:
-                status = sd.wait()
-                sd.stop()
+            gain = 1.0
+            if self.audio_stream is not None:
+                # streamed from the file in play_stream()
+                data, mapping = None, None
+            elif self.multichannel:
+                # every speaker is one column of the output matrix, the gains are applied by the router
+                data = self.router.route(self.audio_data, self.output_lines, self.get_output_gains(),
+                                         out=self._output_matrix if self.persistent_stream else None)
+                mapping = None
+                if self.persistent_stream:
+                    # the engine copies the matrix, so it can be reused for the next sound
+                    self._output_matrix = data
+            else:
+                data = self.audio_data
+                mapping = self.output_channel
+                gain = self.get_output_gains()[0]
+
+            status = None
+            if self.audio_stream is not None:
+                # long file: the engine streams it block by block from the file
+                if len(self.output_lines) > 1:
+                    raise ValueError('Streamed audio files can only be played on one line')
+                engine = self.get_engine(self.output_device)
+                n_status_flags = len(engine.status_flags)
+                engine.play_stream(self.audio_stream, self.output_channel, block=not async_rec,
+                                   gain=self.get_output_gains()[0])
+                self.onset_latency = engine.onset_latency
+                status = ' '.join(engine.status_flags[n_status_flags:])
+            elif self.persistent_stream:
+                # queue the sound in the already running stream of the device (gain is applied while copying)
+                engine = self.get_engine(self.output_device)
+                # the stream was opened with the sample rate of the first sound
+                if self.fs != engine.fs:
+                    raise ValueError('Sample rate of ' + str(self.file_to_play) + ' (' + str(self.fs) + ' Hz) does not '
+                                     'match the sample rate of the output stream (' + str(engine.fs) + ' Hz)')
+                n_status_flags = len(engine.status_flags)
+                engine.play(data, mapping, block=not async_rec, gain=gain)
+                self.onset_latency = engine.onset_latency
+                status = ' '.join(engine.status_flags[n_status_flags:])
+            else:
+                # play the sound
+                import sounddevice as sd
+                sd.play(self._apply_gain(data, gain), self.fs, mapping=mapping, device=self.output_device)
+                if not async_rec:
+                    status = sd.wait()
+                    sd.stop()
+
+            if self.timing_log is not None:
+                self.timing_log.record('AudioPlayer', 'play', start_ns, status=str(status) if status else '')
+                if self.persistent_stream and not async_rec:
+                    self.timing_log.record('AudioPlayer', 'onset', start_ns, start_ns + int(self.onset_latency * 1e9))
+
+    def play_and_record(self, input_channels, input_device=None):
+        """ Plays the previously set sound on the output device and channel and records the given input channels
+            (starting at 1) at the same time. Blocks until the sound is played back.
+            Returns the recording (frames x input channels).
+        """
+
+        if not self.dummy:
+            if input_device is None:
+                input_device = self.output_device
+            self.logger.info('Recording channels ' + str(input_channels) + ' of device ' + str(input_device))
+            if self.audio_stream is not None:
+                raise ValueError('Streamed audio files can not be recorded, use a shorter file')
+            import sounddevice as sd
+            data = self._apply_gain(self.audio_data, self.get_output_gains()[0])
+            recording = sd.playrec(data, self.fs, input_mapping=input_channels,
+                                   output_mapping=[self.output_channel], device=(input_device, self.output_device))
+            sd.wait()
+            return recording
+
+    def set_level(self, level_db):
+        """ Sets the overall level in dB (0 dB: level of the stimulus files). Takes effect with the next sound. """
+        self.level_db = level_db
+
+    def get_output_gains(self):
+        """ Returns the linear gain of each current output line: speaker calibration, overall level and the
+            gains of set_output_lines()
+        """
+        gains = np.full(len(self.output_lines), 10 ** (self.level_db / 20), dtype=np.float32)
+        if self.calibration is not None:
+            gains *= self.calibration.get_gains(self.output_lines)
+        if self.output_gains is not None:
+            gains *= np.asarray(self.output_gains, dtype=np.float32)
+        return gains
+
+    def _apply_gain(self, data, gain):
+        """ Returns data multiplied with gain. The result is written into a reused buffer, data is not changed.
+            Only used without persistent streams. A previous sound that was played asynchronously may still read
+            the buffer, so it is stopped first (sd.play and sd.playrec would stop it anyway).
+        """
+        if gain == 1:
+            return data
+        import sounddevice as sd
+        sd.stop()
+        if self._gain_buffer is None or self._gain_buffer.shape[0] < data.shape[0] or \
+                self._gain_buffer.shape[1:] != data.shape[1:]:
+            self._gain_buffer = np.empty(data.shape, dtype=np.float32)
+        return np.multiply(data, gain, out=self._gain_buffer[:data.shape[0]], casting='unsafe')
+
+    def open_streams(self, devices=None):
+        """ Opens and starts one long-lived output stream for each of the given devices (default: the devices
+            of the routing table or the multichannel device). The sample rate of the preloaded stimuli is used.
+        """
+
+        if not self.dummy:
+            if devices is None and self.multichannel:
+                devices = [self.multichannel_device]
+            elif devices is None:
+                # only the devices with speakers (not every Fireface device of every host API)
+                devices = sorted({speaker['device'] for speaker in self.router.speakers.values()})
+            for device in devices:
+                self.get_engine(device)
+
+    def get_engine(self, device):
+        """ Returns the running output stream of the device. The stream is opened, if it is not open yet. """
+
+        if device not in self.engines:
+            fs = self.stimuli_fs if self.stimuli_fs is not None else self.fs
+            n_channels = self.router.n_channels if self.multichannel else 2
+            engine = OutputStreamEngine(device, fs, n_channels=n_channels, buffer_seconds=self.buffer_seconds,
+                                        stream_factory=self.stream_factory)
+            engine.start()
+            self.engines[device] = engine
+        return self.engines[device]
+
+    def close(self):
+        """ Closes all output streams """
+
+        for engine in self.engines.values():
+            engine.close()
+        self.engines = {}
 
     def set_audio_file(self, file_to_play):
-        """ Sets the file to play """
+        """ Sets the file to play. With persistent streams, files that do not fit into the ring buffer of the output
+            stream (buffer_seconds) are only memory-mapped and streamed during playback
+            (see OutputStreamEngine.play_stream()).
+        """
 
         if not self.dummy:
             self.file_to_play = file_to_play
             self.logger.info("Setting audio file to play: " + self.file_to_play)
-            self.audio_data, self.fs = sf.read(file_to_play, dtype='float32')
+            start_ns = time.perf_counter_ns()
+            info = sf.info(file_to_play)
+            if self.persistent_stream and info.frames > int(self.buffer_seconds * info.samplerate):
+                self.audio_stream = StimulusStream(file_to_play)
+                self.audio_data, self.fs = None, self.audio_stream.fs
+            else:
+                self.audio_stream = None
+                self.audio_data, self.fs = sf.read(file_to_play, dtype='float32')
+            if self.timing_log is not None:
+                self.timing_log.record('AudioPlayer', 'load', start_ns)
+
+    def set_audio_data(self, audio_data, fs):
+        """ Sets a sound that is already in memory (e.g. an excitation signal) to play """
+
+        if not self.dummy:
+            self.file_to_play = None
+            self.audio_stream = None
+            self.audio_data, self.fs = np.ascontiguousarray(audio_data, dtype=np.float32), fs
+
+    def load_stimuli(self, files):
+        """ Loads all stimuli once into memory, so that no file needs to be read during the experiment.
+            files is a dict mapping a key (e.g. 'white', 'rippled') to a file path.
+            All files need to have the same sample rate.
+        """
+
+        if not self.dummy:
+            for key, file_name in files.items():
+                self.logger.info("Preloading stimulus '" + str(key) + "': " + str(file_name))
+                start_ns = time.perf_counter_ns()
+                data, fs = sf.read(file_name, dtype='float32')
+                if self.timing_log is not None:
+                    self.timing_log.record('AudioPlayer', 'preload', start_ns)
+
+                # all stimuli are played with the same stream settings, so the sample rate has to match
+                if self.stimuli_fs is None:
+                    self.stimuli_fs = fs
+                elif fs != self.stimuli_fs:
+                    raise ValueError('Sample rate of ' + str(file_name) + ' (' + str(fs) + ' Hz) does not match the '
+                                     'sample rate of the other stimuli (' + str(self.stimuli_fs) + ' Hz)')
+
+                self.stimuli[key] = np.ascontiguousarray(data, dtype=np.float32)
+
+            if self.persistent_stream:
+                self.open_streams()
+
+    def use_synthesized_stimuli(self, parameters, n_tokens=20, seed=0, max_bytes=100 * 2 ** 20):
+        """ Synthesizes the stimuli instead of reading them from files.
+            parameters is a dict mapping a key (e.g. 'white', 'rippled') to the parameters of synthesize(),
+            e.g. {'noise_type': 'rippled', 'duration': 0.3, 'bandwidth': 1000}.
+            Every time a stimulus is selected (set_stimulus()), one of n_tokens different noise tokens is drawn.
+            The tokens are kept in an LRU cache of max_bytes bytes.
+        """
+
+        if not self.dummy:
+            if self.stimuli_fs is None:
+                self.stimuli_fs = 44100
+            self.stimulus_cache = StimulusCache(self.stimuli_fs, max_bytes=max_bytes, base_seed=seed)
+            self.synthesis_parameters = dict(parameters)
+            self.n_tokens = n_tokens
+            self.token_rng = np.random.default_rng(seed)
+
+            if self.persistent_stream:
+                self.open_streams()
+
+    def set_stimulus(self, key):
+        """ Selects a preloaded stimulus (see load_stimuli()) or a new token of a synthesized stimulus (see
+            use_synthesized_stimuli()) for playback. No file is read here.
+        """
+
+        if not self.dummy:
+            self.file_to_play = key
+            self.audio_stream = None
+            if key in self.synthesis_parameters:
+                token = self.token_rng.integers(self.n_tokens)
+                self.audio_data = self.stimulus_cache.get(token=token, **self.synthesis_parameters[key])
+            else:
+                self.audio_data = self.stimuli[key]
+            self.fs = self.stimuli_fs
 
     def get_device_numbers(self):
         """  Returns the operating system numbers of Fireface devices that can be used for playback
@@ -69,81 +330,121 @@ class AudioPlayer():
         if not self.dummy:
             self.logger.info("Getting audio devices...")
 
-            device_numbers = []
-            # get the devide numbers automatically
-            for i, dev in enumerate(self.devices):
-                # only play sounds from lines that are called fireface analog, have 2 channels and are not the 11+12 output line
-                if dev['max_output_channels'] >= 2 and dev['name'].find('Fireface Analog') != -1 and dev['name'].find('(11+12)') == -1:
-                    self.logger.info(str(i) + '  ' + str(dev['name']))
-                    device_numbers.append(i)
+            # get the devide numbers automatically (or from the device cache)
+            # only play sounds from lines that are called fireface analog, have 2 channels and are not the 11+12 output line
+            device_numbers = self.devices.resolve(
+                'fireface', lambda registry: registry.find('Fireface Analog', min_output_channels=2, exclude='(11+12)'))
+            for i in device_numbers:
+                self.logger.info(str(i) + '  ' + str(self.devices[i]['name']))
 
             return device_numbers
 
     def set_output_line(self, line_number):
-        """ Connectes the correct output dice and channel number to the given line_number (speaker).
-            ATTENTION : This needs to be adapated as soon as new sound devices are attached to the computer!
+        """ Connectes the correct output device and channel number to the given line_number (speaker).
+            The mapping is read from the routing table (speaker_routing.json).
+            ATTENTION : The table needs to be adapated as soon as new sound devices are attached to the computer!
         """
 
         if not self.dummy:
-            # DeviceNumber: 190    ChannelNumber: 1    Name: Analog (3+4) (Fireface Analog (3+4))
-            if line_number == 0:
-                self.output_device = 190
-                # self.output_device = 202 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 1
-            elif line_number == 1:
-                self.output_device = 190
-                # self.output_device = 202 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 2
-            elif line_number == 2:
-                self.output_device = 196
-                # self.output_device = 208 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 1
-            elif line_number == 3:
-                self.output_device = 196
-                # self.output_device = 208 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 2
-            elif line_number == 4:
-                self.output_device = 202
-                # self.output_device = 214 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 1
-            elif line_number == 5:
-                self.output_device = 202
-                # self.output_device = 214 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 2
-            elif line_number == 6:
-                self.output_device = 206
-                # self.output_device = 218 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 1
-            elif line_number == 7:
-                self.output_device = 206
-                # self.output_device = 218 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 2
-            elif line_number == 8:
-                self.output_device = 166
-                # self.output_device = 178 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 1
-            elif line_number == 9:
-                self.output_device = 166
-                # self.output_device = 178 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 2
-            elif line_number == 10:
-                self.output_device = 172
-                # self.output_device = 184 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 1
-            elif line_number == 11:
-                self.output_device = 172
-                # self.output_device = 184 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 2
-            elif line_number == 12:
-                self.output_device = 178
-                # self.output_device = 190 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 1
-            elif line_number == 13:
-                self.output_device = 178
-                # self.output_device = 190 # use this one if SB Omni external sound card is plugged in
-                self.output_channel = 2
+            self.output_lines = [line_number]
+            self.output_gains = None
+            if self.multichannel:
+                self.output_device = self.multichannel_device
+                self.output_channel = self.router.get_matrix_channel(line_number)
             else:
-                self.output_device = 0
-                self.output_channel = 0
+                self.output_device, self.output_channel = self.router.get_device_channel(line_number)
 
             return self.output_device, self.output_channel
+
+    def set_output_lines(self, line_numbers, gains=None):
+        """ Plays the sound on all given line numbers (speakers) at the same time, each weighted with its gain.
+            Only possible if the multichannel device is used.
+        """
+
+        if not self.dummy:
+            if not self.multichannel:
+                raise ValueError('Playing on several lines at the same time requires multichannel=True')
+            self.output_lines = list(line_numbers)
+            self.output_gains = gains
+            self.output_device = self.multichannel_device
+            self.output_channel = [self.router.get_matrix_channel(line) for line in self.output_lines]
+
+
+# Just for testing: files up to the size of the ring buffer are read, longer files are streamed
+if __name__ == '__main__':
+    import json
+    import tempfile
+    from pathlib import Path
+    from DeviceRegistry import DeviceRegistry
+    from OutputStreamEngine import FakeOutputStream
+
+    class FakeBackend():
+        """ sounddevice replacement with the stereo devices of the routing table (and the same devices of a
+            second host API, which are not used)
+        """
+        devices = [{'name': 'Analog ({0}+{1}) (Fireface Analog ({0}+{1}))'.format(2 * i + 1, 2 * i + 2),
+                    'max_output_channels': 2, 'max_input_channels': 2, 'hostapi': hostapi}
+                   for hostapi in range(2) for i in range(7)]
+        devices.append({'name': 'Fireface 802 (multichannel)', 'max_output_channels': 18, 'max_input_channels': 18,
+                        'hostapi': 0})
+
+        def query_devices(self, device=None):
+            return list(self.devices) if device is None else self.devices[device]
+
+    folder = Path(tempfile.mkdtemp())
+    routing = {'multichannel_device': 'Fireface', 'n_channels': 18, 'speakers': [
+        {'line_number': line, 'device': line // 2, 'channel': line % 2 + 1, 'matrix_channel': line + 3}
+        for line in range(14)]}
+    (folder / 'routing.json').write_text(json.dumps(routing))
+
+    fs = 44100
+    buffer_seconds = 2
+    audio_player = AudioPlayer(persistent_stream=True, routing_file=(folder / 'routing.json').as_posix(),
+                               registry=DeviceRegistry(backend=FakeBackend(), cache_file=None),
+                               stream_factory=lambda **kwargs: FakeOutputStream(realtime=False, **kwargs),
+                               buffer_seconds=buffer_seconds)
+    # streams are only opened for the devices with speakers
+    sf.write((folder / 'click.wav').as_posix(), np.zeros(100), fs, subtype='FLOAT')
+    audio_player.load_stimuli({'click': (folder / 'click.wav').as_posix()})
+    assert len(audio_player.device_numbers) == 12 and sorted(audio_player.engines) == list(range(7))
+    rng = np.random.default_rng(0)
+
+    def check_playback(audio_player, durations):
+        """ Plays noise files of the given durations on line 3 and compares the output with the files """
+        audio_player.set_output_line(3)
+        for duration in durations:
+            file_name = (folder / 'noise_{0}s.wav'.format(duration)).as_posix()
+            sf.write(file_name, rng.uniform(-0.5, 0.5, int(duration * fs)), fs, subtype='FLOAT')
+            audio_player.set_audio_file(file_name)
+            assert (audio_player.audio_stream is not None) == (duration > buffer_seconds)
+
+            engine = audio_player.get_engine(audio_player.output_device)
+            engine.stream.output = []
+            engine.stream.frames_played = 0
+            audio_player.play()
+            output = engine.stream.get_output()
+            onset = int(round((engine.onset_time - engine.latency) * fs))
+            expected = sf.read(file_name, dtype='float32')[0]
+            assert np.array_equal(output[onset:onset + len(expected), audio_player.output_channel - 1], expected)
+
+    # shorter than, as long as and longer than the ring buffer (e.g. 15 s with the default of 10 s)
+    check_playback(audio_player, [1.0, buffer_seconds, 1.5 * buffer_seconds, 3 * buffer_seconds])
+
+    # a sound with another sample rate than the running stream is not played at the wrong speed
+    audio_player.set_audio_data(np.zeros(100), 48000)
+    try:
+        audio_player.play()
+        raise AssertionError('a sound with the wrong sample rate was played')
+    except ValueError:
+        pass
+    audio_player.close()
+
+    # the same on the multichannel device (long files are streamed into the column of the speaker)
+    audio_player = AudioPlayer(persistent_stream=True, multichannel=True,
+                               routing_file=(folder / 'routing.json').as_posix(),
+                               registry=DeviceRegistry(backend=FakeBackend(), cache_file=None),
+                               stream_factory=lambda **kwargs: FakeOutputStream(realtime=False, **kwargs),
+                               buffer_seconds=buffer_seconds)
+    check_playback(audio_player, [1.0, 3 * buffer_seconds])
+    audio_player.close()
+    print('All checks passed')
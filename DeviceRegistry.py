@@ -0,0 +1,153 @@
+import json
+import logging
+from pathlib import Path
+
+#######################################################################
+# Process-wide registry of the audio devices.
+# The devices are enumerated only once per process and indexed by name,
+# number of output channels and host API. Resolved device numbers (e.g. of
+# the Fireface devices) are stored in a small cache file. On the next start,
+# the cached devices are checked one by one against the hardware, so the
+# full scan of all devices is only needed if something has changed.
+#######################################################################
+
+
+class DeviceRegistry():
+
+    def __init__(self, backend=None, cache_file='.device_cache.json'):
+        self.logger = logging.getLogger(__name__)
+
+        if backend is None:
+            import sounddevice as backend
+        self.backend = backend
+        self.cache_file = Path(cache_file) if cache_file is not None else None
+
+        # full list of devices, only filled by scan()
+        self.devices = None
+        self.by_name = {}
+        self.by_output_channels = {}
+        self.by_hostapi = {}
+        # single devices that were queried without a full scan
+        self._queried = {}
+
+        self.cache = self.load_cache()
+
+    def scan(self):
+        """ Enumerates all devices and builds the indexes """
+        self.logger.info("Scanning audio devices...")
+        try:
+            self.devices = list(self.backend.query_devices())
+        except Exception:
+            self.logger.error("No Output device found")
+            self.devices = []
+
+        self.by_name = {}
+        self.by_output_channels = {}
+        self.by_hostapi = {}
+        for i, dev in enumerate(self.devices):
+            self.by_name.setdefault(dev['name'], []).append(i)
+            self.by_output_channels.setdefault(dev['max_output_channels'], []).append(i)
+            self.by_hostapi.setdefault(dev['hostapi'], []).append(i)
+
+    def get_device(self, device_number):
+        """ Returns the device info of the given device number. A full scan is not needed for that. """
+        if self.devices is not None:
+            return self.devices[device_number]
+        if device_number not in self._queried:
+            self._queried[device_number] = self.backend.query_devices(device_number)
+        return self._queried[device_number]
+
+    def __getitem__(self, device_number):
+        return self.get_device(device_number)
+
+    def find(self, name=None, min_output_channels=0, hostapi=None, exclude=None):
+        """ Returns the numbers of all devices whose name contains name (and not exclude), that have at least
+            min_output_channels output channels and belong to the given host API (index).
+        """
+        if self.devices is None:
+            self.scan()
+
+        candidates = set(range(len(self.devices)))
+        if name is not None or exclude is not None:
+            candidates &= {i for dev_name, numbers in self.by_name.items()
+                           if (name is None or dev_name.find(name) != -1) and (exclude is None or dev_name.find(exclude) == -1)
+                           for i in numbers}
+        if min_output_channels > 0:
+            candidates &= {i for n, numbers in self.by_output_channels.items() if n >= min_output_channels for i in numbers}
+        if hostapi is not None:
+            candidates &= set(self.by_hostapi.get(hostapi, []))
+
+        return sorted(candidates)
+
+    def resolve(self, key, find):
+        """ Returns the device numbers that find(registry) returns. The result is stored in the cache under key.
+            If all cached devices still exist with the same name, the cached result is returned without scanning.
+            Empty results (e.g. the Fireface was switched off) are not cached, so the devices are searched again
+            on the next start.
+        """
+        entry = self.cache.get(key)
+        if entry is not None and self.is_valid(entry):
+            return entry['device_numbers']
+
+        device_numbers = find(self)
+        if not device_numbers:
+            if self.cache.pop(key, None) is not None:
+                self.save_cache()
+            return device_numbers
+        self.cache[key] = {
+            'device_numbers': device_numbers,
+            'names': [self.get_device(i)['name'] for i in device_numbers]
+        }
+        self.save_cache()
+        return device_numbers
+
+    def is_valid(self, entry):
+        """ Checks if the cached devices still exist with the same name. Empty entries are never valid. """
+        if not entry.get('device_numbers') or len(entry['device_numbers']) != len(entry.get('names', [])):
+            return False
+        for device_number, name in zip(entry['device_numbers'], entry['names']):
+            try:
+                if self.get_device(device_number)['name'] != name:
+                    return False
+            except Exception:
+                return False
+        return True
+
+    def load_cache(self):
+        if self.cache_file is None or not self.cache_file.exists():
+            return {}
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            self.logger.warning('Could not read device cache ' + str(self.cache_file))
+            return {}
+
+    def save_cache(self):
+        if self.cache_file is None:
+            return
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump(self.cache, f, indent=4)
+        except OSError:
+            self.logger.warning('Could not write device cache ' + str(self.cache_file))
+
+    def clear_cache(self):
+        """ Forgets all cached devices, e.g. after the sound card setup was changed """
+        self.cache = {}
+        self.devices = None
+        self._queried = {}
+        if self.cache_file is not None and self.cache_file.exists():
+            self.cache_file.unlink()
+
+
+# the registry that is shared by all AudioPlayers of this process
+_registry = None
+
+
+def get_registry():
+    """ Returns the process-wide device registry """
+    global _registry
+    if _registry is None:
+        _registry = DeviceRegistry()
+    return _registry
@@ -0,0 +1,63 @@
+import os
+import threading
+import time
+import numpy as np
+from ArduinoReader import FRAME_HEADER
+
+#######################################################################
+# Fake Arduino on a pseudo terminal (pty), only works on Linux / macOS.
+# The ArduinoReader connects to fake_arduino.port like to a real serial
+# port. press() sends the values of one button press with the timing of
+# the given baud rate (10 bits per byte), as text lines or binary frames.
+#######################################################################
+
+
+class FakeArduino():
+
+    def __init__(self, baud_rate=9600, binary=False, n_values=100):
+        self.baud_rate = baud_rate
+        self.binary = binary
+        self.n_values = n_values
+
+        self.master, self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+
+        # time of the first and the last byte of the last button press
+        self.first_byte_time = None
+        self.last_byte_time = None
+
+    def encode(self, values):
+        """ Encodes the values like the Arduino does """
+        if self.binary:
+            frames = np.zeros(len(values), dtype=[('header', 'S2'), ('value', '<f4')])
+            frames['header'] = FRAME_HEADER
+            frames['value'] = values
+            return frames.tobytes()
+        return ''.join('{0:.2f}\r\n'.format(value) for value in values).encode()
+
+    def press(self, angle=None):
+        """ Sends the values of one button press. Blocks until all bytes are sent. """
+        if angle is None:
+            angle = np.random.uniform(0, 135)
+        values = angle + np.random.normal(0, 0.5, self.n_values)
+        data = self.encode(values)
+
+        # send in small chunks to keep the timing of the baud rate
+        chunk_size = 16
+        byte_time = 10 / self.baud_rate
+        self.first_byte_time = time.perf_counter()
+        for i in range(0, len(data), chunk_size):
+            os.write(self.master, data[i:i + chunk_size])
+            self.last_byte_time = time.perf_counter()
+            time.sleep(max(0, self.first_byte_time + (i + chunk_size) * byte_time - time.perf_counter()))
+        return values.mean()
+
+    def press_later(self, delay, angle=None):
+        """ Sends the values of one button press after delay seconds (in a thread) """
+        timer = threading.Timer(delay, self.press, args=(angle,))
+        timer.start()
+        return timer
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
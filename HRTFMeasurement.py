@@ -0,0 +1,198 @@
+import time
+import logging
+import numpy as np
+import soundfile as sf
+
+#######################################################################
+# Measurement of head related transfer functions (HRTFs).
+# The excitation signal (audio/hrtf_measurement) is played n_repetitions
+# times on each speaker line and recorded synchronously with the in-ear
+# microphones (AudioPlayer.play_and_record()). The round-trip latency of the
+# audio interface is found by cross-correlation with the excitation and
+# removed before the recordings are split into the repetitions (the delays
+# between the ears and speakers are kept). The repetitions are averaged
+# and the impulse responses of all speakers and ears are deconvolved at once
+# (regularized division in the frequency domain), windowed and transformed
+# to HRTFs. The HRTFs are stored in a .npy file, which can be memory-mapped
+# (load_hrtfs()), with shape speakers x ears x frequency bins. The elevation
+# of each speaker is stored next to it (<name>_elevations.npy).
+#######################################################################
+
+excitation_files = {
+    'sweep': 'audio/hrtf_measurement/white_noise_44100_hz_200samples_sweep.wav',
+    'vn': 'audio/hrtf_measurement/white_noise_44100_hz_200samples_VN.wav',
+}
+
+
+def speaker_elevations(line_numbers):
+    """ Elevation of the speakers in degree: 11.25 deg between speakers, the lowest speaker is at -45 deg """
+    return np.asarray(line_numbers) * 11.25 - 45
+
+
+def excitation_train(excitation, n_repetitions, period, max_latency=0):
+    """ Repeats the excitation n_repetitions times, every period samples. One more period and max_latency
+        samples of silence are added at the end to record the response to the last repetition.
+    """
+    train = np.zeros((n_repetitions + 1) * period + max_latency, dtype=np.float32)
+    train[:n_repetitions * period].reshape(n_repetitions, period)[:, :len(excitation)] = excitation
+    return train
+
+
+def estimate_latency(recordings, excitation, max_latency, threshold=0.5):
+    """ Round-trip latency in samples (output, speaker, microphone and input) of recordings (lines x samples x ears)
+        of an excitation train: the first lag up to max_latency at which the cross-correlation with the excitation
+        reaches threshold times its maximum, i.e. the direct sound of the first repetition. The median over the
+        lines of the earlier ear is returned, so a silent line does not change the latency.
+    """
+    n_lags = max_latency + 1
+    segment = recordings[..., :n_lags + len(excitation), :]
+    n_fft = segment.shape[-2] + len(excitation)
+    xcorr = np.fft.irfft(np.fft.rfft(segment, n_fft, axis=-2) *
+                         np.conj(np.fft.rfft(excitation, n_fft))[:, np.newaxis], n_fft, axis=-2)[..., :n_lags, :]
+    xcorr = np.abs(xcorr)
+    onsets = np.argmax(xcorr >= threshold * xcorr.max(axis=-2, keepdims=True), axis=-2)
+    return int(np.median(onsets.min(axis=-1)))
+
+
+def split_repetitions(recordings, n_repetitions, period):
+    """ Splits recordings (... x samples x ears) of an excitation train into the repetitions
+        (... x repetitions x period x ears). Each repetition contains the response to one excitation.
+    """
+    shape = recordings.shape[:-2] + (n_repetitions, period, recordings.shape[-1])
+    return recordings[..., :n_repetitions * period, :].reshape(shape)
+
+
+def compute_hrtfs(repetitions, excitation, ir_length=512, regularization=1e-3, n_fade=64):
+    """ Computes the HRTFs of the recorded repetitions (speakers x repetitions x period x ears).
+        The repetitions are averaged before the deconvolution (this is the same as averaging the transfer
+        functions, but needs only one FFT per speaker and ear). The impulse responses are cut to ir_length
+        samples with a half Hann window of n_fade samples at the end.
+        Returns HRTFs (speakers x ears x ir_length // 2 + 1) and impulse responses (speakers x ears x ir_length).
+    """
+    period = repetitions.shape[-2]
+    n_fft = period
+    mean_recording = repetitions.mean(axis=1)
+
+    # regularized deconvolution: H = R X* / (|X|^2 + eps)
+    recorded = np.fft.rfft(mean_recording, n=n_fft, axis=-2)
+    excited = np.fft.rfft(excitation, n=n_fft)
+    power = np.abs(excited) ** 2
+    inverse = np.conj(excited) / (power + regularization * power.max())
+    impulse_responses = np.fft.irfft(recorded * inverse[:, np.newaxis], n=n_fft, axis=-2)
+
+    # speakers x ears x samples
+    impulse_responses = np.moveaxis(impulse_responses, -1, 1)[..., :ir_length]
+    window = np.ones(ir_length)
+    window[-n_fade:] = np.hanning(2 * n_fade)[n_fade:]
+    impulse_responses = impulse_responses * window
+
+    hrtfs = np.fft.rfft(impulse_responses, axis=-1)
+    return hrtfs.astype(np.complex64), impulse_responses.astype(np.float32)
+
+
+def save_hrtfs(file_name, hrtfs, elevations):
+    """ Stores the HRTFs in a .npy file that can be memory-mapped and the elevations next to it """
+    stored = np.lib.format.open_memmap(file_name, mode='w+', dtype=hrtfs.dtype, shape=hrtfs.shape)
+    stored[:] = hrtfs
+    stored.flush()
+    np.save(elevations_file(file_name), np.asarray(elevations))
+
+
+def load_hrtfs(file_name):
+    """ Returns the memory-mapped HRTFs (speakers x ears x frequency bins) and the elevations of the speakers """
+    return np.load(file_name, mmap_mode='r'), np.load(elevations_file(file_name))
+
+
+def elevations_file(file_name):
+    return file_name[:-len('.npy')] + '_elevations.npy' if file_name.endswith('.npy') else file_name + '_elevations.npy'
+
+
+class HRTFMeasurement():
+
+    def __init__(self, audio_player, excitation='vn', n_repetitions=24, input_channels=(1, 2), input_device=None,
+                 ir_length=512, max_latency=4096, pre_delay=32):
+        self.logger = logging.getLogger(__name__)
+        self.audio_player = audio_player
+        self.n_repetitions = n_repetitions
+        self.input_channels = list(input_channels)
+        self.input_device = input_device
+        self.ir_length = ir_length
+
+        self.excitation, self.fs = sf.read(excitation_files.get(excitation, excitation), dtype='float32')
+        # every repetition needs room for the excitation and the impulse response
+        self.period = len(self.excitation) + ir_length
+        # longest round-trip latency that is found and removed, samples kept before the direct sound
+        self.max_latency = max_latency
+        self.pre_delay = pre_delay
+        self.latency = None
+        self.train = excitation_train(self.excitation, n_repetitions, self.period, max_latency)
+
+    def record(self, line_numbers):
+        """ Plays the excitation train on all given lines and returns the recordings (lines x samples x ears) """
+        recordings = []
+        for line_number in line_numbers:
+            self.logger.info('Measuring line ' + str(line_number))
+            self.audio_player.set_output_line(line_number)
+            self.audio_player.set_audio_data(self.train, self.fs)
+            recordings.append(self.audio_player.play_and_record(self.input_channels, self.input_device))
+        return np.stack(recordings)
+
+    def measure(self, line_numbers, file_name=None):
+        """ Records and computes the HRTFs of all given lines. If file_name is given, they are stored. """
+        recordings = self.record(line_numbers)
+        hrtfs, impulse_responses = self.process(recordings)
+        if file_name is not None:
+            save_hrtfs(file_name, hrtfs, speaker_elevations(line_numbers))
+        return hrtfs, impulse_responses
+
+    def process(self, recordings):
+        """ Computes HRTFs and impulse responses of recordings (lines x samples x ears) """
+        self.latency = estimate_latency(recordings, self.excitation, self.max_latency)
+        self.logger.info('Round-trip latency: {0} samples ({1:.1f} ms)'.format(
+            self.latency, self.latency / self.fs * 1e3))
+        shift = max(self.latency - self.pre_delay, 0)
+        repetitions = split_repetitions(recordings[:, shift:], self.n_repetitions, self.period)
+        return compute_hrtfs(repetitions, self.excitation, self.ir_length)
+
+
+# Just for testing: synthetic recordings of known impulse responses
+if __name__ == '__main__':
+    n_speakers, n_ears, n_repetitions, ir_length, latency = 14, 2, 24, 512, 1000
+    excitation, fs = sf.read(excitation_files['vn'], dtype='float32')
+    period = len(excitation) + ir_length
+    rng = np.random.default_rng(0)
+
+    # random decaying impulse responses (speakers x ears x samples)
+    true_irs = rng.normal(0, 1, (n_speakers, n_ears, ir_length)) * np.exp(-np.arange(ir_length) / 40)
+    # direct sound
+    true_irs[..., 0] = 4
+    train = excitation_train(excitation, n_repetitions, period, max_latency=4096)
+    n_fft = len(train) + ir_length
+    recordings = np.fft.irfft(np.fft.rfft(train, n_fft) * np.fft.rfft(true_irs, n_fft), n_fft)[..., :len(train)]
+    recordings = np.moveaxis(recordings, 1, -1) + rng.normal(0, 0.01, (n_speakers, len(train), n_ears))
+
+    ts = time.perf_counter()
+    repetitions = split_repetitions(recordings, n_repetitions, period)
+    hrtfs, irs = compute_hrtfs(repetitions, excitation, ir_length, n_fade=1)
+    print('Processing of {0} speakers x {1} repetitions: {2:.3f} s'.format(
+        n_speakers, n_repetitions, time.perf_counter() - ts))
+
+    error = np.abs(irs - true_irs).max() / np.abs(true_irs).max()
+    print('Max. relative error of the impulse responses: {0:.4f}'.format(error))
+    assert error < 0.05
+
+    # the interface delays the recordings: the latency is removed, pre_delay samples are kept before the onset
+    delayed = np.concatenate([np.zeros((n_speakers, latency, n_ears)), recordings[:, :-latency]], axis=1)
+    assert estimate_latency(delayed, excitation, 4096) == latency
+    measurement = HRTFMeasurement(None, n_repetitions=n_repetitions, ir_length=ir_length, max_latency=4096)
+    irs = measurement.process(delayed)[1]
+    error = np.abs(irs[..., 32:-64] - true_irs[..., :-96]).max() / np.abs(true_irs).max()
+    print('Latency: {0} samples, max. relative error of the aligned impulse responses: {1:.4f}'.format(
+        measurement.latency, error))
+    assert measurement.latency == latency and error < 0.05
+
+    import tempfile
+    file_name = tempfile.mkdtemp() + '/hrtfs_test.npy'
+    save_hrtfs(file_name, hrtfs, speaker_elevations(np.arange(n_speakers)))
+    stored, elevations = load_hrtfs(file_name)
+    assert np.array_equal(stored, hrtfs) and elevations[0] == -45
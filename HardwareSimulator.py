@@ -0,0 +1,269 @@
+import argparse
+import tempfile
+import time
+from concurrent.futures import Future
+from pathlib import Path
+import numpy as np
+import soundfile as sf
+from ArduinoReader import Response, FRAME_SIZE
+from TimingLog import TimingLog
+from ResultWriter import ResultWriter
+from AngleProcessing import AngleProcessor, EncoderMapping, line_to_elevation, sample_header, session_files
+
+#######################################################################
+# Simulated hardware for load tests of whole sessions without the Fireface
+# and the Arduino.
+# - VirtualClock: replaces the time module (perf_counter(), perf_counter_ns(),
+#   sleep()). Sleeping only advances the virtual time, so a session runs much
+#   faster than real time. Pass it as clock to TrialScheduler and TimingLog.
+# - SimulatedAudioPlayer: has the interface of the AudioPlayer. Playback takes
+#   the output latency of the device plus the duration of the sound.
+# - SimulatedArduinoReader: has the interface of the ArduinoReader. The
+#   response of the participant (ParticipantModel) starts after a random
+#   reaction time and takes as long as the serial transfer of n_values values
+#   (text lines or binary frames) at the given baud rate. The values scatter
+#   around the angle of the handle (noise_sd) and are processed like the
+#   values of the Arduino (AngleProcessor).
+# - simulate_session(): runs the conditions like experiment_start.main(),
+#   without the interactive parts, and writes results, raw values, encoder
+#   mapping and timing log.
+#######################################################################
+
+
+class VirtualClock():
+
+    def __init__(self, start=0.0):
+        self.now_ns = int(start * 1e9)
+
+    def perf_counter(self):
+        return self.now_ns / 1e9
+
+    def perf_counter_ns(self):
+        return self.now_ns
+
+    def sleep(self, seconds):
+        """ Advances the virtual time by seconds, without waiting """
+        if seconds > 0:
+            self.now_ns += int(seconds * 1e9)
+
+    def advance_to(self, time_ns):
+        """ Advances the virtual time to time_ns (if it is in the future) """
+        self.now_ns = max(self.now_ns, int(time_ns))
+
+
+class SimulatedResponse(Future):
+    """ Future of a simulated response. The result is known in advance, but result() advances the clock until
+        the response is complete, like waiting for the Arduino.
+    """
+
+    def __init__(self, clock, response):
+        super().__init__()
+        self.clock = clock
+        self.set_result(response)
+
+    def result(self, timeout=None):
+        response = super().result(timeout)
+        self.clock.advance_to(response.last_byte_ns)
+        return response
+
+
+class ParticipantModel():
+    """ Perceived elevation: gain * elevation + bias + normal noise (sd in degree).
+        Reaction time from the sound onset: log-normal with median reaction_time (s) and shape reaction_time_sd.
+    """
+
+    def __init__(self, gain=0.7, bias=5.0, sd=10.0, reaction_time=1.5, reaction_time_sd=0.35, seed=None,
+                 mapping=None):
+        # encoder angle of the perceived elevation (default: elevation = 90 - angle)
+        self.mapping = EncoderMapping(None) if mapping is None else mapping
+        self.gain = gain
+        self.bias = bias
+        self.sd = sd
+        self.reaction_time = reaction_time
+        self.reaction_time_sd = reaction_time_sd
+        self.rng = np.random.default_rng(seed)
+
+    def respond(self, line_number):
+        """ Returns the angle of the handle (as sent by the Arduino) and the reaction time in s.
+            If line_number is None (no sound, e.g. start of a condition), the handle is in zero position.
+        """
+        angle = 0.0
+        if line_number is not None:
+            elevation = line_to_elevation(line_number)
+            estimate = np.clip(self.gain * elevation + self.bias + self.rng.normal(0, self.sd), -45, 90)
+            angle = float(self.mapping.to_angle(estimate))
+        reaction_time = self.reaction_time * np.exp(self.rng.normal(0, self.reaction_time_sd))
+        return angle, reaction_time
+
+
+class SimulatedAudioPlayer():
+
+    def __init__(self, clock, latency=0.006, latency_jitter=0.0005, fs=44100, seed=None, timing_log=None):
+        self.clock = clock
+        # output latency of the device in s (and its standard deviation)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.fs = fs
+        self.rng = np.random.default_rng(seed)
+        self.timing_log = timing_log
+        self.durations = {}
+        self.duration = 0
+        self.line_number = None
+        self.level_db = 0.0
+        self.onset_latency = None
+        # virtual time of the onset of the last sound in ns
+        self.onset_ns = None
+
+    def load_stimuli(self, files):
+        for key, file_name in files.items():
+            self.durations[key] = sf.info(file_name).duration
+
+    def use_synthesized_stimuli(self, parameters, **kwargs):
+        for key, parameter in parameters.items():
+            self.durations[key] = parameter['duration']
+
+    def set_stimulus(self, key):
+        self.duration = self.durations[key]
+
+    def set_audio_file(self, file_to_play):
+        self.duration = sf.info(file_to_play).duration
+
+    def set_output_line(self, line_number):
+        self.line_number = line_number
+
+    def set_level(self, level_db):
+        self.level_db = level_db
+
+    def play(self, async_rec=False):
+        """ Blocks (in virtual time) until the sound is played back, unless async_rec """
+        start_ns = self.clock.perf_counter_ns()
+        self.onset_latency = max(0, self.rng.normal(self.latency, self.latency_jitter))
+        self.onset_ns = start_ns + int(self.onset_latency * 1e9)
+        if not async_rec:
+            self.clock.advance_to(self.onset_ns + int(self.duration * 1e9))
+        if self.timing_log is not None:
+            self.timing_log.record('AudioPlayer', 'play', start_ns, self.clock.perf_counter_ns())
+            self.timing_log.record('AudioPlayer', 'onset', start_ns, self.onset_ns)
+
+    def close(self):
+        pass
+
+
+class SimulatedArduinoReader():
+
+    def __init__(self, clock, audio_player, participant=None, baud_rate=9600, binary=False, n_values=100,
+                 timing_log=None, noise_sd=0.5, seed=None):
+        self.clock = clock
+        # the participant responds to the last sound of the audio player
+        self.audio_player = audio_player
+        self.participant = ParticipantModel() if participant is None else participant
+        self.baud_rate = baud_rate
+        self.binary = binary
+        self.n_values = n_values
+        self.timing_log = timing_log
+        # scatter of the values of a button press in degree
+        self.noise_sd = noise_sd
+        self.rng = np.random.default_rng(seed)
+        self.processor = AngleProcessor()
+
+    def transfer_time(self, angle):
+        """ Duration of the serial transfer of one response in s (10 bits per byte: start, 8 data, stop bit) """
+        if self.binary:
+            n_bytes = self.n_values * FRAME_SIZE
+        else:
+            n_bytes = self.n_values * len('{0:.2f}\r\n'.format(angle))
+        return n_bytes * 10 / self.baud_rate
+
+    def request_response(self, callback=None):
+        """ Returns the (simulated) response to the last sound, see ArduinoReader.request_response() """
+        angle, reaction_time = self.participant.respond(self.audio_player.line_number)
+        samples = angle + self.rng.normal(0, self.noise_sd, self.n_values)
+        onset_ns = self.audio_player.onset_ns if self.audio_player.onset_ns is not None else self.clock.perf_counter_ns()
+        first_byte_ns = max(onset_ns + int(reaction_time * 1e9), self.clock.perf_counter_ns())
+        last_byte_ns = first_byte_ns + int(self.transfer_time(angle) * 1e9)
+        if self.timing_log is not None:
+            self.timing_log.record('ArduinoReader', 'transfer', first_byte_ns, last_byte_ns)
+
+        future = SimulatedResponse(self.clock, Response(self.processor.estimate(samples), first_byte_ns, last_byte_ns,
+                                                        samples))
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def get_data(self):
+        """ Waits (in virtual time) for a button press and returns the angle """
+        start_ns = self.clock.perf_counter_ns()
+        angle = self.request_response().result().angle
+        if self.timing_log is not None:
+            self.timing_log.record('ArduinoReader', 'read', start_ns, self.clock.perf_counter_ns())
+        return angle
+
+    def zeroing(self):
+        self.clock.sleep(2)
+
+    def close(self):
+        pass
+
+
+def simulate_session(results_folder, user_id='sim', participant=None, baud_rate=9600, binary=False, latency=0.006,
+                     seed=None):
+    """ Runs a whole session (all conditions, see experiment_start.run_session()) with simulated hardware in
+        virtual time. The configuration of the session (conditions, number of trials, isi, ...) is taken from
+        experiment_start. Returns the virtual duration of the session in s, the file name of the results and
+        the TimingLog.
+    """
+    import experiment_start
+
+    clock = VirtualClock()
+    results_file = (Path(results_folder) / ('userid_' + user_id + '_date_01.01.2000_time_00.00.csv')).as_posix()
+    timing_log = TimingLog(results_file[:-len('.csv')] + '_timing.log', clock=clock)
+    if participant is None:
+        participant = ParticipantModel(seed=seed)
+    sample_file, mapping_file = session_files(results_file)
+    participant.mapping.save(mapping_file)
+
+    with ResultWriter(results_file, flush_policy=experiment_start.results_flush_policy) as res_file_writer, \
+            ResultWriter(sample_file, flush_policy=experiment_start.results_flush_policy, compact=False) as sample_log:
+        audio_player = SimulatedAudioPlayer(clock, latency=latency, seed=seed, timing_log=timing_log)
+        experiment_start.load_stimuli(audio_player)
+        arduino_reader = SimulatedArduinoReader(clock, audio_player, participant, baud_rate, binary,
+                                                timing_log=timing_log, seed=seed)
+        sample_log.writerow(sample_header(arduino_reader.n_values))
+        experiment_start.run_session(audio_player, arduino_reader, res_file_writer, user_id, timing_log, clock,
+                                     sample_log=sample_log)
+
+    timing_log.close()
+    return clock.perf_counter(), results_file, timing_log
+
+
+# Just for testing: runs a full session in virtual time and checks the results
+if __name__ == '__main__':
+    import experiment_start
+    from ResultWriter import read_columns
+
+    parser = argparse.ArgumentParser(description='Runs a whole session with simulated hardware in virtual time')
+    parser.add_argument('-n', '--n-trials', type=int, default=experiment_start.n_trials, help='trials per condition')
+    parser.add_argument('-b', '--baud-rate', type=int, default=experiment_start.ARDUINO_BAUD_RATE, help='baud rate')
+    parser.add_argument('--binary', action='store_true', help='binary frames instead of text lines')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the simulated participant')
+    args = parser.parse_args()
+
+    # configuration of the session (like the globals of experiment_start)
+    experiment_start.n_trials = args.n_trials
+    experiment_start.sequence_seed = args.seed
+
+    ts = time.perf_counter()
+    duration, results_file, timing_log = simulate_session(tempfile.mkdtemp(), baud_rate=args.baud_rate,
+                                                          binary=args.binary, seed=args.seed)
+    wall_time = time.perf_counter() - ts
+
+    columns = read_columns(results_file)
+    assert len(columns['trial']) == 2 * args.n_trials
+    assert np.all(columns['reaction_time'] > 0)
+    # the raw values of the session give the same responses again
+    from AngleProcessing import reprocess_session
+    trials, conditions, angles, elevations = reprocess_session(results_file)
+    assert np.array_equal(trials, columns['trial']) and np.allclose(angles, columns['user_estimate'], atol=1e-6)
+    print('##### Session of {0} trials: {1:.1f} min virtual time, {2:.2f} s wall time ({3:.0f}x real time) #####'.format(
+        len(columns['trial']), duration / 60, wall_time, duration / wall_time))
+    timing_log.print_summary()
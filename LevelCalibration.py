@@ -0,0 +1,139 @@
+import json
+import os
+import numpy as np
+
+#######################################################################
+# Level calibration of the speakers and the hearing threshold test.
+# - LevelCalibration: table of the gain of every speaker in dB, stored in
+#   speaker_calibration.json. The gains equalize the level differences of the
+#   speakers (measure_speaker_levels() with a measurement microphone). The
+#   AudioPlayer applies them in software while the sound is copied into the
+#   output buffer, so the stimuli themselves are never changed.
+# - Staircase: adaptive 1-up/1-down procedure for the hearing threshold. The
+#   level is lowered after every 'heard' and raised after every 'not heard'
+#   answer. The step size is halved at every reversal (down to min_step_db).
+#   The threshold is the mean level of the reversals (without the first two).
+#######################################################################
+
+
+def db_to_gain(level_db):
+    return 10 ** (np.asarray(level_db, dtype=np.float64) / 20)
+
+
+def gain_to_db(gain):
+    return 20 * np.log10(gain)
+
+
+class LevelCalibration():
+
+    def __init__(self, calibration_file='speaker_calibration.json'):
+        self.calibration_file = calibration_file
+        # line number -> gain in dB
+        self.gains_db = {}
+        if calibration_file is not None and os.path.exists(calibration_file):
+            self.load()
+
+    def load(self):
+        with open(self.calibration_file) as f:
+            calibration = json.load(f)
+        self.gains_db = {int(line): float(gain) for line, gain in calibration['gains_db'].items()}
+
+    def save(self):
+        with open(self.calibration_file, 'w') as f:
+            json.dump({'gains_db': {str(line): gain for line, gain in sorted(self.gains_db.items())}}, f, indent=2)
+
+    def get_gain(self, line_number):
+        """ Returns the linear gain of the speaker (1 if the speaker is not calibrated) """
+        return float(db_to_gain(self.gains_db.get(line_number, 0.0)))
+
+    def get_gains(self, line_numbers):
+        return db_to_gain([self.gains_db.get(line, 0.0) for line in line_numbers]).astype(np.float32)
+
+    def set_gains_from_levels(self, levels_db):
+        """ Sets the gains from measured levels (dict: line number -> level in dB), so that all speakers are as
+            loud as the quietest one. All gains are <= 0 dB, so the calibration can never cause clipping.
+        """
+        reference = min(levels_db.values())
+        self.gains_db = {int(line): float(reference - level) for line, level in levels_db.items()}
+
+
+def measure_speaker_levels(audio_player, line_numbers, input_channel=1, input_device=None):
+    """ Plays the current sound of the audio player on every line and records it with a measurement microphone.
+        Returns the RMS level in dB of every line (dict). The calibration gains are not applied.
+    """
+    levels_db = {}
+    level_db = audio_player.level_db
+    calibration = audio_player.calibration
+    audio_player.calibration = None
+    audio_player.set_level(0)
+    try:
+        for line_number in line_numbers:
+            audio_player.set_output_line(line_number)
+            recording = audio_player.play_and_record([input_channel], input_device)
+            levels_db[line_number] = float(gain_to_db(np.sqrt(np.mean(np.square(recording, dtype=np.float64)))))
+    finally:
+        audio_player.calibration = calibration
+        audio_player.set_level(level_db)
+    return levels_db
+
+
+class Staircase():
+
+    def __init__(self, start_db=0.0, step_db=8.0, min_step_db=1.0, n_reversals=8, min_db=-90.0, max_db=0.0,
+                 max_trials=60):
+        self.level_db = start_db
+        self.step_db = step_db
+        self.min_step_db = min_step_db
+        self.n_reversals = n_reversals
+        self.min_db = min_db
+        self.max_db = max_db
+        self.max_trials = max_trials
+        # levels and answers of all trials, levels of the reversals
+        self.levels = []
+        self.answers = []
+        self.reversals = []
+
+    @property
+    def finished(self):
+        return len(self.reversals) >= self.n_reversals or len(self.answers) >= self.max_trials
+
+    def update(self, heard):
+        """ Stores the answer to the current level and returns the next level in dB """
+        if self.answers and self.answers[-1] != heard:
+            self.reversals.append(self.level_db)
+            self.step_db = max(self.min_step_db, self.step_db / 2)
+        self.levels.append(self.level_db)
+        self.answers.append(heard)
+
+        self.level_db += -self.step_db if heard else self.step_db
+        self.level_db = min(self.max_db, max(self.min_db, self.level_db))
+        return self.level_db
+
+    def threshold(self):
+        """ Mean level of the reversals without the first two (mean of all levels if there are not enough) """
+        if len(self.reversals) > 2:
+            return float(np.mean(self.reversals[2:]))
+        return float(np.mean(self.levels)) if self.levels else self.level_db
+
+
+# Just for testing: simulated listener with a known threshold
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    true_threshold = -37.0
+    errors, n_trials = [], []
+    for i in range(500):
+        staircase = Staircase()
+        while not staircase.finished:
+            # psychometric function: logistic with a slope of 1 dB
+            p_heard = 1 / (1 + np.exp(-(staircase.level_db - true_threshold)))
+            staircase.update(rng.random() < p_heard)
+        errors.append(staircase.threshold() - true_threshold)
+        n_trials.append(len(staircase.answers))
+    print('Threshold error: mean {0:.2f} dB, std {1:.2f} dB, trials: mean {2:.1f}, max {3}'.format(
+        np.mean(errors), np.std(errors), np.mean(n_trials), np.max(n_trials)))
+    assert abs(np.mean(errors)) < 1
+
+    calibration = LevelCalibration(None)
+    calibration.set_gains_from_levels({0: -20.0, 1: -23.0, 2: -21.5})
+    assert calibration.gains_db == {0: -3.0, 1: 0.0, 2: -1.5}
+    assert np.isclose(calibration.get_gain(0), 10 ** (-3 / 20)) and calibration.get_gain(5) == 1
@@ -0,0 +1,288 @@
+import argparse
+import json
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from AngleProcessing import EncoderMapping, line_to_elevation
+
+#######################################################################
+# Live statistics of a running session, updated after every trial.
+# - RunningStats: mean and variance with Welford's algorithm (O(1) per value)
+# - RunningRegression: regression of the perceived on the true elevation
+#   (elevation gain, intercept, r2) from running co-moments (O(1) per trial)
+# - OnlineMonitor: per condition the response rate, the reaction time, the
+#   regression and the mean and standard deviation of every speaker, plus
+#   warnings (dead speaker line, stuck or loose encoder). update() only
+#   takes a lock and a few additions, so it never delays the trial loop.
+#   serve() starts a local dashboard in a background thread:
+#     http://localhost:8050/            page that reloads itself
+#     http://localhost:8050/stats.json  all statistics
+#   and python OnlineMonitor.py --watch shows the same in a second terminal.
+# The encoder angles are converted with the EncoderMapping of the session.
+#######################################################################
+
+
+class RunningStats():
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def variance(self):
+        """ Sample variance (nan for less than two values) """
+        return self.m2 / (self.n - 1) if self.n > 1 else float('nan')
+
+    @property
+    def sd(self):
+        return float(np.sqrt(self.variance))
+
+
+class RunningRegression():
+
+    def __init__(self):
+        self.n = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        # sums of the squared and the cross deviations from the means
+        self.m2_x = 0.0
+        self.m2_y = 0.0
+        self.c_xy = 0.0
+
+    def update(self, x, y):
+        self.n += 1
+        dx = x - self.mean_x
+        dy = y - self.mean_y
+        self.mean_x += dx / self.n
+        self.mean_y += dy / self.n
+        self.m2_x += dx * (x - self.mean_x)
+        self.m2_y += dy * (y - self.mean_y)
+        self.c_xy += dx * (y - self.mean_y)
+
+    def get(self):
+        """ Returns gain, intercept and r2 (nan as long as all x are the same) """
+        if self.m2_x == 0:
+            return float('nan'), float('nan'), float('nan')
+        gain = self.c_xy / self.m2_x
+        intercept = self.mean_y - gain * self.mean_x
+        r2 = self.c_xy ** 2 / (self.m2_x * self.m2_y) if self.m2_y > 0 else 1.0
+        return gain, intercept, r2
+
+
+class ConditionStats():
+
+    def __init__(self):
+        self.n_trials = 0
+        self.reaction_time = RunningStats()
+        self.regression = RunningRegression()
+        self.estimates = RunningStats()
+        # line number -> [trials, RunningStats of the valid estimates]
+        self.speakers = {}
+
+
+class OnlineMonitor():
+
+    def __init__(self, mapping=None, max_reaction_time=5, min_trials=3, min_response_rate=0.5, max_sd=30.0,
+                 min_sd=1.0):
+        # encoder angle -> elevation
+        self.mapping = EncoderMapping(None) if mapping is None else mapping
+        # responses after max_reaction_time are invalid (like in the analysis)
+        self.max_reaction_time = max_reaction_time
+        # thresholds of the warnings, checked after min_trials trials of a speaker
+        self.min_trials = min_trials
+        self.min_response_rate = min_response_rate
+        self.max_sd = max_sd
+        self.min_sd = min_sd
+        self.conditions = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def update(self, trial, user_estimate, reaction_time):
+        """ Adds the result of a trial (see TrialScheduler.Trial). user_estimate is the angle of the encoder. """
+        valid = reaction_time <= self.max_reaction_time
+        elevation = float(line_to_elevation(trial.line_number))
+        estimate = float(self.mapping.to_elevation(user_estimate))
+        with self.lock:
+            condition = self.conditions.setdefault(trial.condition, ConditionStats())
+            speaker = condition.speakers.setdefault(trial.line_number, [0, RunningStats()])
+            condition.n_trials += 1
+            speaker[0] += 1
+            if valid:
+                condition.reaction_time.update(reaction_time)
+                condition.regression.update(elevation, estimate)
+                condition.estimates.update(estimate)
+                speaker[1].update(estimate)
+
+    def snapshot(self):
+        """ Returns all statistics as a dict (can be written as json) """
+        with self.lock:
+            conditions = {}
+            for name, condition in self.conditions.items():
+                gain, intercept, r2 = condition.regression.get()
+                conditions[name] = {
+                    'n_trials': condition.n_trials,
+                    'n_valid': condition.estimates.n,
+                    'sd': condition.estimates.sd,
+                    'response_rate': condition.reaction_time.n / condition.n_trials,
+                    'reaction_time': condition.reaction_time.mean if condition.reaction_time.n else float('nan'),
+                    'gain': gain, 'intercept': intercept, 'r2': r2,
+                    'speakers': {line: {'n_trials': n_trials, 'n_valid': stats.n,
+                                        'mean': stats.mean if stats.n else float('nan'), 'sd': stats.sd}
+                                 for line, (n_trials, stats) in sorted(condition.speakers.items())}
+                }
+        return {'conditions': conditions, 'warnings': self._get_warnings(conditions)}
+
+    def _get_warnings(self, conditions):
+        warnings = []
+        for name, condition in conditions.items():
+            # the handle is not moved at all: encoder stuck or not connected
+            if condition['n_valid'] >= self.min_trials * 2 and condition['sd'] < self.min_sd:
+                warnings.append(name + ': the estimates do not change, is the encoder connected?')
+            for line, speaker in condition['speakers'].items():
+                if speaker['n_trials'] < self.min_trials:
+                    continue
+                if speaker['n_valid'] / speaker['n_trials'] < self.min_response_rate:
+                    warnings.append(name + ': line {0}: only {1} of {2} trials answered, is the speaker playing?'.format(
+                        line, speaker['n_valid'], speaker['n_trials']))
+                elif speaker['sd'] > self.max_sd:
+                    warnings.append(name + ': line {0}: sd of the estimates {1:.0f} deg, is the encoder loose?'.format(
+                        line, speaker['sd']))
+        return warnings
+
+    def serve(self, port=8050):
+        """ Starts the dashboard on localhost in a background thread (port 0: any free port). Returns the port. """
+        monitor = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                snapshot = monitor.snapshot()
+                if self.path == '/stats.json':
+                    # nan is not valid json: null
+                    body, content_type = json.dumps(_nan_to_none(snapshot), allow_nan=False), 'application/json'
+                elif self.path == '/':
+                    body = ('<html><head><meta http-equiv="refresh" content="2"><title>Session monitor</title></head>'
+                            '<body><pre>' + format_snapshot(snapshot) + '</pre></body></html>')
+                    content_type = 'text/html'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type + '; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # no output in the terminal of the experiment
+                pass
+
+        self.server = ThreadingHTTPServer(('localhost', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def _nan_to_none(value):
+    """ Replaces nan in the nested dicts and lists of a snapshot with None """
+    if isinstance(value, dict):
+        return {key: _nan_to_none(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_nan_to_none(item) for item in value]
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _none_to_nan(value):
+    """ Inverse of _nan_to_none() for the statistics of /stats.json """
+    if isinstance(value, dict):
+        return {key: _none_to_nan(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_none_to_nan(item) for item in value]
+    return float('nan') if value is None else value
+
+
+def format_snapshot(snapshot):
+    """ Text view of the statistics of OnlineMonitor.snapshot() """
+    lines = []
+    for name, condition in snapshot['conditions'].items():
+        lines.append('{0}: {1} trials, response rate {2:.0%}, reaction time {3:.2f} s, gain {4:.2f}, '
+                     'intercept {5:.1f} deg, r2 {6:.2f}'.format(
+                         name, condition['n_trials'], condition['response_rate'], condition['reaction_time'],
+                         condition['gain'], condition['intercept'], condition['r2']))
+        lines.append('{0:>8}{1:>12}{2:>10}{3:>12}{4:>10}'.format('line', 'elevation', 'trials', 'mean', 'sd'))
+        for line, speaker in condition['speakers'].items():
+            lines.append('{0:>8}{1:>12.1f}{2:>10}{3:>12.1f}{4:>10.1f}'.format(
+                line, line_to_elevation(int(line)), speaker['n_trials'], speaker['mean'], speaker['sd']))
+        lines.append('')
+    lines += ['WARNING ' + warning for warning in snapshot['warnings']]
+    return '\n'.join(lines)
+
+
+# Just for testing: simulated participant with a dead speaker line, or --watch to show a running dashboard
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Live statistics of a running session')
+    parser.add_argument('--watch', metavar='URL', nargs='?', const='http://localhost:8050',
+                        help='show the statistics of the dashboard at URL in this terminal')
+    parser.add_argument('-i', '--interval', type=float, default=2.0, help='update interval of --watch in s')
+    args = parser.parse_args()
+
+    if args.watch:
+        while True:
+            with urllib.request.urlopen(args.watch + '/stats.json') as response:
+                snapshot = _none_to_nan(json.load(response))
+            print('\n' * 50 + format_snapshot(snapshot))
+            time.sleep(args.interval)
+
+    from HardwareSimulator import ParticipantModel
+    from TrialScheduler import Trial
+    from regression_stats import linear_regression
+
+    participant = ParticipantModel(seed=0)
+    rng = np.random.default_rng(0)
+    monitor = OnlineMonitor()
+    port = monitor.serve(0)
+    lines, estimates, timings = [], [], []
+    for i in range(400):
+        trial = Trial(i % 200, 'bin' if i < 200 else 'mono', int(rng.integers(10)), 'white')
+        angle, reaction_time = participant.respond(trial.line_number)
+        # line 7 does not play: the participant does not answer in time
+        if trial.line_number == 7 and trial.condition == 'mono':
+            reaction_time = 10.0
+        elif trial.condition == 'bin':
+            lines.append(line_to_elevation(trial.line_number))
+            estimates.append(monitor.mapping.to_elevation(angle))
+        ts = time.perf_counter()
+        monitor.update(trial, angle, reaction_time)
+        timings.append(time.perf_counter() - ts)
+
+    # a speaker with a single valid estimate has no sd yet: null in the json
+    monitor.update(Trial(0, 'single', 0, 'white'), 90.0, 1.0)
+    with urllib.request.urlopen('http://localhost:{0}/stats.json'.format(port)) as response:
+        body = response.read().decode()
+    monitor.close()
+    assert 'NaN' not in body and json.loads(body)['conditions']['single']['sd'] is None
+    snapshot = _none_to_nan(json.loads(body))
+    print(format_snapshot(snapshot))
+    print('update: mean {0:.1f} us, max {1:.1f} us'.format(np.mean(timings) * 1e6, np.max(timings) * 1e6))
+
+    assert np.allclose(monitor.snapshot()['conditions']['bin']['gain'], linear_regression(lines, estimates)[0])
+    assert np.allclose(snapshot['conditions']['bin']['r2'], linear_regression(lines, estimates)[2])
+    assert any('line 7' in warning for warning in snapshot['warnings'])
+    assert not any(warning.startswith('bin') for warning in snapshot['warnings'])
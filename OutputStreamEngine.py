@@ -0,0 +1,339 @@
+import threading
+import time
+import logging
+from collections import namedtuple
+import numpy as np
+
+#######################################################################
+# Persistent, low latency playback for the Fireface 802.
+# Instead of opening a new PortAudio stream for every sound (sd.play), one
+# OutputStream per device is opened at startup and kept running. Sounds are
+# written into a ring buffer, which is emptied by the stream callback.
+# Long stimuli (StimulusStream) are fed into the ring buffer block by block by
+# a feeder thread (play_stream()), so only the ring buffer is kept in memory.
+# - if you just want to test your code, without sound card, initialize
+#   OutputStreamEngine with stream_factory=FakeOutputStream.
+#######################################################################
+
+
+class RingBuffer():
+
+    def __init__(self, n_frames, n_channels):
+        self.buffer = np.zeros((n_frames, n_channels), dtype=np.float32)
+        self.n_frames = n_frames
+        self.n_channels = n_channels
+        self.read_index = 0
+        self.n_filled = 0
+        self.lock = threading.RLock()
+        # is notified whenever frames were read, see play_stream()
+        self.space_available = threading.Condition(self.lock)
+
+    @property
+    def n_free(self):
+        return self.n_frames - self.n_filled
+
+    def write(self, data, channel=None, gain=1.0):
+        """ Writes data into the buffer. If data is one dimensional, it is written to the given channel
+            (starting at 1, like the mapping of sd.play) and all other channels are silent.
+            The data is multiplied with gain while it is copied, data itself is not changed.
+        """
+        n = data.shape[0]
+        with self.lock:
+            if n > self.n_frames - self.n_filled:
+                raise ValueError('Ring buffer overflow: ' + str(n) + ' frames do not fit into the buffer ('
+                                 + str(self.n_frames - self.n_filled) + ' frames free)')
+
+            start = (self.read_index + self.n_filled) % self.n_frames
+            # the data might wrap around the end of the buffer
+            first = min(n, self.n_frames - start)
+            for dst, src in ((slice(start, start + first), slice(0, first)), (slice(0, n - first), slice(first, n))):
+                if data.ndim == 1:
+                    self.buffer[dst] = 0
+                    np.multiply(data[src], gain, out=self.buffer[dst, channel - 1], casting='unsafe')
+                else:
+                    np.multiply(data[src], gain, out=self.buffer[dst], casting='unsafe')
+            self.n_filled += n
+
+    def read_into(self, out):
+        """ Copies as many frames as available into out and fills the rest with zeros.
+            Returns the number of frames that were copied.
+        """
+        with self.lock:
+            n = min(out.shape[0], self.n_filled)
+            first = min(n, self.n_frames - self.read_index)
+            out[:first] = self.buffer[self.read_index:self.read_index + first]
+            out[first:n] = self.buffer[:n - first]
+            out[n:] = 0
+            self.read_index = (self.read_index + n) % self.n_frames
+            self.n_filled -= n
+            if n > 0:
+                self.space_available.notify_all()
+            return n
+
+    def clear(self):
+        with self.lock:
+            self.read_index = 0
+            self.n_filled = 0
+            self.space_available.notify_all()
+
+
+class OutputStreamEngine():
+
+    def __init__(self, device, fs, n_channels=2, blocksize=256, latency='low', buffer_seconds=10, stream_factory=None):
+        self.logger = logging.getLogger(__name__)
+
+        self.device = device
+        self.fs = fs
+        self.n_channels = n_channels
+        self.blocksize = blocksize
+
+        self.ring_buffer = RingBuffer(int(buffer_seconds * fs), n_channels)
+        # is set as soon as everything in the ring buffer was handed to the sound card
+        self.finished = threading.Event()
+        self.finished.set()
+
+        # timing of the last sound
+        self.play_time = None
+        self.onset_time = None
+        self.onset_latency = None
+        self.status_flags = []
+        self._waiting_for_onset = False
+        # a feeder thread is still writing a StimulusStream into the ring buffer
+        self._streaming = False
+        self._feeder = None
+        # blocks in which the feeder was too slow (silence in the middle of a stream)
+        self.stream_underruns = 0
+
+        if stream_factory is None:
+            import sounddevice as sd
+            stream_factory = sd.OutputStream
+
+        self.stream = stream_factory(device=device, samplerate=fs, channels=n_channels, dtype='float32',
+                                     blocksize=blocksize, latency=latency, callback=self._callback)
+        # the output latency reported by PortAudio
+        self.latency = self.stream.latency
+        self.logger.info('Opened output stream on device ' + str(device) + ' with ' + str(n_channels) +
+                         ' channels, latency: {0:.2f} ms'.format(self.latency * 1000))
+
+    def _callback(self, outdata, frames, time_info, status):
+        """ Called by PortAudio whenever the sound card needs new samples """
+        if status:
+            self.status_flags.append(str(status))
+
+        # play() must not queue a new sound while the state of the buffer is checked
+        with self.ring_buffer.lock:
+            n = self.ring_buffer.read_into(outdata)
+
+            if n > 0 and self._waiting_for_onset:
+                # first samples of the sound leave the sound card at the dac time of this block
+                self._waiting_for_onset = False
+                self.onset_time = time_info.outputBufferDacTime
+                self.onset_latency = self.onset_time - self.play_time
+
+            if n < frames:
+                if self._streaming:
+                    self.stream_underruns += 1
+                else:
+                    self.finished.set()
+
+    def start(self):
+        self.stream.start()
+
+    def close(self):
+        self.stop()
+        self.stream.stop()
+        self.stream.close()
+
+    def play(self, data, channel=1, block=True, gain=1.0):
+        """ Queues data for playback. If data is one dimensional it is played on the given channel only.
+            The samples are multiplied with gain on the way into the ring buffer.
+            If block is True, execution is blocked until the sound is played back.
+        """
+        if self._streaming:
+            self.stop()
+        with self.ring_buffer.lock:
+            self.play_time = self.stream.time
+            self._waiting_for_onset = True
+            self.finished.clear()
+            self.ring_buffer.write(data, channel, gain)
+
+        if block:
+            self.wait()
+
+    def play_stream(self, stream, channel=1, block=True, gain=1.0):
+        """ Plays a long stimulus (StimulusStream) without loading it into memory. The first block is queued
+            before this method returns (playback starts with the next callback), all other blocks are written
+            by a feeder thread as soon as there is space in the ring buffer.
+            channel, block and gain as in play().
+        """
+        if stream.fs != self.fs:
+            raise ValueError('Sample rate of ' + str(stream.file_name) + ' (' + str(stream.fs) + ' Hz) does not match '
+                             'the sample rate of the output stream (' + str(self.fs) + ' Hz)')
+        if stream.block_frames > self.ring_buffer.n_frames:
+            raise ValueError('Blocks of ' + str(stream.block_frames) + ' frames do not fit into the ring buffer')
+        if self._feeder is not None:
+            # only one stream at a time
+            self.stop()
+        blocks = stream.blocks()
+        gain = gain * stream.scale
+
+        with self.ring_buffer.lock:
+            self.play_time = self.stream.time
+            self._waiting_for_onset = True
+            self.finished.clear()
+            self._streaming = True
+        first_block = next(blocks, None)
+        if first_block is not None:
+            self._feed(first_block, channel, gain)
+
+        def feed_all():
+            for data in blocks:
+                if not self._feed(data, channel, gain):
+                    break
+            with self.ring_buffer.lock:
+                self._streaming = False
+        self._feeder = threading.Thread(target=feed_all, daemon=True)
+        self._feeder.start()
+
+        if block:
+            self.wait()
+
+    def _feed(self, data, channel, gain):
+        """ Waits for space in the ring buffer and writes data. Returns False if the stream was stopped. """
+        with self.ring_buffer.lock:
+            self.ring_buffer.space_available.wait_for(
+                lambda: not self._streaming or self.ring_buffer.n_free >= data.shape[0])
+            if not self._streaming:
+                return False
+            self.ring_buffer.write(data, channel, gain)
+            return True
+
+    def wait(self, timeout=None):
+        """ Blocks until all queued samples were handed to the sound card """
+        return self.finished.wait(timeout)
+
+    def stop(self):
+        """ Drops all samples that were not played yet (and stops a running stream) """
+        with self.ring_buffer.lock:
+            self._streaming = False
+            self.ring_buffer.clear()
+        if self._feeder is not None:
+            self._feeder.join()
+            self._feeder = None
+        self.finished.set()
+
+
+# time information that is passed to the stream callback, like in sounddevice
+StreamTime = namedtuple('StreamTime', ['inputBufferAdcTime', 'outputBufferDacTime', 'currentTime'])
+
+
+class FakeOutputStream():
+    """ Replacement for sd.OutputStream that runs without a sound card.
+        The callback is called from a thread, just like PortAudio does it. All samples
+        that are handed to the (fake) sound card are kept in self.output.
+    """
+
+    def __init__(self, device=None, samplerate=44100, channels=2, dtype='float32', blocksize=256, latency='low',
+                 callback=None, realtime=True, output_latency=0.005, keep_output=True):
+        self.device = device
+        self.samplerate = samplerate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.callback = callback
+        self.realtime = realtime
+        self.latency = output_latency
+        # if False, the played samples are not kept (long streams)
+        self.keep_output = keep_output
+
+        self.output = []
+        self.frames_played = 0
+        self.active = False
+        self._thread = None
+
+    @property
+    def time(self):
+        return self.frames_played / self.samplerate
+
+    def _run(self):
+        block_duration = self.blocksize / self.samplerate
+        next_block = time.perf_counter()
+        while self.active:
+            outdata = np.empty((self.blocksize, self.channels), dtype=np.float32)
+            now = self.time
+            self.callback(outdata, self.blocksize, StreamTime(0, now + self.latency, now), False)
+            if self.keep_output:
+                self.output.append(outdata)
+            self.frames_played += self.blocksize
+
+            if self.realtime:
+                next_block += block_duration
+                time.sleep(max(0, next_block - time.perf_counter()))
+            else:
+                # give other threads the chance to write into the buffer
+                time.sleep(0)
+
+    def start(self):
+        self.active = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.active = False
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self):
+        self.stop()
+
+    def get_output(self):
+        return np.concatenate(self.output) if self.output else np.zeros((0, self.channels), dtype=np.float32)
+
+
+# Just for testing
+if __name__ == '__main__':
+    import soundfile as sf
+
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    data, fs = sf.read('audio/white_noise_300.0ms_1000_bandwidth.wav', dtype='float32')
+
+    engine = OutputStreamEngine(None, fs, stream_factory=FakeOutputStream)
+    engine.start()
+
+    latencies = []
+    for i in range(10):
+        channel = i % 2 + 1
+        gain = 1 / (i + 1)
+        engine.play(data, channel, gain=gain)
+        latencies.append(engine.onset_latency)
+
+        # check that exactly the sound was played on the given channel
+        output = engine.stream.get_output()
+        onset = int(round((engine.onset_time - engine.latency) * fs))
+        played = output[onset:onset + len(data)]
+        assert np.allclose(played[:, channel - 1], data * gain)
+        assert not played[:, 2 - channel].any()
+    assert np.array_equal(data, sf.read('audio/white_noise_300.0ms_1000_bandwidth.wav', dtype='float32')[0])
+
+    # long stimulus: streamed from the memory-mapped file, the same samples are played
+    from StimulusStream import StimulusStream
+    stream = StimulusStream('audio/others/wn_long.wav', block_frames=4096)
+    engine.stream.output = []
+    engine.stream.frames_played = 0
+    ts = time.perf_counter()
+    engine.play_stream(stream, 2, block=False)
+    print('Time to first sample of a {0:.0f} s stimulus: {1:.2f} ms'.format(stream.duration, (time.perf_counter() - ts) * 1000))
+    engine.wait()
+    output = engine.stream.get_output()
+    onset = int(round((engine.onset_time - engine.latency) * fs))
+    expected = sf.read('audio/others/wn_long.wav', dtype='float32')[0]
+    assert np.allclose(output[onset:onset + len(expected), 1], expected, atol=1e-7)
+    print('Stream underruns: ' + str(engine.stream_underruns))
+
+    engine.close()
+
+    latencies = np.asarray(latencies) * 1000
+    print('Onset latency: mean {0:.2f} ms, std {1:.2f} ms, max {2:.2f} ms'.format(
+        latencies.mean(), latencies.std(), latencies.max()))
+    print('Status flags: ' + str(engine.status_flags))
@@ -0,0 +1,181 @@
+import csv
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+#######################################################################
+# Crash-safe writer for the results of the experiment.
+# Rows are appended to a csv file (the journal) by a background thread, so
+# writing never delays a trial. The flush policy sets when the rows are
+# forced to disk (flush + fsync):
+# - 'row':      after every row (nothing is lost in case of a crash)
+# - 'interval': at most every flush_interval seconds and whenever no more rows are waiting
+# - 'close':    only when the writer is closed
+# When the writer is closed, the journal is compacted into a typed, columnar
+# .npz file next to it (and a .parquet file, if pandas and pyarrow are installed).
+# If writing fails in the background thread (e.g. disk full), the error is
+# raised by the next call of writerow() or close().
+#######################################################################
+
+FLUSH_POLICIES = ['row', 'interval', 'close']
+# columns that are never converted to numbers (e.g. user id '007'), like all columns ending with '_id' or 'name'
+STRING_COLUMNS = ['condition', 'sound_type']
+
+
+class ResultWriter():
+
+    def __init__(self, file_name, flush_policy='row', flush_interval=1.0, compact=True):
+        if flush_policy not in FLUSH_POLICIES:
+            raise ValueError('Unknown flush policy: ' + str(flush_policy) + ', use one of ' + str(FLUSH_POLICIES))
+        self.file_name = file_name
+        self.flush_policy = flush_policy
+        self.flush_interval = flush_interval
+        self.compact_on_close = compact
+
+        self.file = open(file_name, mode='w', newline='')
+        self.writer = csv.writer(self.file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+        self.rows = queue.Queue()
+        # exception of the background thread, raised by writerow() and close()
+        self.error = None
+        self.write_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.write_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def writerow(self, row):
+        """ Appends a row to the journal, without waiting for it to be written """
+        if self.error is not None:
+            raise self.error
+        self.rows.put(list(row))
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _write_loop(self):
+        try:
+            self._write_rows()
+        except Exception as e:
+            # the rows are not written anymore, the error is raised in the thread of the experiment
+            self.error = e
+
+    def _write_rows(self):
+        last_sync = time.perf_counter()
+        while True:
+            try:
+                row = self.rows.get(timeout=self.flush_interval)
+            except queue.Empty:
+                row = False
+
+            if row is None:
+                # writer was closed
+                break
+            if row:
+                self.writer.writerow(row)
+
+            if self.flush_policy == 'row' and row:
+                self._sync()
+            elif self.flush_policy == 'interval' and (self.rows.empty() or time.perf_counter() - last_sync > self.flush_interval):
+                self._sync()
+                last_sync = time.perf_counter()
+
+    def close(self):
+        """ Writes all remaining rows, closes the journal and compacts it """
+        if self.file is None:
+            return
+        self.rows.put(None)
+        self.write_thread.join()
+        try:
+            if self.error is None:
+                self._sync()
+        finally:
+            self.file.close()
+            self.file = None
+        if self.error is not None:
+            raise self.error
+
+        if self.compact_on_close:
+            self.compact()
+
+    def compact(self):
+        """ Converts the journal into a typed, columnar .npz file (and .parquet if possible).
+            Returns the columns as dict of arrays.
+        """
+        columns = read_columns(self.file_name)
+        base_name = os.path.splitext(self.file_name)[0]
+        np.savez(base_name + '.npz', **columns)
+
+        try:
+            import pandas as pd
+            pd.DataFrame(columns).to_parquet(base_name + '.parquet')
+        except ImportError:
+            pass
+
+        return columns
+
+
+def is_string_column(name):
+    return name in STRING_COLUMNS or name.endswith('_id') or name.endswith('name')
+
+
+def read_columns(file_name):
+    """ Reads a csv file (with header) into a dict of typed arrays (int, float or str, see STRING_COLUMNS) """
+    with open(file_name, newline='') as f:
+        rows = list(csv.reader(f, delimiter=',', quotechar='"'))
+    if not rows:
+        # nothing was written (e.g. the session was aborted)
+        return {}
+    header, rows = rows[0], rows[1:]
+
+    values = np.array(rows, dtype=str).reshape(len(rows), len(header))
+    columns = {}
+    for i, name in enumerate(header):
+        columns[name] = values[:, i]
+        if is_string_column(name):
+            continue
+        for dtype in (np.int64, np.float64):
+            try:
+                columns[name] = values[:, i].astype(dtype)
+                break
+            except ValueError:
+                pass
+    return columns
+
+
+# Just for testing: ids stay strings, errors of the background thread are raised
+if __name__ == '__main__':
+    import tempfile
+
+    file_name = os.path.join(tempfile.mkdtemp(), 'results.csv')
+    with ResultWriter(file_name) as writer:
+        writer.writerow(['trial', 'user_estimate', 'condition', 'user_id'])
+        writer.writerow([0, 12.5, 'bin', '007'])
+    columns = np.load(file_name[:-len('.csv')] + '.npz')
+    assert columns['trial'].dtype == np.int64 and columns['user_estimate'].dtype == np.float64
+    assert columns['user_id'][0] == '007'
+
+    # nothing written at all
+    ResultWriter(os.path.join(tempfile.mkdtemp(), 'empty.csv')).close()
+
+    class BrokenWriter():
+        def writerow(self, row):
+            raise OSError(28, 'No space left on device')
+
+    writer = ResultWriter(os.path.join(tempfile.mkdtemp(), 'broken.csv'), compact=False)
+    writer.writer = BrokenWriter()
+    writer.writerow([0])
+    writer.write_thread.join(timeout=5)
+    for method in (lambda: writer.writerow([1]), writer.close):
+        try:
+            method()
+            raise AssertionError('the error of the background thread was not raised')
+        except OSError:
+            pass
+    print('All checks passed')
@@ -0,0 +1,78 @@
+import json
+import numpy as np
+
+#######################################################################
+# Maps the speakers (line numbers) to the outputs of the sound card.
+# The mapping is read from a config table (speaker_routing.json):
+# - device, channel: operating system device number and channel of the stereo
+#   Fireface device the speaker is connected to (one stream per device)
+# - matrix_channel: channel (starting at 1) of the speaker on the multichannel
+#   Fireface device (one stream for all speakers)
+# ATTENTION : The table needs to be adapted as soon as new sound devices are attached
+# to the computer! Use mapping_test.py to check it.
+#######################################################################
+
+
+def load_routing(routing_file='speaker_routing.json'):
+    """ Reads the routing table from the given json file """
+    with open(routing_file) as f:
+        return json.load(f)
+
+
+class SpeakerRouter():
+
+    def __init__(self, routing):
+        self.multichannel_device = routing['multichannel_device']
+        self.n_channels = routing['n_channels']
+        self.speakers = {speaker['line_number']: speaker for speaker in routing['speakers']}
+
+    def get_device_channel(self, line_number):
+        """ Returns the stereo device number and the channel of the given line number (speaker).
+            Unknown lines are mapped to device 0, channel 0.
+        """
+        if line_number not in self.speakers:
+            return 0, 0
+        speaker = self.speakers[line_number]
+        return speaker['device'], speaker['channel']
+
+    def get_matrix_channel(self, line_number):
+        """ Returns the channel (starting at 1) of the given line number on the multichannel device """
+        return self.speakers[line_number]['matrix_channel']
+
+    def find_multichannel_device(self, devices):
+        """ Returns the number of the first device (in the DeviceRegistry) whose name contains the configured
+            multichannel device name and that has enough output channels.
+        """
+        device_numbers = devices.find(self.multichannel_device, min_output_channels=self.n_channels)
+        if device_numbers:
+            return device_numbers[0]
+        raise ValueError('No multichannel device "' + self.multichannel_device + '" with ' + str(self.n_channels) +
+                         ' output channels found')
+
+    def route(self, signal, line_numbers, gains=None, out=None):
+        """ Creates the output matrix (frames x channels) of the multichannel device, in which the mono signal
+            is played on all given line numbers (speakers) at the same time. Each speaker can be weighted
+            with its own gain, e.g. to pan the sound between speakers.
+            If out is given (and has the correct shape), it is used instead of allocating a new matrix.
+        """
+        columns = np.array([self.get_matrix_channel(line) - 1 for line in line_numbers])
+        if gains is None:
+            gains = np.ones(len(columns), dtype=np.float32)
+
+        if out is None or out.shape != (signal.shape[0], self.n_channels):
+            out = np.zeros((signal.shape[0], self.n_channels), dtype=np.float32)
+        else:
+            out[:] = 0
+
+        out[:, columns] = signal[:, np.newaxis] * np.asarray(gains, dtype=np.float32)[np.newaxis, :]
+        return out
+
+    def pan(self, position):
+        """ Returns line numbers and gains to play a sound at a position between two neighbouring
+            speakers (e.g. position 4.5 is in the middle of line 4 and 5). Equal power panning is used.
+        """
+        lower = int(np.floor(position))
+        fraction = position - lower
+        if fraction == 0:
+            return [lower], [1.0]
+        return [lower, lower + 1], [np.cos(fraction * np.pi / 2), np.sin(fraction * np.pi / 2)]
@@ -0,0 +1,120 @@
+import struct
+import numpy as np
+import soundfile as sf
+
+#######################################################################
+# Long stimuli (e.g. audio/others/wn_long.wav or recordings of several
+# minutes), which are played without decoding the whole file into memory.
+# - uncompressed wav files (16/32 bit integer or 32 bit float PCM) are
+#   memory-mapped: the blocks are views into the file and are converted to
+#   float32 only when they are copied into the output buffer (see
+#   OutputStreamEngine.play_stream())
+# - all other files are decoded block by block with soundfile
+# The memory needed for playback does not depend on the length of the file.
+#######################################################################
+
+# wav format tags: PCM and IEEE float, WAVE_FORMAT_EXTENSIBLE stores the tag in the sub format
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def map_wav(file_name):
+    """ Memory-maps the samples of an uncompressed wav file.
+        Returns the samples (frames x channels, dtype of the file), the sample rate and the scale that converts
+        the samples to float (-1...1). Raises ValueError if the file can not be mapped.
+    """
+    with open(file_name, 'rb') as f:
+        riff, size, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(str(file_name) + ' is not a wav file')
+
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError('No data chunk in ' + str(file_name))
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                chunk = f.read(chunk_size)
+                format_tag, n_channels, fs, _, _, bits = struct.unpack('<HHIIHH', chunk[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE:
+                    format_tag = struct.unpack('<H', chunk[24:26])[0]
+                fmt = (format_tag, n_channels, fs, bits)
+            elif chunk_id == b'data':
+                offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size, 1)
+            # chunks are padded to an even size
+            if chunk_size % 2 == 1:
+                f.seek(1, 1)
+
+    if fmt is None:
+        raise ValueError('No fmt chunk in ' + str(file_name))
+    format_tag, n_channels, fs, bits = fmt
+    dtypes = {(WAVE_FORMAT_PCM, 16): ('<i2', 1 / 2 ** 15), (WAVE_FORMAT_PCM, 32): ('<i4', 1 / 2 ** 31),
+              (WAVE_FORMAT_IEEE_FLOAT, 32): ('<f4', 1.0)}
+    if (format_tag, bits) not in dtypes:
+        raise ValueError('Wav format ' + str(format_tag) + ' with ' + str(bits) + ' bits can not be mapped')
+    dtype, scale = dtypes[(format_tag, bits)]
+
+    n_frames = chunk_size // (n_channels * np.dtype(dtype).itemsize)
+    samples = np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=(n_frames, n_channels))
+    return samples, fs, scale
+
+
+class StimulusStream():
+
+    def __init__(self, file_name, block_frames=16384, mmap=True):
+        self.file_name = file_name
+        self.block_frames = block_frames
+        self.samples = None
+        if mmap:
+            try:
+                self.samples, self.fs, self.scale = map_wav(file_name)
+            except ValueError:
+                self.samples = None
+        if self.samples is not None:
+            self.n_frames, self.n_channels = self.samples.shape
+        else:
+            info = sf.info(file_name)
+            self.fs, self.n_frames, self.n_channels = info.samplerate, info.frames, info.channels
+            self.scale = 1.0
+
+    @property
+    def duration(self):
+        return self.n_frames / self.fs
+
+    def blocks(self):
+        """ Yields the samples block by block (mono: one dimensional). Multiply them with scale to get floats. """
+        if self.samples is not None:
+            for start in range(0, self.n_frames, self.block_frames):
+                block = self.samples[start:start + self.block_frames]
+                yield block[:, 0] if self.n_channels == 1 else block
+        else:
+            with sf.SoundFile(self.file_name) as f:
+                for block in f.blocks(self.block_frames, dtype='float32', always_2d=True):
+                    yield block[:, 0] if self.n_channels == 1 else block
+
+
+# Just for testing: the mapped blocks are the same as the decoded file
+if __name__ == '__main__':
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    data = np.random.default_rng(0).uniform(-0.5, 0.5, (44100 * 3 + 17, 2))
+    for subtype in ['PCM_16', 'PCM_32', 'FLOAT']:
+        file_name = folder + '/test_' + subtype + '.wav'
+        sf.write(file_name, data, 44100, subtype=subtype)
+        expected, fs = sf.read(file_name, dtype='float32')
+        for mmap in [True, False]:
+            stream = StimulusStream(file_name, block_frames=10000, mmap=mmap)
+            assert (stream.samples is not None) == mmap
+            streamed = np.concatenate([block * np.float32(stream.scale) for block in stream.blocks()])
+            assert stream.fs == fs and np.allclose(streamed, expected, atol=1e-7), subtype
+
+    stream = StimulusStream('audio/others/wn_long.wav')
+    assert np.allclose(np.concatenate([block * np.float32(stream.scale) for block in stream.blocks()]),
+                       sf.read('audio/others/wn_long.wav', dtype='float32')[0], atol=1e-7)
+    print('All checks passed')
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import numpy as np
+
+#######################################################################
+# Synthesis of the noise stimuli of the experiment.
+# - white noise: uniformly distributed noise (like white_noise_*.wav)
+# - rippled noise: the spectrum alternates between pass bands and stop bands
+#   of the given bandwidth in Hz (like rippled_noise_*_<bandwidth>_bandwidth.wav)
+# Optionally, the noise is band limited to [low, high] Hz. All filtering is
+# done in the frequency domain (rfft) for many tokens at once. Sounds are
+# ramped on and off with raised cosine ramps.
+# Tokens are generated from a seed, so a token can always be generated again.
+# StimulusCache keeps the last generated tokens in memory (LRU).
+#######################################################################
+
+NOISE_TYPES = ['white', 'rippled']
+
+
+def raised_cosine_ramps(signals, fs, ramp=0.005):
+    """ Applies raised cosine on- and off-ramps of ramp seconds to the signals (in place, last axis is time) """
+    n_ramp = min(int(ramp * fs), signals.shape[-1] // 2)
+    if n_ramp > 0:
+        window = 0.5 - 0.5 * np.cos(np.pi * np.arange(n_ramp) / n_ramp)
+        signals[..., :n_ramp] *= window
+        signals[..., -n_ramp:] *= window[::-1]
+    return signals
+
+
+def synthesize(noise_type, duration, bandwidth=1000, fs=44100, n_tokens=1, seed=None, low=None, high=None,
+               ripple_depth=25, level=0.3 / np.sqrt(3), ramp=0.005):
+    """ Returns n_tokens noise tokens (n_tokens x samples, float32).
+        - bandwidth: width of the pass and stop bands of the rippled noise in Hz
+        - low, high: optional band limits in Hz
+        - ripple_depth: attenuation of the stop bands in dB
+        - level: RMS of the tokens (default: RMS of uniform noise between -0.3 and 0.3, like the wav files)
+    """
+    if noise_type not in NOISE_TYPES:
+        raise ValueError('Unknown noise type: ' + str(noise_type) + ', use one of ' + str(NOISE_TYPES))
+    rng = np.random.default_rng(seed)
+    n_samples = int(round(duration * fs))
+    tokens = rng.uniform(-1, 1, (n_tokens, n_samples))
+
+    if noise_type == 'rippled' or low is not None or high is not None:
+        frequencies = np.fft.rfftfreq(n_samples, 1 / fs)
+        gain = np.ones(len(frequencies))
+        if noise_type == 'rippled':
+            # bands [0, bandwidth), [2 bandwidth, 3 bandwidth), ... are attenuated
+            stop_band = (frequencies // bandwidth) % 2 == 0
+            gain[stop_band] = 10 ** (-ripple_depth / 20)
+        if low is not None:
+            gain[frequencies < low] = 0
+        if high is not None:
+            gain[frequencies > high] = 0
+        tokens = np.fft.irfft(np.fft.rfft(tokens, axis=-1) * gain, n=n_samples, axis=-1)
+
+    tokens *= level / np.sqrt(np.mean(tokens ** 2, axis=-1, keepdims=True))
+    raised_cosine_ramps(tokens, fs, ramp)
+    return tokens.astype(np.float32)
+
+
+def token_seed(base_seed, noise_type, duration, bandwidth, token):
+    """ Returns the seed of a token, so that the same parameters always give the same token """
+    return np.random.SeedSequence([base_seed, NOISE_TYPES.index(noise_type), int(round(duration * 1e6)),
+                                   int(bandwidth), token])
+
+
+class StimulusCache():
+
+    def __init__(self, fs=44100, max_bytes=100 * 2 ** 20, base_seed=0):
+        self.fs = fs
+        # the least recently used tokens are removed, if the cache is larger than max_bytes
+        self.max_bytes = max_bytes
+        self.base_seed = base_seed
+        self.tokens = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, noise_type, duration, bandwidth=1000, token=0, **kwargs):
+        """ Returns the token with the given parameters (see synthesize()). It is generated if not in the cache. """
+        key = (noise_type, duration, bandwidth, token, tuple(sorted(kwargs.items())))
+        if key in self.tokens:
+            self.hits += 1
+            self.tokens.move_to_end(key)
+            return self.tokens[key]
+
+        self.misses += 1
+        seed = token_seed(self.base_seed, noise_type, duration, bandwidth, token)
+        data = synthesize(noise_type, duration, bandwidth, self.fs, seed=seed, **kwargs)[0]
+
+        self.tokens[key] = data
+        self.n_bytes += data.nbytes
+        while self.n_bytes > self.max_bytes and len(self.tokens) > 1:
+            key, removed = self.tokens.popitem(last=False)
+            self.n_bytes -= removed.nbytes
+        return data
+
+
+# Just for testing
+if __name__ == '__main__':
+    import soundfile as sf
+
+    for noise_type in NOISE_TYPES:
+        file_name = 'audio/' + noise_type + '_noise_300.0ms_1000_bandwidth.wav'
+        data, fs = sf.read(file_name, dtype='float32')
+        token = synthesize(noise_type, 0.3, 1000, fs, seed=1)[0]
+        assert token.shape == data.shape
+
+        # compare the band levels of the wav file and the synthesized token (pass band 1-2 kHz, stop band 2-3 kHz)
+        frequencies = np.fft.rfftfreq(len(data), 1 / fs)
+        for name, signal in [('wav', data), ('synthesized', token)]:
+            spectrum = np.abs(np.fft.rfft(signal))
+            levels = [20 * np.log10(spectrum[(frequencies >= f) & (frequencies < f + 1000)].mean()) for f in (1000, 2000)]
+            print('{0:<8} {1:<12} 1-2 kHz: {2:5.1f} dB   2-3 kHz: {3:5.1f} dB   RMS: {4:.3f}'.format(
+                noise_type, name, levels[0], levels[1], np.sqrt(np.mean(signal ** 2))))
@@ -0,0 +1,92 @@
+import csv
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+#######################################################################
+# Side-channel log of the timing of the experiment.
+# AudioPlayer, ArduinoReader and TrialScheduler record the start and end
+# (time.perf_counter_ns, monotonic) of each phase of a trial and the status
+# flags of the audio stream (e.g. output underflow). Every event is written
+# to the log file immediately. At the end of a session, print_summary()
+# shows the latency percentiles of all phases.
+#######################################################################
+
+PERCENTILES = [50, 90, 99]
+
+
+class TimingLog():
+
+    def __init__(self, log_file=None, clock=None):
+        self.events = []
+        # provides perf_counter_ns() (default: the time module, see HardwareSimulator for a virtual clock)
+        self.clock = time if clock is None else clock
+        self.trial = None
+        self.lock = threading.Lock()
+
+        self.file = None
+        if log_file is not None:
+            self.file = open(log_file, mode='w', newline='')
+            self.writer = csv.writer(self.file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            self.writer.writerow(['trial', 'source', 'phase', 'start_ns', 'end_ns', 'duration_ms', 'status'])
+
+    def set_trial(self, trial):
+        """ All following events belong to the given trial """
+        self.trial = trial
+
+    def record(self, source, phase, start_ns, end_ns=None, status=''):
+        """ Records one phase. If end_ns is not given, the phase ends now. """
+        if end_ns is None:
+            end_ns = self.clock.perf_counter_ns()
+        event = (self.trial, source, phase, start_ns, end_ns, (end_ns - start_ns) / 1e6, status)
+        with self.lock:
+            self.events.append(event)
+            if self.file is not None:
+                self.writer.writerow(event)
+                self.file.flush()
+
+    @contextmanager
+    def measure(self, source, phase):
+        """ Records the duration of the with block """
+        start_ns = self.clock.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(source, phase, start_ns)
+
+    def get_summary(self):
+        """ Returns count, percentiles and maximum of the duration (in ms) and the number of status flags
+            for each phase.
+        """
+        durations = {}
+        n_status = {}
+        with self.lock:
+            for trial, source, phase, start_ns, end_ns, duration_ms, status in self.events:
+                durations.setdefault((source, phase), []).append(duration_ms)
+                n_status[(source, phase)] = n_status.get((source, phase), 0) + (1 if status else 0)
+
+        summary = {}
+        for key, values in durations.items():
+            values = np.asarray(values)
+            summary[key] = {
+                'count': len(values),
+                'percentiles': dict(zip(PERCENTILES, np.percentile(values, PERCENTILES))),
+                'max': values.max(),
+                'n_status': n_status[key]
+            }
+        return summary
+
+    def print_summary(self):
+        print('{0:<16}{1:<16}{2:>7}'.format('source', 'phase', 'count') +
+              ''.join('{0:>12}'.format('p' + str(p) + ' [ms]') for p in PERCENTILES) +
+              '{0:>12}{1:>8}'.format('max [ms]', 'status'))
+        for (source, phase), item in self.get_summary().items():
+            print('{0:<16}{1:<16}{2:>7}'.format(source, phase, item['count']) +
+                  ''.join('{0:>12.3f}'.format(item['percentiles'][p]) for p in PERCENTILES) +
+                  '{0:>12.3f}{1:>8}'.format(item['max'], item['n_status']))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,160 @@
+import time
+import argparse
+from collections import namedtuple
+import numpy as np
+
+#######################################################################
+# Runs the trials of one condition.
+# The whole trial list is built up front. While the participant responds to
+# trial N, trial N+1 (sound and speaker) is already prepared. Instead of a
+# fixed sleep after each trial, the next sound is played isi seconds after the
+# response arrived, so time spent writing results is not added to the pause.
+# The duration of all phases of each trial is recorded (print_statistics()) and,
+# if a TimingLog is given, also written to its log file.
+# All times are taken from clock (default: the time module). With the virtual
+# clock of HardwareSimulator, whole sessions run faster than real time.
+# If a sample log is given (a ResultWriter, see AngleProcessing), the raw values of
+# every response are written to it, so the responses can be processed again later.
+#######################################################################
+
+Trial = namedtuple('Trial', ['index', 'condition', 'line_number', 'sound_type'])
+
+# wait: time before the sound is played (pause or, if not pipelined, preparation of the trial)
+# prepare: time after playback until the response is awaited (preparation of the next trial if pipelined)
+# onset_error: delay of the sound compared to the planned onset (pipelined only)
+PHASES = ['wait', 'play', 'prepare', 'response', 'write', 'onset_error']
+
+
+class TrialScheduler():
+
+    def __init__(self, audio_player, arduino_reader, isi=1.0, pipelined=True, timing_log=None, clock=None,
+                 sample_log=None):
+        self.audio_player = audio_player
+        self.arduino_reader = arduino_reader
+        # time between response and next sound in seconds
+        self.isi = isi
+        # if False, trials are run strictly one after the other with a fixed pause (like before)
+        self.pipelined = pipelined
+        # duration of the phases of all trials in seconds
+        self.timings = {phase: [] for phase in PHASES}
+        self.timing_log = timing_log
+        # provides perf_counter(), perf_counter_ns() and sleep()
+        self.clock = time if clock is None else clock
+        # raw values of the responses (rows: trial, condition, values)
+        self.sample_log = sample_log
+
+    @staticmethod
+    def build_trials(condition, stimulus_sequence, random_sequence, sound_types=('white', 'rippled')):
+        """ Creates the list of trials from the stimulus tuples (speaker, sound type) and their random order """
+        trials = []
+        for i_trial, i_tuple in enumerate(random_sequence):
+            line_number, sound_type = stimulus_sequence[i_tuple]
+            trials.append(Trial(i_trial, condition, int(line_number), sound_types[sound_type]))
+        return trials
+
+    def prepare(self, trial):
+        """ Selects sound and speaker of the trial, nothing is read from disk """
+        self.audio_player.set_stimulus(trial.sound_type)
+        self.audio_player.set_output_line(trial.line_number)
+
+    def run(self, trials, write_result):
+        """ Runs all trials. write_result(trial, user_estimate, reaction_time) is called after each response. """
+        if self.pipelined:
+            self.prepare(trials[0])
+        deadline = self.clock.perf_counter()
+
+        for i_trial, trial in enumerate(trials):
+            if self.timing_log is not None:
+                self.timing_log.set_trial(trial.condition + '_' + str(trial.index))
+            t_start = self.clock.perf_counter()
+            if self.pipelined:
+                # wait until the pause after the last response is over
+                self.clock.sleep(max(0, deadline - t_start))
+            else:
+                self.prepare(trial)
+            t_onset = self.clock.perf_counter()
+            self.audio_player.play()
+            t_played = self.clock.perf_counter()
+
+            # start measuring the time
+            ts = self.clock.perf_counter_ns()
+            print('Waiting for participant response...')
+            response = self.arduino_reader.request_response()
+
+            # prepare the next trial while the participant responds
+            if self.pipelined and i_trial + 1 < len(trials):
+                self.prepare(trials[i_trial + 1])
+            t_prepared = self.clock.perf_counter()
+
+            result = response.result()
+            t_response = self.clock.perf_counter()
+            reaction_time = (result.first_byte_ns - ts) / 1e9
+
+            write_result(trial, result.angle, reaction_time)
+            if self.sample_log is not None and result.samples is not None:
+                self.sample_log.writerow([trial.index, trial.condition] + list(result.samples))
+            t_written = self.clock.perf_counter()
+
+            self.timings['wait'].append(t_onset - t_start)
+            self.timings['play'].append(t_played - t_onset)
+            self.timings['prepare'].append(t_prepared - t_played)
+            self.timings['response'].append(t_response - t_prepared)
+            self.timings['write'].append(t_written - t_response)
+            if i_trial > 0 and self.pipelined:
+                self.timings['onset_error'].append(t_onset - deadline)
+
+            if self.timing_log is not None:
+                t = [int(t * 1e9) for t in (t_start, t_onset, t_played, t_prepared, t_response, t_written)]
+                for i_phase, phase in enumerate(PHASES[:5]):
+                    self.timing_log.record('TrialScheduler', phase, t[i_phase], t[i_phase + 1])
+
+            if self.pipelined:
+                deadline = t_response + self.isi
+            else:
+                # wait some time until playing the next sound
+                self.clock.sleep(self.isi)
+
+    def get_statistics(self):
+        """ Returns mean, standard deviation and maximum (in seconds) of all phases """
+        statistics = {}
+        for phase, timings in self.timings.items():
+            if timings:
+                timings = np.asarray(timings)
+                statistics[phase] = (timings.mean(), timings.std(), timings.max())
+        return statistics
+
+    def print_statistics(self):
+        for phase, (mean, std, maximum) in self.get_statistics().items():
+            print('{0:<12} mean: {1:9.3f} ms   std: {2:9.3f} ms   max: {3:9.3f} ms'.format(
+                phase, mean * 1000, std * 1000, maximum * 1000))
+
+
+# Simulated hardware: dummy audio player and arduino reader with a short response time
+if __name__ == '__main__':
+    from AudioPlayer import AudioPlayer
+    from ArduinoReader import ArduinoReader
+    from experiment_start import create_rand_balanced_order
+
+    parser = argparse.ArgumentParser(description='Runs the trial scheduler with simulated hardware')
+    parser.add_argument('-n', '--n-trials', type=int, default=40, help='number of trials')
+    parser.add_argument('-r', '--response-time', type=float, default=0.3, help='response time of the participant in s')
+    parser.add_argument('-i', '--isi', type=float, default=0.2, help='time between response and next sound in s')
+    args = parser.parse_args()
+
+    audio_player = AudioPlayer(dummy=True)
+    arduino_reader = ArduinoReader(dummy=True)
+    arduino_reader.dummy_response_time = args.response_time
+
+    n_speakers = 10
+    stimulus_sequence = [(i, j) for i in np.arange(n_speakers) for j in np.arange(2)]
+    random_sequence = create_rand_balanced_order(n_items=n_speakers * 2, n_trials=args.n_trials)
+
+    for pipelined in [False, True]:
+        scheduler = TrialScheduler(audio_player, arduino_reader, isi=args.isi, pipelined=pipelined)
+        trials = scheduler.build_trials('bin', stimulus_sequence, random_sequence)
+
+        ts = time.perf_counter()
+        scheduler.run(trials, lambda trial, user_estimate, reaction_time: None)
+        print('##### ' + ('pipelined' if pipelined else 'sequential') +
+              ' session: {0:.2f} s #####'.format(time.perf_counter() - ts))
+        scheduler.print_statistics()
@@ -0,0 +1,345 @@
+import argparse
+import csv
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import soundfile as sf
+from pathlib import Path
+from AudioPlayer import AudioPlayer
+from DeviceRegistry import DeviceRegistry
+from ArduinoReader import ArduinoReader, parse_text, parse_frames
+from ResultWriter import ResultWriter
+from StimulusSynthesis import NOISE_TYPES, StimulusCache, synthesize
+from StimulusStream import StimulusStream
+from AngleProcessing import AngleProcessor
+from OutputStreamEngine import OutputStreamEngine, FakeOutputStream
+
+#######################################################################
+# Micro-benchmarks for the timing critical parts of the experiment.
+# Run with the name of the benchmark, e.g.:
+#   python benchmarks.py stimulus_loading
+# Use -l to list all available benchmarks.
+#######################################################################
+
+
+sound_folder = Path('audio')
+
+
+def print_timings(name, timings):
+    """ Prints mean, standard deviation and maximum of the given timings (in seconds) in ms """
+    timings = np.asarray(timings) * 1000
+    print('{0:<40} mean: {1:8.4f} ms   std: {2:8.4f} ms   max: {3:8.4f} ms'.format(
+        name, timings.mean(), timings.std(), timings.max()))
+
+
+def benchmark_stimulus_loading(n_trials=200):
+    """ Compares the per-trial latency of reading the stimulus from disk (set_audio_file)
+        with selecting it from the preloaded stimulus bank (set_stimulus).
+    """
+    files = {
+        'white': (sound_folder / 'white_noise_300.0ms_1000_bandwidth.wav').as_posix(),
+        'rippled': (sound_folder / 'rippled_noise_300.0ms_1000_bandwidth.wav').as_posix()
+    }
+    keys = list(files.keys())
+    order = np.random.randint(0, len(keys), n_trials)
+
+    audio_player = AudioPlayer()
+    audio_player.logger.disabled = True
+
+    # current path: decode the file on every trial
+    timings = []
+    for i in order:
+        ts = time.perf_counter()
+        audio_player.set_audio_file(files[keys[i]])
+        timings.append(time.perf_counter() - ts)
+    print_timings('set_audio_file (sf.read)', timings)
+
+    # stimulus bank: decode once, select per trial
+    ts = time.perf_counter()
+    audio_player.load_stimuli(files)
+    print('{0:<40} {1:8.4f} ms (once)'.format('load_stimuli', (time.perf_counter() - ts) * 1000))
+
+    timings = []
+    for i in order:
+        ts = time.perf_counter()
+        audio_player.set_stimulus(keys[i])
+        timings.append(time.perf_counter() - ts)
+    print_timings('set_stimulus (bank)', timings)
+
+    # make sure both paths deliver the same samples
+    data, _ = sf.read(files['white'], dtype='float32')
+    audio_player.set_stimulus('white')
+    assert np.array_equal(data, audio_player.audio_data)
+
+
+class MockSoundDevice():
+    """ Replacement for the sounddevice module with many devices (like the Windows machine of the lab, where
+        every Fireface line shows up several times for the different host APIs). Every device that is queried
+        costs query_time seconds, like in PortAudio.
+    """
+
+    def __init__(self, n_devices=220, query_time=0.0002):
+        self.query_time = query_time
+        self.devices = []
+        for i in range(n_devices):
+            if i % 6 == 0:
+                name = 'Analog ({0}+{1}) (Fireface Analog ({0}+{1}))'.format(i % 14 + 1, i % 14 + 2)
+            else:
+                name = 'Some other device ' + str(i)
+            self.devices.append({'name': name, 'max_output_channels': 2, 'max_input_channels': 2,
+                                 'hostapi': i % 4, 'default_samplerate': 44100.0})
+        self.n_queries = 0
+
+    def query_devices(self, device=None):
+        if device is None:
+            self.n_queries += len(self.devices)
+            time.sleep(self.query_time * len(self.devices))
+            return list(self.devices)
+        self.n_queries += 1
+        time.sleep(self.query_time)
+        return self.devices[device]
+
+
+def benchmark_device_discovery(n_players=20):
+    """ Compares the startup time of the AudioPlayer with a full device scan for every player, the process-wide
+        device registry and the device cache of a previous start (mocked sounddevice backend).
+    """
+    backend = MockSoundDevice()
+    cache_file = Path(tempfile.mkdtemp()) / 'device_cache.json'
+
+    def create_players(new_registry):
+        timings = []
+        registry = DeviceRegistry(backend=backend, cache_file=cache_file)
+        for i in range(n_players):
+            ts = time.perf_counter()
+            if new_registry:
+                registry = DeviceRegistry(backend=backend, cache_file=cache_file)
+            audio_player = AudioPlayer(registry=registry)
+            audio_player.logger.disabled = True
+            timings.append(time.perf_counter() - ts)
+        return timings
+
+    # full scan on every construction (no cache, new registry)
+    cache_file = None
+    print_timings('full scan per player', create_players(True))
+
+    # one registry per process, first player scans
+    cache_file = Path(tempfile.mkdtemp()) / 'device_cache.json'
+    print_timings('process-wide registry', create_players(False))
+
+    # new process: registry is created again, but the cache of the last start is still valid
+    print_timings('cached device numbers', create_players(True))
+
+
+def benchmark_serial_acquisition(n_presses=10):
+    """ Compares the line by line readout of the ArduinoReader with the background reader (text lines and binary
+        frames) on a fake Arduino (pty). Reports the delay between the last byte and the returned estimate and the
+        total time of a button press, as well as the parsing throughput.
+    """
+    from FakeArduino import FakeArduino
+
+    settings = [
+        ('readline, text, 9600 baud', dict(baud_rate=9600, background=False, binary=False)),
+        ('background, text, 9600 baud', dict(baud_rate=9600, background=True, binary=False)),
+        ('background, binary, 115200 baud', dict(baud_rate=115200, background=True, binary=True)),
+    ]
+    for name, setting in settings:
+        fake_arduino = FakeArduino(baud_rate=setting['baud_rate'], binary=setting['binary'])
+        arduino_reader = ArduinoReader(port=fake_arduino.port, **setting)
+
+        delays = []
+        durations = []
+        for i in range(n_presses):
+            timer = fake_arduino.press_later(0.05)
+            arduino_reader.get_data()
+            ts = time.perf_counter()
+            timer.join()
+            delays.append(ts - fake_arduino.last_byte_time)
+            durations.append(ts - fake_arduino.first_byte_time)
+
+        print_timings(name + ' delay', delays)
+        print_timings(name + ' total', durations)
+        arduino_reader.close()
+        fake_arduino.close()
+
+    # parsing throughput without the serial port
+    fake_arduino = FakeArduino(binary=False, n_values=100000)
+    text = fake_arduino.encode(np.random.uniform(0, 135, 100000))
+    fake_arduino.binary = True
+    frames = fake_arduino.encode(np.random.uniform(0, 135, 100000))
+    fake_arduino.close()
+
+    ts = time.perf_counter()
+    [float(line.decode().rstrip()) for line in text.splitlines()]
+    print('{0:<40} {1:8.2f} Mvalues/s'.format('readline parsing', 0.1 / (time.perf_counter() - ts)))
+    ts = time.perf_counter()
+    parse_text(text)
+    print('{0:<40} {1:8.2f} Mvalues/s'.format('vectorized text parsing', 0.1 / (time.perf_counter() - ts)))
+    ts = time.perf_counter()
+    parse_frames(frames)
+    print('{0:<40} {1:8.2f} Mvalues/s'.format('binary frame parsing', 0.1 / (time.perf_counter() - ts)))
+
+
+def benchmark_result_writing(n_trials=400):
+    """ Compares the time a trial spends writing its result with a csv writer that is flushed and synced
+        on the trial path and with the ResultWriter (for all flush policies).
+    """
+    folder = Path(tempfile.mkdtemp())
+    row = [0, 5, 47.11, 'rippled', 'mono', 1.2345, '10']
+    header = ['trial', 'line_number', 'user_estimate', 'sound_type', 'condition', 'reaction_time', 'user_id']
+
+    # csv writer on the trial path, synced after every row
+    timings = []
+    with open(folder / 'direct.csv', mode='w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for i in range(n_trials):
+            ts = time.perf_counter()
+            writer.writerow([i] + row[1:])
+            f.flush()
+            os.fsync(f.fileno())
+            timings.append(time.perf_counter() - ts)
+    print_timings('csv writer + fsync', timings)
+
+    for flush_policy in ['row', 'interval', 'close']:
+        timings = []
+        ts_session = time.perf_counter()
+        with ResultWriter((folder / (flush_policy + '.csv')).as_posix(), flush_policy=flush_policy) as writer:
+            writer.writerow(header)
+            for i in range(n_trials):
+                ts = time.perf_counter()
+                writer.writerow([i] + row[1:])
+                timings.append(time.perf_counter() - ts)
+        print_timings('ResultWriter ' + flush_policy, timings)
+        print('{0:<40} {1:8.4f} ms (once)'.format('close + compaction', (time.perf_counter() - ts_session - sum(timings)) * 1000))
+
+    columns = np.load(folder / 'row.npz')
+    assert len(columns['trial']) == n_trials and columns['reaction_time'].dtype == np.float64
+
+
+def benchmark_stimulus_synthesis(n_tokens=200):
+    """ Compares the time per noise token of reading the wav file with synthesizing it (one by one and as batch)
+        and taking it from the StimulusCache.
+    """
+    for noise_type in NOISE_TYPES:
+        file_name = (sound_folder / (noise_type + '_noise_300.0ms_1000_bandwidth.wav')).as_posix()
+        fs = sf.info(file_name).samplerate
+
+        timings = []
+        for i in range(n_tokens):
+            ts = time.perf_counter()
+            sf.read(file_name, dtype='float32')
+            timings.append(time.perf_counter() - ts)
+        print_timings(noise_type + ' wav file', timings)
+
+        timings = []
+        for i in range(n_tokens):
+            ts = time.perf_counter()
+            synthesize(noise_type, 0.3, 1000, fs, seed=i)
+            timings.append(time.perf_counter() - ts)
+        print_timings(noise_type + ' synthesis', timings)
+
+        ts = time.perf_counter()
+        synthesize(noise_type, 0.3, 1000, fs, n_tokens=n_tokens, seed=0)
+        print('{0:<40} {1:8.4f} ms per token'.format(noise_type + ' batch synthesis', (time.perf_counter() - ts) / n_tokens * 1000))
+
+        cache = StimulusCache(fs)
+        timings = []
+        for i in range(n_tokens):
+            ts = time.perf_counter()
+            cache.get(noise_type, 0.3, 1000, token=i % 20)
+            timings.append(time.perf_counter() - ts)
+        print_timings(noise_type + ' cache (20 tokens)', timings)
+
+
+def benchmark_stimulus_streaming(durations=(0.3, 10, 60, 600, 1800)):
+    """ Compares the time to the first sample and the peak memory of reading a long stimulus into memory
+        (sf.read) with streaming it from the memory-mapped file (OutputStreamEngine.play_stream).
+    """
+    folder = tempfile.mkdtemp()
+    fs = 44100
+    rng = np.random.default_rng(0)
+    print('{0:>10}{1:>22}{2:>22}{3:>22}{4:>22}'.format('duration', 'read: first sample', 'read: peak memory',
+                                                       'stream: first sample', 'stream: peak memory'))
+    for duration in durations:
+        # 16 bit mono white noise, written block by block
+        file_name = os.path.join(folder, 'noise_{0}s.wav'.format(duration))
+        with sf.SoundFile(file_name, 'w', fs, 1, subtype='PCM_16') as f:
+            for start in range(0, int(duration * fs), fs * 10):
+                f.write(rng.uniform(-0.5, 0.5, min(fs * 10, int(duration * fs) - start)))
+
+        # read: the whole file has to be decoded before the first sample can be played
+        tracemalloc.start()
+        ts = time.perf_counter()
+        data, _ = sf.read(file_name, dtype='float32')
+        read_time = time.perf_counter() - ts
+        read_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del data
+
+        # stream: the first block is queued at once, the rest is played through the ring buffer
+        engine = OutputStreamEngine(None, fs, blocksize=4096, stream_factory=lambda **kwargs: FakeOutputStream(
+            realtime=False, keep_output=False, **kwargs))
+        engine.start()
+        tracemalloc.start()
+        ts = time.perf_counter()
+        engine.play_stream(StimulusStream(file_name), 1, block=False)
+        stream_time = time.perf_counter() - ts
+        engine.wait()
+        stream_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        engine.close()
+
+        print('{0:>9}s{1:>19.2f} ms{2:>19.1f} MB{3:>19.2f} ms{4:>19.1f} MB'.format(
+            duration, read_time * 1000, read_memory / 2 ** 20, stream_time * 1000, stream_memory / 2 ** 20))
+        os.remove(file_name)
+
+
+def benchmark_angle_processing(n_blocks=1000):
+    """ Compares the time per button press (100 values) of the arithmetic mean with the robust circular estimate
+        of the AngleProcessor (block by block during the session and all blocks at once when reprocessing).
+    """
+    rng = np.random.default_rng(0)
+    blocks = (rng.uniform(-60, 60, (n_blocks, 1)) + rng.normal(0, 0.5, (n_blocks, 100))) % 360
+    processor = AngleProcessor()
+
+    for name, func in [('arithmetic mean', np.mean), ('AngleProcessor', processor.estimate)]:
+        timings = []
+        for block in blocks:
+            ts = time.perf_counter()
+            func(block)
+            timings.append(time.perf_counter() - ts)
+        print_timings(name, timings)
+
+    ts = time.perf_counter()
+    processor.process(blocks)
+    print('{0:<40} {1:8.4f} ms per block'.format('AngleProcessor (all blocks)', (time.perf_counter() - ts) / n_blocks * 1000))
+
+
+benchmarks = {
+    'stimulus_loading': benchmark_stimulus_loading,
+    'device_discovery': benchmark_device_discovery,
+    'serial_acquisition': benchmark_serial_acquisition,
+    'result_writing': benchmark_result_writing,
+    'stimulus_synthesis': benchmark_stimulus_synthesis,
+    'stimulus_streaming': benchmark_stimulus_streaming,
+    'angle_processing': benchmark_angle_processing,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the localization experiment')
+    parser.add_argument('benchmark', nargs='*', help='name of the benchmark(s) to run, runs all if empty')
+    parser.add_argument('-l', '--list', action='store_true', help='show list of benchmarks and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, func in benchmarks.items():
+            print(name + ': ' + ' '.join(func.__doc__.split()))
+        parser.exit(0)
+
+    for name in args.benchmark or benchmarks.keys():
+        print('##### ' + name + ' #####')
+        benchmarks[name]()
@@ -1,13 +1,19 @@
 import numpy as np
 from pathlib import Path
+from collections import namedtuple
+from contextlib import contextmanager
 import logging
 from datetime import datetime
-import csv
-import time
-import random as rd
 from colorama import init, deinit, Fore, Style, Back
 from AudioPlayer import AudioPlayer
 from ArduinoReader import ArduinoReader
+from TrialScheduler import TrialScheduler
+from TimingLog import TimingLog
+from ResultWriter import ResultWriter
+from LevelCalibration import LevelCalibration, Staircase
+from OnlineMonitor import OnlineMonitor
+from AngleProcessing import EncoderMapping, sample_header, session_files
+from randomization import balanced_order, constrained_order
 
 
 # specifies the folder of the audio files
@@ -18,10 +24,46 @@ deafness_test_sound = sound_folder / 'white_noise_300.0ms_1000_bandwidth.wav'
 rippled_noise_sound = sound_folder / 'rippled_noise_300.0ms_1000_bandwidth.wav'
 white_noise_sound = sound_folder / 'white_noise_300.0ms_1000_bandwidth.wav'
 
+# synthesize the stimuli instead of reading the files above (a new noise token in every trial, see StimulusSynthesis)
+synthesize_stimuli = False
+synthesized_stimuli = {
+    'white': {'noise_type': 'white', 'duration': 0.3},
+    'rippled': {'noise_type': 'rippled', 'duration': 0.3, 'bandwidth': 1000}
+}
+
+# We have 2 conditions (monaural, binaural). In each condition, two different sounds are randomly played
+conditions = ['bin', 'mono']
 # number of speakers, starting from bottom
 n_speakers = 10
 # trials per condition
 n_trials = 200
+# seed of the random trial order (None: new order every session)
+sequence_seed = None
+# constraints of the trial order (see randomization.py)
+no_speaker_repeats = False  # the same speaker is never used in two consecutive trials
+max_sound_type_run = None  # maximum number of consecutive trials with the same sound type (None: no limit)
+# time between the response of the participant and the next sound in seconds
+isi = 1.0
+# when the results are forced to disk: 'row' (after every trial), 'interval' or 'close' (see ResultWriter)
+results_flush_policy = 'row'
+
+# gains of the speakers (see LevelCalibration, measured with python mapping_test.py -c <input channel>)
+speaker_calibration_file = 'speaker_calibration.json'
+# hearing threshold test: start level of the staircase and level of the mono condition below the threshold in dB
+deafness_start_db = 0.0
+deafness_margin_db = 3.0
+
+# keep one output stream per device open during the whole experiment (fixed onset latency)
+persistent_audio_stream = True
+# open the Fireface as one multichannel device instead of one stereo device per speaker pair (see speaker_routing.json)
+multichannel_audio = False
+
+# mapping of the encoder angle to the elevation (see AngleProcessing, measured with python mapping_test.py -e),
+# a copy is saved with the results of every session
+encoder_mapping_file = 'encoder_mapping.json'
+
+# port of the live statistics of the session on localhost (see OnlineMonitor, None: no monitor)
+online_monitor_port = 8050
 
 
 # Just for testing
@@ -30,54 +72,47 @@ dummy_arduino_reader = False
 
 # ARDUINO_PORT = '/dev/ttyUSB0' # Linux
 ARDUINO_PORT = 'COM3'  # Windows
+ARDUINO_BAUD_RATE = 9600
+# read the serial port in a background thread
+arduino_background = True
+# the Arduino sends packed binary frames instead of text lines (needs the binary firmware, e.g. with 115200 baud)
+arduino_binary = False
+
+
+# columns of the results file
+result_header = [
+    'trial',  # Trial
+    'line_number',  # line number (speaker number)
+    'user_estimate',  # perceived elevation in degree
+    'sound_type',  # type of the sound
+    'condition',  # condition
+    'reaction_time',  # time for participant to respond
+    'user_id'   # id of the user
+]
 
 
 def clear_screen():
     print('\n' * 50)
 
 
-def create_rand_balanced_order(n_items=2, n_trials=64):
+def create_rand_balanced_order(n_items=2, n_trials=64, seed=None):
     """ This function creates a balanced order. Make sure that the input is correct!"""
-    returnList = []
-    availableItems = []
-    trialsAlreadyAssignedToItem = [0] * n_items
-    numberOfTrialsPerItem = int(n_trials / n_items)
-
-    #  get still available for testing items
-    for i in range(n_items):
-        availableItems.append(i)
-
-    # until there are unused items
-    while len(availableItems) > 0:
-        # choose random item from the list
-        i = rd.randrange(0, len(availableItems))
-        chosenItem = availableItems[i]
-
-        # add to the returnList
-        returnList.append(chosenItem)
-
-        # update channelInfo
-        trialsAlreadyAssignedToItem[chosenItem] += 1
-
-        if trialsAlreadyAssignedToItem[chosenItem] == numberOfTrialsPerItem:
-            del availableItems[i:i + 1]
+    return list(balanced_order(n_items, n_trials, seed))
 
-    return returnList
 
-
-def test_deafness(test_trials=5):
-    """ Tests the hearing threshold of participants by repeatingly playing sound.
-        The sound level needs to be adapted in the FireFace GUI.
+def test_deafness(audio_player, test_trials=3):
+    """ Tests the hearing threshold of participants with an adaptive staircase (see LevelCalibration.Staircase).
+        The sound is played test_trials times per level, the level is changed in software between the repeats
+        (no file is read and the output stream keeps running). The level for the rest of the session is set
+        deafness_margin_db below the threshold and returned.
     """
-    sound_was_heard = True
-
-    # reduced the volume if the sound was heared
-    while sound_was_heard:
-        audio_player = AudioPlayer(deafness_test_sound.as_posix(), dummy=dummy_audio_player)
-
-        # set output line to speaker in the middle
-        audio_player.set_output_line(5)
+    audio_player.set_stimulus('deafness_test' if 'deafness_test' in audio_player.stimuli else 'white')
+    # set output line to speaker in the middle
+    audio_player.set_output_line(5)
 
+    staircase = Staircase(start_db=deafness_start_db)
+    while not staircase.finished:
+        audio_player.set_level(staircase.level_db)
         for j in range(test_trials):
             audio_player.play()
 
@@ -86,163 +121,210 @@ def test_deafness(test_trials=5):
 
         # get input regarding perception
         userAnswer = str(input())
+        staircase.update(not (userAnswer == 'n' or userAnswer == '0' or userAnswer == 'N'))
+        clear_screen()
 
-        # set status
-        if userAnswer == 'n' or userAnswer == '0' or userAnswer == 'N':
-            sound_was_heard = False
-            clear_screen()
-
-    print(Fore.RED + 'Do NOT forget to write down sound level!' + Style.RESET_ALL)
+    level_db = staircase.threshold() - deafness_margin_db
+    audio_player.set_level(level_db)
+    print(Fore.RED + 'Hearing threshold: {0:.1f} dB, sound level: {1:.1f} dB. Do NOT forget to write down the sound '
+          'level!'.format(staircase.threshold(), level_db) + Style.RESET_ALL)
     input()
     clear_screen()
-
-
-def main():
-    """ Main experiment code starts here.
+    return level_db
+
+
+def load_stimuli(audio_player):
+    """ Loads the stimuli of the experiment (files or synthesized) into the audio player """
+    if synthesize_stimuli:
+        audio_player.use_synthesized_stimuli(synthesized_stimuli)
+    else:
+        # read all stimuli once, so that no file is read during the trials
+        audio_player.load_stimuli({
+            'white': white_noise_sound.as_posix(),
+            'rippled': rippled_noise_sound.as_posix(),
+            'deafness_test': deafness_test_sound.as_posix()
+        })
+
+
+def run_condition(cond, i_cond, audio_player, arduino_reader, res_file_writer, user_id, timing_log=None, clock=None,
+                  monitor=None, sample_log=None):
+    """ Runs all trials of one condition (cond is the i_cond-th condition of the session) and writes the results
+        (and the raw values of the responses to sample_log). If an OnlineMonitor is given, it is updated after every
+        trial. Returns the TrialScheduler (timing statistics).
     """
+    # create tupels of all speakers with all sound types 10 speakers * 2 sounds = 20 tuples
+    stimulus_sequence = [(i, j) for i in np.arange(n_speakers) for j in np.arange(2)]
+    # We need to walk over this sequence to ensure that we tested all speakers and sounds
+    speakers = np.array([speaker for speaker, sound_type in stimulus_sequence])
+    sound_types = np.array([sound_type for speaker, sound_type in stimulus_sequence])
+    random_sequence = constrained_order(
+        len(stimulus_sequence), n_trials,
+        seed=None if sequence_seed is None else sequence_seed + i_cond,
+        no_repeat=speakers if no_speaker_repeats else None,
+        max_run=(sound_types, max_sound_type_run) if max_sound_type_run is not None else None)
+
+    trials = TrialScheduler.build_trials(cond, stimulus_sequence, random_sequence)
+
+    def write_result(trial, user_estimate, reaction_time):
+        # create data entry and add it to file
+        result_item = [
+            trial.index,  # Trial
+            trial.line_number,  # line number (speaker number)
+            user_estimate,  # perceived elevation in degree
+            trial.sound_type,  # type of the sound
+            trial.condition,  # condition
+            reaction_time,
+            user_id   # id of the user
+        ]
+
+        res_file_writer.writerow(result_item)
+        if monitor is not None:
+            monitor.update(trial, user_estimate, reaction_time)
+
+    # the next trial is prepared while the participant responds
+    scheduler = TrialScheduler(audio_player, arduino_reader, isi=isi, timing_log=timing_log, clock=clock,
+                               sample_log=sample_log)
+    scheduler.run(trials, write_result)
+    scheduler.print_statistics()
+    return scheduler
+
+
+def threshold_test(audio_player):
+    """ Hearing threshold test of the mono condition with instructions for the experimenter """
+    # Adjust the level of the sound so that the participant does not hear anything with both ears occluded.
+    print(Fore.RED + 'Make sure participant is wearing ear plugs and headphones' + Style.RESET_ALL)
+    input()
+    # run threshold test
+    test_deafness(audio_player)
 
-    # set path where the results are stored
-    results_path = Path('./results/')
-    results_path.mkdir(parents=False, exist_ok=True)
-
-    # We have 2 conditions (monaural, binaural). In each condition, two different sounds are randomly played
-    conditions = ['bin', 'mono']
-
-    # set number of trials per condition. each sound is then played n_trials/2
-    # make sure this numer is divideable by 2 (sounds) and 13 (number of speakers)
-    assert(n_trials % 2 == 0 and n_trials % n_speakers == 0)
+    clear_screen()
+    print(Fore.RED + 'Tell participant to remove headphone from leading ear' + Style.RESET_ALL)
+    input()
 
-    # ask for user id
-    print(Fore.GREEN + 'Please enter participant id: ' + Style.RESET_ALL)
-    user_id = input()
 
-    # create the path to the data file
-    date = datetime.now()
-    resultsFile = 'userid_' + user_id + '_date_' + date.strftime('%d.%m.%Y') + '_time_' + date.strftime('%H.%M') + '.csv'
-    resultsStoredIn = results_path / resultsFile
-
-    # start by creating a new data file to store the data.
-    # data is stored continously, so in case of a crash the data is not lost.
-    with open(resultsStoredIn.as_posix(), mode='w', newline='') as resFile:
-
-        # create the file
-        res_file_writer = csv.writer(resFile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-        # add headers
-        res_file_writer.writerow([
-            'trial',  # Trial
-            'line_number',  # line number (speaker number)
-            'user_estimate',  # perceived elevation in degree
-            'sound_type',  # type of the sound
-            'condition',  # condition
-            'reaction_time',  # time for participant to respond
-            'user_id'   # id of the user
-        ])
+def run_session(audio_player, arduino_reader, res_file_writer, user_id, timing_log=None, clock=None, monitor=None,
+                sample_log=None, interactive=False):
+    """ Runs all conditions. Without interactive, there are no prompts (and no hearing threshold test).
+        With interactive, the experimenter is guided through the session (see main()).
+        Returns the TrialScheduler of each condition.
+    """
+    res_file_writer.writerow(result_header)
 
+    if interactive:
         ### Determining hearing threshold first, if mono condition is first ###
-
         if conditions[0] == 'mono':
-            # Adjust the level of the sound so that the participant does not hear anything with both ears occluded.
-            print(Fore.RED + 'Make sure participant is wearing ear plugs and headphones' + Style.RESET_ALL)
-            input()
-
-            # start threshold test
-            test_deafness()
-
-            # instructions
-            clear_screen()
-            print(Fore.RED + 'Tell participant to remove headphone from leading ear' + Style.RESET_ALL)
-            input()
-
+            threshold_test(audio_player)
         clear_screen()
-        # Initialize AudioPlayer
-        audio_player = AudioPlayer(dummy=dummy_audio_player)
-        # Initialize Arduino Reader
-        arduino_reader = ArduinoReader(port=ARDUINO_PORT, dummy=dummy_arduino_reader)
-
         # Zeroing of the angle encoder
         print(Fore.RED + 'Confirm that the handle is in zero position (pointing downwards)' + Style.RESET_ALL)
         input()
-        arduino_reader.zeroing()
+    arduino_reader.zeroing()
 
+    if interactive:
         clear_screen()
         print(Back.RED + '###### Experiment is starting NOW ######' + Style.RESET_ALL)
         print(Back.RED + '########################################' + Style.RESET_ALL)
         print(Back.RED + '########################################' + Style.RESET_ALL)
 
-        # walk over all conditions
-        for i_cond, cond in enumerate(conditions):
-
+    schedulers = []
+    for i_cond, cond in enumerate(conditions):
+        if interactive:
             print(Fore.GREEN + 'The following condition is tested: ' + cond + '\n' + Style.RESET_ALL)
-
             print(Fore.GREEN + 'Participant starts experiment by pressing the button \n' + Style.RESET_ALL)
-            # wait for button press of participant
-            arduino_reader.get_data()
-
-            # create tupels of all speakers with all sound types 10 speakers * 2 sounds = 20 tuples
-            stimulus_sequence = [(i, j) for i in np.arange(n_speakers) for j in np.arange(2)]
-            # We need to walk over this sequence to ensure that we tested all speakers and sounds
-            random_sequence = create_rand_balanced_order(n_items=n_speakers * 2, n_trials=n_trials)
-
-            # walk over random sequence
-            for i_trial, i_tuple in enumerate(random_sequence):
-
-                # decode the stimulus sequence
-                num_speaker = stimulus_sequence[i_tuple][0]
-                sound_type = stimulus_sequence[i_tuple][1]
-                if sound_type == 1:
-                    audio_player.set_audio_file(rippled_noise_sound.as_posix())
-                    sound_type_name = 'rippled'
-                else:
-                    audio_player.set_audio_file(white_noise_sound.as_posix())
-                    sound_type_name = 'white'
-
-                # set output line to speaker in the middle
-                audio_player.set_output_line(num_speaker)
-                audio_player.play()
-
-                # start measuring the time
-                ts = datetime.now()
-
-                # get participant response
-                print('Waiting for participant response...')
-                user_estimate = arduino_reader.get_data()
-                # print('Response is : '+ str(user_estimate))
-
-                # calculate reaction time
-                reaction_time = (datetime.now() - ts).total_seconds()
-
-                # create data entry and add it to file
-                result_item = [
-                    i_trial,  # Trial
-                    num_speaker,  # line number (speaker number)
-                    user_estimate,  # perceived elevation in degree
-                    sound_type_name,  # type of the sound
-                    cond,  # condition
-                    reaction_time,
-                    user_id   # id of the user
-                ]
-
-                res_file_writer.writerow(result_item)
-
-                # wait some time until playing the next sound
-                time.sleep(1)
+        # participant starts the condition by pressing the button
+        arduino_reader.get_data()
+        schedulers.append(run_condition(cond, i_cond, audio_player, arduino_reader, res_file_writer, user_id,
+                                        timing_log, clock, monitor, sample_log))
 
+        if interactive:
             print("First Condition is finished.")
             input()
-
             # If the second condition is mono, then we need to do the threshold test
             if conditions[1] == 'mono':
+                threshold_test(audio_player)
+    return schedulers
+
+
+# files and devices of a session, see open_session()
+Session = namedtuple('Session', ['results_file', 'timing_log', 'res_file_writer', 'sample_log', 'audio_player',
+                                 'arduino_reader', 'monitor'])
+
+
+@contextmanager
+def open_session(user_id, results_folder='results'):
+    """ Creates the files of a session (results, timing log, raw values of the responses, encoder mapping) and
+        the devices, configured by the globals above. Yields a Session and closes everything at the end.
+    """
+    # set path where the results are stored
+    results_path = Path(results_folder)
+    results_path.mkdir(parents=True, exist_ok=True)
 
-                # Adjust the level of the sound so that the participant does not hear anything with both ears occluded.
-                print(Fore.RED + 'Make sure participant is wearing ear plugs and headphones' + Style.RESET_ALL)
-                input()
-                # run threshold test
-                test_deafness()
+    # create the path to the data file
+    date = datetime.now()
+    results_file = results_path / ('userid_' + user_id + '_date_' + date.strftime('%d.%m.%Y') + '_time_' +
+                                   date.strftime('%H.%M') + '.csv')
+    # timing of all trials is logged next to the results (not .csv, so it is not read as results)
+    timing_log = TimingLog(results_file.with_name(results_file.stem + '_timing.log').as_posix())
+    # raw values of the responses and the encoder mapping of the session, to process the responses again later
+    sample_file, mapping_file = session_files(results_file.as_posix())
+    encoder_mapping = EncoderMapping(encoder_mapping_file)
+    encoder_mapping.save(mapping_file)
+
+    # data is stored continously (in a background thread, see ResultWriter), so in case of a crash the data is not lost.
+    # At the end of the session, a typed .npz file is written next to the csv file.
+    with ResultWriter(results_file.as_posix(), flush_policy=results_flush_policy) as res_file_writer, \
+            ResultWriter(sample_file, flush_policy=results_flush_policy, compact=False) as sample_log:
+
+        # the hearing threshold test uses the same output streams as the trials
+        audio_player = AudioPlayer(dummy=dummy_audio_player, persistent_stream=persistent_audio_stream,
+                                   multichannel=multichannel_audio, timing_log=timing_log,
+                                   calibration=LevelCalibration(speaker_calibration_file))
+        load_stimuli(audio_player)
+
+        arduino_reader = ArduinoReader(port=ARDUINO_PORT, baud_rate=ARDUINO_BAUD_RATE, dummy=dummy_arduino_reader,
+                                       background=arduino_background, binary=arduino_binary, timing_log=timing_log)
+        sample_log.writerow(sample_header(arduino_reader.n_values))
+
+        # live statistics of the session, e.g. to find a dead speaker line after a few trials
+        monitor = None
+        if online_monitor_port is not None:
+            monitor = OnlineMonitor(mapping=encoder_mapping)
+            try:
+                port = monitor.serve(online_monitor_port)
+                print(Fore.GREEN + 'Live statistics: http://localhost:' + str(port) + Style.RESET_ALL)
+            except OSError as e:
+                # e.g. the port is used by another program: the session runs without the dashboard
+                logging.warning('Live statistics are not available (port ' + str(online_monitor_port) + '): ' + str(e))
+
+        try:
+            yield Session(results_file, timing_log, res_file_writer, sample_log, audio_player, arduino_reader, monitor)
+        finally:
+            # close the output streams and the serial connection
+            audio_player.close()
+            arduino_reader.close()
+            if monitor is not None:
+                monitor.close()
+
+    # latency report of the whole session
+    timing_log.print_summary()
+    timing_log.close()
+
+
+def main():
+    """ Main experiment code starts here.
+    """
+
+    # set number of trials per condition. each sound is then played n_trials/2
+    # make sure this numer is divideable by 2 (sounds) and 13 (number of speakers)
+    assert(n_trials % 2 == 0 and n_trials % n_speakers == 0)
+
+    # ask for user id
+    print(Fore.GREEN + 'Please enter participant id: ' + Style.RESET_ALL)
+    user_id = input()
 
-                clear_screen()
-                print(Fore.RED + 'Tell participant to remove headphone from leading ear' + Style.RESET_ALL)
-                input()
+    with open_session(user_id) as session:
+        run_session(session.audio_player, session.arduino_reader, session.res_file_writer, user_id,
+                    session.timing_log, monitor=session.monitor, sample_log=session.sample_log, interactive=True)
 
 
 if __name__ == '__main__':
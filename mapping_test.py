@@ -2,6 +2,43 @@ import argparse
 import sounddevice as sd
 import logging
 from AudioPlayer import AudioPlayer
+from LevelCalibration import LevelCalibration, measure_speaker_levels
+from AngleProcessing import EncoderMapping, line_to_elevation
+
+
+def calibrate(input_channel, calibration_file='speaker_calibration.json'):
+    """ Measures the level of every line with a measurement microphone on the given input channel and stores the
+        gains that equalize the speakers (see LevelCalibration)
+    """
+    fileToPlay = "audio/white_noise_300.0ms_1000_bandwidth.wav"
+    audio_player = AudioPlayer(fileToPlay)
+    calibration = LevelCalibration(calibration_file)
+    levels_db = measure_speaker_levels(audio_player, range(13), input_channel)
+    calibration.set_gains_from_levels(levels_db)
+    calibration.save()
+    for line, level in levels_db.items():
+        logging.info('Line {0}: level {1:.1f} dB, gain {2:.1f} dB'.format(line, level, calibration.gains_db[line]))
+
+
+def calibrate_encoder(line_numbers=(0, 4, 9, 12), mapping_file='encoder_mapping.json', port='COM3'):
+    """ Fits the mapping of the encoder angle to the elevation: the handle is pointed at each of the given lines
+        (speakers) and the button is pressed. The mapping is stored (see AngleProcessing.EncoderMapping).
+    """
+    from ArduinoReader import ArduinoReader
+    arduino_reader = ArduinoReader(port=port)
+    input('Put the handle in zero position (pointing downwards) and press enter')
+    arduino_reader.zeroing()
+    angles = []
+    for line in line_numbers:
+        print('Point the handle at line ' + str(line) + ' and press the button')
+        angles.append(arduino_reader.get_data())
+    arduino_reader.close()
+
+    mapping = EncoderMapping(mapping_file)
+    residual_sd = mapping.fit(angles, line_to_elevation(line_numbers))
+    mapping.save()
+    logging.info('Encoder mapping: elevation = {0:.2f} + {1:.3f} * angle, residual sd {2:.2f} deg'.format(
+        mapping.offset, mapping.gain, residual_sd))
 
 
 def main():
@@ -38,6 +75,12 @@ if __name__ == '__main__':
     parser.add_argument(
         '-l', '--list-devices', action='store_true',
         help='show list of audio devices and exit')
+    parser.add_argument(
+        '-c', '--calibrate', type=int, metavar='INPUT_CHANNEL',
+        help='measure the level of all lines with the microphone on INPUT_CHANNEL and store the speaker gains')
+    parser.add_argument(
+        '-e', '--encoder', metavar='PORT',
+        help='measure the angles of the handle pointing at some lines (Arduino on PORT) and store the encoder mapping')
     args, remaining = parser.parse_known_args()
     if args.list_devices:
         for i,dev in enumerate(sd.query_devices()):
@@ -50,4 +93,9 @@ if __name__ == '__main__':
         parents=[parser])
     args = parser.parse_args(remaining)
 
-    main()
+    if args.calibrate is not None:
+        calibrate(args.calibrate)
+    elif args.encoder is not None:
+        calibrate_encoder(port=args.encoder)
+    else:
+        main()
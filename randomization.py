@@ -0,0 +1,166 @@
+import time
+import numpy as np
+
+#######################################################################
+# Balanced, seedable trial orders.
+# Items are the indices of the stimulus tuples (speaker, sound type) of the
+# experiment. Every item is used equally often. Optional constraints:
+# - no_repeat: array with one value per item (e.g. the speaker of each item).
+#   Two consecutive trials never have the same value.
+# - max_run: (values, n) no more than n consecutive trials have the same value
+#   (e.g. the sound type of each item).
+# Orders can be split into balanced blocks and the order of blocks / conditions
+# can be counterbalanced over participants with a (Williams) latin square.
+#######################################################################
+
+
+def balanced_order(n_items, n_trials, seed=None):
+    """ Returns a random order of n_trials trials, in which every item is used n_trials / n_items times """
+    if n_trials % n_items != 0:
+        raise ValueError('n_trials (' + str(n_trials) + ') has to be divisible by n_items (' + str(n_items) + ')')
+    rng = np.random.default_rng(seed)
+    return rng.permutation(np.repeat(np.arange(n_items), n_trials // n_items))
+
+
+def constrained_order(n_items, n_trials, seed=None, no_repeat=None, max_run=None, history=(), max_attempts=100):
+    """ Returns a balanced random order (like balanced_order()) that fulfills the constraints no_repeat and
+        max_run (see above). history are the items of the trials before (e.g. of the last block), which are
+        taken into account for the constraints.
+        Items are drawn one after the other with a probability proportional to how often they still have to be
+        used, so the order stays balanced. If no item fulfills the constraints, the order is started again.
+    """
+    if no_repeat is None and max_run is None:
+        return balanced_order(n_items, n_trials, seed)
+    if n_trials % n_items != 0:
+        raise ValueError('n_trials (' + str(n_trials) + ') has to be divisible by n_items (' + str(n_items) + ')')
+
+    rng = np.random.default_rng(seed)
+    if max_run is not None:
+        run_values, max_run_length = np.asarray(max_run[0]), max_run[1]
+    if no_repeat is not None:
+        no_repeat = np.asarray(no_repeat)
+
+    for attempt in range(max_attempts):
+        remaining = np.full(n_items, n_trials // n_items)
+        order = np.empty(n_trials, dtype=int)
+        # random numbers for all draws at once
+        draws = rng.random(n_trials)
+        last = history[-1] if len(history) > 0 else None
+        run_length = 0
+        if last is not None and max_run is not None:
+            # length of the run at the end of the history
+            history_values = run_values[np.asarray(history)]
+            run_length = np.argmin(history_values[::-1] == history_values[-1]) or len(history_values)
+
+        for i in range(n_trials):
+            allowed = remaining > 0
+            if last is not None:
+                if no_repeat is not None:
+                    allowed &= no_repeat != no_repeat[last]
+                if max_run is not None and run_length >= max_run_length:
+                    allowed &= run_values != run_values[last]
+
+            weights = np.where(allowed, remaining, 0).cumsum()
+            if weights[-1] == 0:
+                break
+            item = np.searchsorted(weights, draws[i] * weights[-1], side='right')
+
+            if max_run is not None:
+                run_length = run_length + 1 if last is not None and run_values[item] == run_values[last] else 1
+            order[i] = item
+            remaining[item] -= 1
+            last = item
+        else:
+            return order
+
+    raise ValueError('No order found that fulfills the constraints after ' + str(max_attempts) + ' attempts')
+
+
+def blocked_order(n_items, n_trials, n_blocks, seed=None, **constraints):
+    """ Returns an order of n_blocks blocks, each of them balanced on its own (see constrained_order()).
+        The constraints also hold at the borders between blocks.
+    """
+    if n_trials % n_blocks != 0:
+        raise ValueError('n_trials (' + str(n_trials) + ') has to be divisible by n_blocks (' + str(n_blocks) + ')')
+    rng = np.random.default_rng(seed)
+    blocks = []
+    for i in range(n_blocks):
+        history = blocks[-1] if blocks else ()
+        blocks.append(constrained_order(n_items, n_trials // n_blocks, seed=rng, history=history, **constraints))
+    return np.concatenate(blocks)
+
+
+def latin_square(n):
+    """ Returns a balanced (Williams) latin square. Each row is the order of the n conditions for one participant.
+        Every condition is preceded by every other condition equally often. For odd n, 2n rows are needed.
+    """
+    # first row: 0, 1, n-1, 2, n-2, ...
+    first = np.zeros(n, dtype=int)
+    first[1::2] = np.arange(1, n // 2 + 1)[:len(first[1::2])]
+    first[2::2] = (n - np.arange(1, n // 2 + 1))[:len(first[2::2])]
+    square = (first[np.newaxis, :] + np.arange(n)[:, np.newaxis]) % n
+    if n % 2 == 1:
+        square = np.concatenate([square, square[:, ::-1]])
+    return square
+
+
+def condition_order(conditions, participant):
+    """ Returns the counterbalanced order of the conditions for the given participant number """
+    square = latin_square(len(conditions))
+    return [conditions[i] for i in square[participant % len(square)]]
+
+
+def max_run_length(values):
+    """ Returns the length of the longest run of equal values """
+    values = np.asarray(values)
+    if len(values) == 0:
+        return 0
+    changes = np.flatnonzero(values[1:] != values[:-1])
+    bounds = np.concatenate([[-1], changes, [len(values) - 1]])
+    return np.diff(bounds).max()
+
+
+# Just for testing: checks balance and constraints over many seeds
+if __name__ == '__main__':
+    n_speakers = 10
+    stimulus_sequence = [(i, j) for i in np.arange(n_speakers) for j in np.arange(2)]
+    speakers = np.array([speaker for speaker, sound_type in stimulus_sequence])
+    sound_types = np.array([sound_type for speaker, sound_type in stimulus_sequence])
+    n_items = len(stimulus_sequence)
+
+    for seed in range(200):
+        order = balanced_order(n_items, 200, seed)
+        assert np.all(np.bincount(order, minlength=n_items) == 10)
+        assert np.array_equal(order, balanced_order(n_items, 200, seed))
+
+        order = constrained_order(n_items, 200, seed, no_repeat=speakers, max_run=(sound_types, 3))
+        assert np.all(np.bincount(order, minlength=n_items) == 10)
+        assert np.all(speakers[order][1:] != speakers[order][:-1])
+        assert max_run_length(sound_types[order]) <= 3
+        assert np.array_equal(order, constrained_order(n_items, 200, seed, no_repeat=speakers, max_run=(sound_types, 3)))
+
+        order = blocked_order(n_items, 200, 5, seed, no_repeat=speakers, max_run=(sound_types, 2))
+        assert np.all(np.bincount(order.reshape(5, 40)[seed % 5], minlength=n_items) == 2)
+        assert np.all(speakers[order][1:] != speakers[order][:-1])
+        assert max_run_length(sound_types[order]) <= 2
+
+    for n in range(2, 9):
+        square = latin_square(n)
+        # every row and column is a permutation
+        assert np.all(np.sort(square, axis=1) == np.arange(n))
+        assert np.all(np.sort(square[:n], axis=0) == np.arange(n)[:, np.newaxis])
+        # every condition follows every other condition equally often
+        pairs = np.zeros((n, n), dtype=int)
+        np.add.at(pairs, (square[:, :-1].ravel(), square[:, 1:].ravel()), 1)
+        assert len(np.unique(pairs[~np.eye(n, dtype=bool)])) == 1
+    print('All checks passed')
+
+    for n_trials in [200, 2000, 20000]:
+        ts = time.perf_counter()
+        balanced_order(n_items, n_trials)
+        t_balanced = time.perf_counter() - ts
+        ts = time.perf_counter()
+        constrained_order(n_items, n_trials, no_repeat=speakers, max_run=(sound_types, 3))
+        t_constrained = time.perf_counter() - ts
+        print('{0:>6} trials: balanced {1:8.3f} ms, constrained {2:8.3f} ms'.format(
+            n_trials, t_balanced * 1000, t_constrained * 1000))
@@ -0,0 +1,157 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+#######################################################################
+# Localization statistics of many groups (e.g. session x condition x sound
+# type) in one vectorized pass.
+# For every group, the user estimates are regressed on the true elevations
+# with closed-form least squares (same results as sklearn LinearRegression):
+# - gain: slope of the regression line (elevation gain)
+# - intercept: intercept of the regression line ('Bias' in the plots)
+# - r2: coefficient of determination (LinearRegression.score())
+# - bias: mean signed error (user estimate - true elevation)
+# All sums are computed with np.bincount over the group index, so the
+# number of groups does not matter.
+# Bootstrap confidence intervals resample the trials within each group. The
+# bootstrap samples are split into chunks, which run in a process pool.
+#######################################################################
+
+STATISTICS = ['gain', 'intercept', 'r2', 'bias']
+
+
+def _group_sums(codes, n_groups, x, y):
+    """ Returns the statistics (n_groups x 4, see STATISTICS) and number of trials of each group """
+    n = np.bincount(codes, minlength=n_groups).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = np.bincount(codes, x, n_groups) / n
+        mean_y = np.bincount(codes, y, n_groups) / n
+        # centered sums (more accurate than the raw sums of squares)
+        dx = x - mean_x[codes]
+        dy = y - mean_y[codes]
+        sxx = np.bincount(codes, dx * dx, n_groups)
+        sxy = np.bincount(codes, dx * dy, n_groups)
+        syy = np.bincount(codes, dy * dy, n_groups)
+
+        # like sklearn: gain is 0 if all x are the same
+        gain = np.where(sxx > 0, sxy / sxx, 0)
+        intercept = mean_y - gain * mean_x
+        ss_residual = syy - gain * sxy
+        # like sklearn: r2 is 1 for a perfect fit of constant y values, 0 otherwise
+        r2 = np.where(syy > 0, 1 - ss_residual / syy, np.where(np.isclose(ss_residual, 0), 1.0, 0.0))
+        bias = mean_y - mean_x
+
+    statistics = np.stack([gain, intercept, r2, bias], axis=-1)
+    statistics[n == 0] = np.nan
+    return statistics, n
+
+
+def linear_regression(x, y):
+    """ Returns gain, intercept and r2 of the regression of y on x """
+    x = np.asarray(x, dtype=np.float64)
+    statistics, n = _group_sums(np.zeros(len(x), dtype=np.intp), 1, x, np.asarray(y, dtype=np.float64))
+    return tuple(statistics[0, :3])
+
+
+def _group_codes(df, by):
+    grouped = df.groupby(list(by), observed=True, sort=True)
+    return grouped.ngroup().to_numpy(), grouped.size().index
+
+
+def grouped_regression(df, by=('session', 'condition', 'sound_type'), x='line_number', y='user_estimate'):
+    """ Returns a DataFrame with one row per group of df (index: by) and the columns
+        gain, intercept, r2, bias (see above) and n_trials.
+    """
+    codes, index = _group_codes(df, by)
+    statistics, n = _group_sums(codes, len(index), df[x].to_numpy(np.float64), df[y].to_numpy(np.float64))
+    result = pd.DataFrame(statistics, index=index, columns=STATISTICS)
+    result['n_trials'] = n.astype(int)
+    return result
+
+
+def _bootstrap_chunk(codes, n_groups, x, y, n_samples, seed):
+    """ Computes the statistics of n_samples bootstrap samples (n_samples x n_groups x 4) """
+    rng = np.random.default_rng(seed)
+    # trials sorted by group: every trial is replaced by a random trial of the same group
+    order = np.argsort(codes, kind='stable')
+    codes, x, y = codes[order], x[order], y[order]
+    sizes = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    samples = np.empty((n_samples, n_groups, len(STATISTICS)))
+    for i in range(n_samples):
+        resampled = starts[codes] + (rng.random(len(codes)) * sizes[codes]).astype(np.intp)
+        samples[i] = _group_sums(codes, n_groups, x[resampled], y[resampled])[0]
+    return samples
+
+
+def bootstrap_regression(df, by=('session', 'condition', 'sound_type'), x='line_number', y='user_estimate',
+                         n_samples=1000, ci=95, seed=0, n_workers=None, chunk_size=100):
+    """ Returns grouped_regression() of df with bootstrap confidence intervals of all statistics
+        (columns <statistic>_low and <statistic>_high, ci in percent). The trials are resampled within each group.
+        The bootstrap samples are computed in chunks of chunk_size in a process pool with n_workers processes
+        (n_workers=1: no process pool). The results only depend on seed, not on n_workers.
+    """
+    codes, index = _group_codes(df, by)
+    x_values, y_values = df[x].to_numpy(np.float64), df[y].to_numpy(np.float64)
+    result = grouped_regression(df, by, x, y)
+
+    chunks = [min(chunk_size, n_samples - start) for start in range(0, n_samples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    arguments = [[codes] * len(chunks), [len(index)] * len(chunks), [x_values] * len(chunks),
+                 [y_values] * len(chunks), chunks, seeds]
+    if n_workers == 1 or len(chunks) == 1:
+        samples = list(map(_bootstrap_chunk, *arguments))
+    else:
+        with ProcessPoolExecutor(n_workers) as executor:
+            samples = list(executor.map(_bootstrap_chunk, *arguments))
+    samples = np.concatenate(samples)
+
+    with np.errstate(invalid='ignore'):
+        low, high = np.nanpercentile(samples, [(100 - ci) / 2, 100 - (100 - ci) / 2], axis=0)
+    for i, statistic in enumerate(STATISTICS):
+        result[statistic + '_low'] = low[:, i]
+        result[statistic + '_high'] = high[:, i]
+    return result
+
+
+# Just for testing: compares the results with sklearn and shows the timing for a large cohort
+if __name__ == '__main__':
+    from sklearn.linear_model import LinearRegression
+
+    rng = np.random.default_rng(0)
+    n_sessions, n_trials = 200, 400
+    df = pd.DataFrame({
+        'session': np.repeat(np.arange(n_sessions), n_trials),
+        'condition': np.tile(np.repeat(['bin', 'mono'], n_trials // 2), n_sessions),
+        'sound_type': rng.choice(['white', 'rippled'], n_sessions * n_trials),
+        'line_number': rng.integers(0, 10, n_sessions * n_trials) * 11.25 - 45,
+    })
+    df['user_estimate'] = df['line_number'] * rng.uniform(0.2, 1.0) + rng.normal(10, 15, len(df))
+
+    ts = time.perf_counter()
+    results = grouped_regression(df)
+    print('{0} groups: {1:.2f} ms'.format(len(results), (time.perf_counter() - ts) * 1000))
+
+    ts = time.perf_counter()
+    for (session, condition, sound_type), group in df.groupby(['session', 'condition', 'sound_type']):
+        x, y = group['line_number'].to_numpy().reshape(-1, 1), group['user_estimate'].to_numpy().reshape(-1, 1)
+        model = LinearRegression().fit(x, y)
+        expected = [model.coef_[0, 0], model.intercept_[0], model.score(x, y)]
+        assert np.allclose(results.loc[(session, condition, sound_type), ['gain', 'intercept', 'r2']], expected)
+    print('sklearn per group: {0:.2f} ms'.format((time.perf_counter() - ts) * 1000))
+
+    # constant x and constant y
+    x, y = np.full((5, 1), 2.0), np.arange(5.0).reshape(-1, 1)
+    model = LinearRegression().fit(x, y)
+    assert np.allclose(linear_regression(x.ravel(), y.ravel()), [model.coef_[0, 0], model.intercept_[0], model.score(x, y)])
+    model = LinearRegression().fit(y, x)
+    assert np.allclose(linear_regression(y.ravel(), x.ravel()), [model.coef_[0, 0], model.intercept_[0], model.score(y, x)])
+    print('Results are the same as sklearn')
+
+    for n_workers in [1, None]:
+        ts = time.perf_counter()
+        bootstrap = bootstrap_regression(df, n_samples=1000, n_workers=n_workers)
+        print('bootstrap (1000 samples, n_workers={0}): {1:.2f} s'.format(n_workers, time.perf_counter() - ts))
+    assert np.all((bootstrap['gain_low'] <= bootstrap['gain']) & (bootstrap['gain'] <= bootstrap['gain_high']))
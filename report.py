@@ -0,0 +1,214 @@
+import argparse
+import hashlib
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt  # noqa: E402
+from session_data import load_sessions  # noqa: E402
+from regression_stats import grouped_regression  # noqa: E402
+
+#######################################################################
+# Generates the standard figures of data_analysis.ipynb without a notebook:
+#   python report.py [results folder] [-o report folder] [-f png pdf svg]
+# - behavioral_results: regression lines of all sessions and the mean line
+#   for each condition / noise type
+# - regression_statistics: box plots of gain, bias and score
+# - session_<name>: scatter plots and regression lines of one session
+# The figures are rendered with the Agg backend in worker processes. A
+# figure is only rendered again if the data it shows (or its style) changed:
+# the hash of its data is stored in <report folder>/.report_cache.json.
+#######################################################################
+
+REPORT_VERSION = 1
+
+# conditions and noise types in the order of the panels
+PANELS = [('mono', 'rippled'), ('mono', 'white'), ('bin', 'rippled'), ('bin', 'white')]
+PANEL_TITLES = ['Monaural Rippled Noise', 'Monaural White Noise', 'Binaural Rippled Noise', 'Binaural White Noise']
+
+drawing_size = 15
+STYLE = {
+    'grid.linestyle': ':',
+    'font.size': drawing_size,
+    'font.style': 'normal',
+    'figure.titlesize': int(drawing_size * 1.3),
+    'lines.linewidth': int(drawing_size / 5),
+    'axes.labelsize': drawing_size,
+    'axes.titlesize': int(drawing_size * 1.3),
+    'xtick.labelsize': drawing_size,
+    'ytick.labelsize': drawing_size,
+    'legend.fancybox': True,
+    'legend.fontsize': drawing_size,
+    'legend.frameon': True,
+    'legend.framealpha': 0.5,
+    'legend.facecolor': 'inherit',
+    'legend.edgecolor': '0.8',
+    'figure.dpi': 100,
+    'image.cmap': 'viridis',
+}
+# name of the seaborn style in old and new matplotlib versions
+BASE_STYLES = ['seaborn-whitegrid', 'seaborn-v0_8-whitegrid']
+
+TEXT_BOX = dict(boxstyle='round', facecolor='white', alpha=0.8)
+
+
+def text_box(ax, gain, bias, score):
+    ax.text(0.05, 0.95, 'Gain: {0:1.2f}\nBias : {1:1.2f}\nScore : {2:1.2f}'.format(gain, bias, score),
+            transform=ax.transAxes, verticalalignment='top', bbox=TEXT_BOX)
+
+
+def plot_behavioral_results(data):
+    """ Regression lines of all sessions and the mean regression line for each panel """
+    df, regression = data
+    fig = plt.figure(figsize=(20, 5))
+    axes = fig.subplots(1, 4, squeeze=False, sharex=True, sharey=True)
+    x = np.arange(-45, 56.25)
+    for ax_num, (condition, noise) in enumerate(PANELS):
+        ax = axes[0, ax_num]
+        results = regression.xs((condition, noise), level=('condition', 'sound_type'))
+        for session, df_ in df[(df['condition'] == condition) & (df['sound_type'] == noise)].groupby('session', observed=True):
+            gain, intercept = results.loc[session, ['gain', 'intercept']]
+            ax.plot(df_['line_number'], df_['line_number'] * gain + intercept, linewidth=2)
+            ax.scatter(df_['line_number'], df_['user_estimate'])
+
+        means = results[['gain', 'intercept', 'r2']].mean().to_numpy()
+        ax.plot(x, x * means[0] + means[1], color='black', linewidth=5)
+        text_box(ax, *means)
+        ax.set_title(PANEL_TITLES[ax_num])
+        ax.set_xlabel('True Elevation [deg]')
+        ax.set_yticks([-25, 0, 25, 50, 75, 100])
+    axes[0, 0].set_ylabel('Perceived Elevation [deg]')
+    return fig
+
+
+def plot_regression_statistics(data):
+    """ Box plots of gain, bias and score of all sessions for each panel """
+    regression, = data
+    fig = plt.figure(figsize=(10, 10))
+    axes = fig.subplots(1, 3, squeeze=False, sharex=True)
+    for ax, (column, title, limits) in zip(axes[0], [('gain', 'Gain', (-0.2, 1.2)), ('intercept', 'Bias', (-10, 100)),
+                                                     ('r2', 'Score', (-0.2, 1.2))]):
+        values = [regression.xs(panel, level=('condition', 'sound_type'))[column].dropna().to_numpy() for panel in PANELS]
+        ax.boxplot(values, boxprops={'linewidth': 2}, whiskerprops={'linewidth': 2}, medianprops={'linewidth': 2})
+        ax.set_title(title)
+        ax.set_ylim(*limits)
+    axes[0, 2].set_xticks(np.arange(1, 5))
+    axes[0, 2].set_xticklabels(['Mono R', 'Mono W', 'Bin R', 'Bin W'])
+    return fig
+
+
+def plot_session(data):
+    """ Scatter plot and regression line of one session for each panel """
+    df, regression = data
+    fig = plt.figure(figsize=(20, 5))
+    axes = fig.subplots(1, 4, squeeze=False, sharex='all', sharey='all')
+    for ax_num, (condition, noise) in enumerate(PANELS):
+        ax = axes[0, ax_num]
+        df_ = df[(df['condition'] == condition) & (df['sound_type'] == noise)]
+        if (condition, noise) in regression.index:
+            gain, intercept, score = regression.loc[(condition, noise), ['gain', 'intercept', 'r2']]
+            ax.plot(df_['line_number'], df_['line_number'] * gain + intercept, linewidth=2)
+            text_box(ax, gain, intercept, score)
+        ax.scatter(df_['line_number'], df_['user_estimate'])
+        ax.set_title(condition + ' ' + noise)
+        ax.set_xlabel('True Elevation')
+        ax.set_yticks([-25, 0, 25, 50, 75, 100])
+    axes[0, 0].set_ylabel('Perceived Elevation')
+    return fig
+
+
+plot_functions = {
+    'behavioral_results': plot_behavioral_results,
+    'regression_statistics': plot_regression_statistics,
+    'session': plot_session,
+}
+
+
+def figure_set(df):
+    """ Returns the standard figures as dict: figure name -> (plot function name, data of the figure) """
+    columns = ['session', 'condition', 'sound_type', 'line_number', 'user_estimate']
+    df = df[columns]
+    regression = grouped_regression(df)
+
+    figures = {
+        'behavioral_results': ('behavioral_results', (df, regression)),
+        'regression_statistics': ('regression_statistics', (regression,)),
+    }
+    for session, df_session in df.groupby('session', observed=True):
+        figures['session_' + str(session)] = ('session', (df_session, regression.xs(session, level='session')))
+    return figures
+
+
+def data_hash(plot_function, data, formats, dpi):
+    """ Returns a hash of everything a figure depends on: its data, plot function, style and output formats """
+    digest = hashlib.sha1(json.dumps([REPORT_VERSION, plot_function, STYLE, sorted(formats), dpi]).encode())
+    for item in data:
+        digest.update(pd.util.hash_pandas_object(item.reset_index(), index=False).to_numpy().tobytes())
+        digest.update(','.join(map(str, item.columns)).encode())
+    return digest.hexdigest()
+
+
+def render(name, plot_function, data, folder, formats, dpi):
+    """ Renders one figure to <folder>/<name>.<format> (runs in a worker process) """
+    with plt.style.context([style for style in BASE_STYLES if style in plt.style.available][:1]):
+        with matplotlib.rc_context(STYLE):
+            fig = plot_functions[plot_function](data)
+            for file_format in formats:
+                fig.savefig(Path(folder) / (name + '.' + file_format), dpi=dpi)
+            plt.close(fig)
+    return name
+
+
+def generate_report(results_folder='results', report_folder='report', formats=('png',), dpi=300, n_workers=None,
+                    force=False):
+    """ Renders all figures of the report, whose data changed since the last call (all figures if force).
+        Returns the names of the rendered figures.
+    """
+    report_folder = Path(report_folder)
+    report_folder.mkdir(parents=True, exist_ok=True)
+    cache_file = report_folder / '.report_cache.json'
+    cache = {}
+    if cache_file.exists() and not force:
+        with open(cache_file) as f:
+            cache = json.load(f)
+
+    figures = figure_set(load_sessions(results_folder))
+    hashes = {}
+    to_render = []
+    for name, (plot_function, data) in figures.items():
+        hashes[name] = data_hash(plot_function, data, formats, dpi)
+        files_exist = all((report_folder / (name + '.' + file_format)).exists() for file_format in formats)
+        if cache.get(name) != hashes[name] or not files_exist:
+            to_render.append(name)
+
+    if len(to_render) > 1 and n_workers != 1:
+        with ProcessPoolExecutor(n_workers) as executor:
+            futures = [executor.submit(render, name, *figures[name], report_folder, formats, dpi) for name in to_render]
+            rendered = [future.result() for future in futures]
+    else:
+        rendered = [render(name, *figures[name], report_folder, formats, dpi) for name in to_render]
+
+    with open(cache_file, 'w') as f:
+        json.dump(hashes, f, indent=1)
+    return rendered
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Renders the figures of the experiment (only the ones whose data changed)')
+    parser.add_argument('results_folder', nargs='?', default='results', help='folder of the results (default: results)')
+    parser.add_argument('-o', '--output', default='report', help='folder of the figures (default: report)')
+    parser.add_argument('-f', '--formats', nargs='+', default=['png'], help='file formats (default: png)')
+    parser.add_argument('--dpi', type=int, default=300, help='resolution of the figures (default: 300)')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--force', action='store_true', help='render all figures, even if their data did not change')
+    args = parser.parse_args()
+
+    ts = time.perf_counter()
+    rendered = generate_report(args.results_folder, args.output, args.formats, args.dpi, args.workers, args.force)
+    print('Rendered {0} figure(s) in {1:.2f} s'.format(len(rendered), time.perf_counter() - ts))
+    for name in rendered:
+        print('  ' + name)
@@ -0,0 +1,208 @@
+import hashlib
+import pickle
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from AngleProcessing import EncoderMapping, line_to_elevation, session_files, wrap_angle
+
+#######################################################################
+# Loads the results of all sessions into one DataFrame.
+# - all csv files in results/ (and its sub folders) are read in parallel
+# - participants are excluded by their id in the file name (e.g. test ids 98, 99)
+# - columns get compact types (categories for sound type, condition, user id)
+# - line numbers and user estimates are converted to degree once for all sessions:
+#   line_number: 11.25 deg between speakers, offset of -45 deg (only the lower 10 speakers are used)
+#   user_estimate: encoder angle converted with the encoder mapping of the session
+#   (<results>_encoder.json, default: 90 deg - angle, see AngleProcessing)
+#   The raw values are kept in raw_line_number and raw_user_estimate.
+# - every parsed session and the merged dataset are cached (results/.session_cache.pkl).
+#   A file is only parsed again if its modification time or size changed and its content
+#   (hash) is new. If no file changed, the merged dataset is returned directly.
+#   Caches of another CACHE_VERSION (other columns or conversions) are ignored.
+#
+# Usage (e.g. in data_analysis.ipynb):
+#   from session_data import load_sessions
+#   df = load_sessions('results')
+#######################################################################
+
+# increase whenever read_session() or to_degree() change, so that old caches are not used
+# 2: encoder mapping of every session (encoder_offset, encoder_gain)
+CACHE_VERSION = 2
+
+FILE_NAME_PATTERN = re.compile(r'userid_(?P<user_id>.+?)_date_(?P<date>[\d.]+)_time_(?P<time>[\d.]+)\.csv$')
+
+COLUMN_TYPES = {
+    'trial': np.int32,
+    'line_number': np.int32,
+    'user_estimate': np.float64,
+    'sound_type': 'category',
+    'condition': 'category',
+    'reaction_time': np.float64,
+    'user_id': str,
+}
+
+
+def parse_file_name(path):
+    """ Returns user id, date and time of a result file, or None if the name does not match """
+    match = FILE_NAME_PATTERN.search(Path(path).name)
+    return match.groupdict() if match is not None else None
+
+
+def session_stat(path):
+    """ Modification time and size of a result file and its encoder mapping """
+    stats = [Path(file).stat() for file in (path, session_files(str(path))[1]) if Path(file).exists()]
+    return max(stat.st_mtime for stat in stats), sum(stat.st_size for stat in stats)
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    for file in (path, session_files(str(path))[1]):
+        if Path(file).exists():
+            with open(file, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def read_session(path):
+    """ Reads one result file with typed columns. The session (file name) and its encoder mapping are added as
+        columns.
+    """
+    df = pd.read_csv(path, dtype=COLUMN_TYPES)
+    df['session'] = Path(path).stem
+    mapping = EncoderMapping(session_files(str(path))[1])
+    df['encoder_offset'] = mapping.offset
+    df['encoder_gain'] = mapping.gain
+    return df
+
+
+def to_degree(df, max_reaction_time=5):
+    """ Converts line numbers and user estimates to degree (vectorized, for all sessions at once) and adds the
+        absolute error and the merged condition ('mono rippled', ...). Trials with reaction times larger than
+        max_reaction_time are removed (probably start trials).
+    """
+    df['raw_line_number'] = df['line_number']
+    df['raw_user_estimate'] = df['user_estimate']
+    df['line_number'] = line_to_elevation(df['raw_line_number'].to_numpy())
+    # encoder mapping of every session (elevation = offset + gain * angle)
+    if 'encoder_offset' not in df:
+        mapping = EncoderMapping(None)
+        df['encoder_offset'], df['encoder_gain'] = mapping.offset, mapping.gain
+    df['user_estimate'] = df['encoder_offset'].to_numpy() + df['encoder_gain'].to_numpy() * \
+        wrap_angle(df['raw_user_estimate'].to_numpy())
+
+    df['error'] = np.abs(df['user_estimate'] - df['line_number'])
+    df['condition_merged'] = (df['condition'].astype(str) + ' ' + df['sound_type'].astype(str)).astype('category')
+
+    if max_reaction_time is not None:
+        df = df[df['reaction_time'] <= max_reaction_time]
+    return df.reset_index(drop=True)
+
+
+def load_sessions(results_folder='results', exclude_ids=('98', '99'), max_reaction_time=5, cache_file=None,
+                  n_workers=None):
+    """ Loads all sessions of results_folder into one DataFrame (see above).
+        Only files that changed since the last call are parsed (in parallel, with n_workers processes).
+    """
+    results_folder = Path(results_folder)
+    if cache_file is None:
+        cache_file = results_folder / '.session_cache.pkl'
+    cache_file = Path(cache_file)
+
+    empty_cache = {'version': CACHE_VERSION, 'sessions': {}, 'merged_key': None, 'merged': None}
+    cache = empty_cache
+    if cache_file.exists():
+        try:
+            with open(cache_file, 'rb') as f:
+                cache = pickle.load(f)
+            if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+                cache = empty_cache
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+
+    paths = []
+    for path in sorted(results_folder.glob('**/*.csv')):
+        info = parse_file_name(path)
+        if info is None or info['user_id'] in exclude_ids:
+            continue
+        paths.append(path)
+
+    sessions = {}
+    to_parse = []
+    for path in paths:
+        key = path.as_posix()
+        mtime, size = session_stat(path)
+        entry = cache['sessions'].get(key)
+        if entry is not None and entry['mtime'] == mtime and entry['size'] == size:
+            sessions[key] = entry
+            continue
+        digest = file_hash(path)
+        if entry is not None and entry['hash'] == digest:
+            # only touched, the content is the same
+            entry.update(mtime=mtime, size=size)
+            sessions[key] = entry
+            continue
+        sessions[key] = {'mtime': mtime, 'size': size, 'hash': digest, 'data': None}
+        to_parse.append(path)
+
+    if to_parse:
+        if len(to_parse) > 1 and n_workers != 1:
+            with ProcessPoolExecutor(n_workers) as executor:
+                parsed = list(executor.map(read_session, to_parse, chunksize=max(1, len(to_parse) // 32)))
+        else:
+            parsed = [read_session(path) for path in to_parse]
+        for path, df in zip(to_parse, parsed):
+            sessions[path.as_posix()]['data'] = df
+
+    merged_key = (CACHE_VERSION, tuple((key, entry['hash']) for key, entry in sessions.items()), max_reaction_time)
+    if merged_key == cache['merged_key']:
+        return cache['merged'].copy()
+
+    if sessions:
+        df = pd.concat([entry['data'] for entry in sessions.values()], ignore_index=True)
+    else:
+        df = pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in COLUMN_TYPES.items()}).assign(session='')
+    for column in ['sound_type', 'condition', 'user_id', 'session']:
+        df[column] = df[column].astype('category')
+    df = to_degree(df, max_reaction_time)
+
+    if cache_file.parent.is_dir():
+        with open(cache_file, 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'sessions': sessions, 'merged_key': merged_key, 'merged': df}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+    return df.copy()
+
+
+# Just for testing: loads generated sessions twice (parsing and cache)
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description='Loads all sessions and shows the loading time')
+    parser.add_argument('results_folder', nargs='?', default=None, help='folder of the results (default: generated data)')
+    parser.add_argument('-n', '--n-sessions', type=int, default=200, help='number of generated sessions')
+    args = parser.parse_args()
+
+    results_folder = args.results_folder
+    if results_folder is None:
+        results_folder = Path(tempfile.mkdtemp())
+        rng = np.random.default_rng(0)
+        for i in range(args.n_sessions):
+            n = 400
+            pd.DataFrame({
+                'trial': np.tile(np.arange(200), 2),
+                'line_number': rng.integers(0, 10, n),
+                'user_estimate': rng.uniform(0, 135, n),
+                'sound_type': rng.choice(['white', 'rippled'], n),
+                'condition': np.repeat(['bin', 'mono'], 200),
+                'reaction_time': rng.uniform(0.5, 6, n),
+                'user_id': '{0:02d}'.format(i),
+            }).to_csv(results_folder / 'userid_{0:02d}_date_20.01.2021_time_13.29.csv'.format(i), index=False)
+
+    for run in ['first load', 'cached load']:
+        ts = time.perf_counter()
+        df = load_sessions(results_folder)
+        print('{0:<12} {1:8.3f} s   {2} trials'.format(run, time.perf_counter() - ts, len(df)))
+    print(df.dtypes)
@@ -0,0 +1,148 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import experiment_start
+
+#######################################################################
+# Runs sessions of the experiment without any prompts, configured by a
+# json file (see session_config.json) instead of the globals of
+# experiment_start.py:
+#   python session_runner.py session_config.json --user-id 12
+#       one session with the hardware (no hearing threshold test!)
+#   python session_runner.py session_config.json --simulate -n 100 -o results_simulated
+#       100 sessions with simulated hardware (HardwareSimulator) in a process
+#       pool, e.g. to test the trial engine or to create data for the analysis
+# Keys that are not in the config file keep the value of experiment_start.py.
+# The key "simulation" holds the participant model and the output latency of
+# the simulated hardware.
+#######################################################################
+
+# key in the config file -> global of experiment_start
+CONFIG_GLOBALS = {
+    'conditions': 'conditions',
+    'n_speakers': 'n_speakers',
+    'n_trials': 'n_trials',
+    'isi': 'isi',
+    'sequence_seed': 'sequence_seed',
+    'no_speaker_repeats': 'no_speaker_repeats',
+    'max_sound_type_run': 'max_sound_type_run',
+    'white_noise_sound': 'white_noise_sound',
+    'rippled_noise_sound': 'rippled_noise_sound',
+    'synthesize_stimuli': 'synthesize_stimuli',
+    'synthesized_stimuli': 'synthesized_stimuli',
+    'results_flush_policy': 'results_flush_policy',
+    'persistent_audio_stream': 'persistent_audio_stream',
+    'multichannel_audio': 'multichannel_audio',
+    'speaker_calibration_file': 'speaker_calibration_file',
+    'encoder_mapping_file': 'encoder_mapping_file',
+    'online_monitor_port': 'online_monitor_port',
+    'dummy_audio_player': 'dummy_audio_player',
+    'dummy_arduino_reader': 'dummy_arduino_reader',
+    'arduino_port': 'ARDUINO_PORT',
+    'arduino_baud_rate': 'ARDUINO_BAUD_RATE',
+    'arduino_background': 'arduino_background',
+    'arduino_binary': 'arduino_binary',
+}
+PATH_KEYS = ['white_noise_sound', 'rippled_noise_sound']
+SIMULATION_KEYS = ['gain', 'bias', 'sd', 'reaction_time', 'reaction_time_sd', 'latency']
+
+
+def load_config(config_file):
+    """ Reads and checks the config file """
+    with open(config_file) as f:
+        config = json.load(f)
+    unknown = set(config) - set(CONFIG_GLOBALS) - {'simulation'}
+    unknown |= set(config.get('simulation', {})) - set(SIMULATION_KEYS)
+    if unknown:
+        raise ValueError('Unknown keys in ' + str(config_file) + ': ' + ', '.join(sorted(unknown)))
+    if 'n_trials' in config and 'n_speakers' in config and config['n_trials'] % (2 * config['n_speakers']) != 0:
+        raise ValueError('n_trials has to be divisible by 2 (sounds) * n_speakers')
+    return config
+
+
+def apply_config(config):
+    """ Sets the globals of experiment_start to the values of the config """
+    for key, value in config.items():
+        if key in CONFIG_GLOBALS:
+            setattr(experiment_start, CONFIG_GLOBALS[key], Path(value) if key in PATH_KEYS else value)
+
+
+def run_headless(config, user_id, results_folder='results'):
+    """ Runs one session with the hardware (or the dummies of experiment_start) without prompts """
+    apply_config(config)
+    with experiment_start.open_session(user_id, results_folder) as session:
+        experiment_start.run_session(session.audio_player, session.arduino_reader, session.res_file_writer, user_id,
+                                     session.timing_log, monitor=session.monitor, sample_log=session.sample_log)
+    return session.results_file
+
+
+def simulate(config, user_id, results_folder, seed):
+    """ Runs one session with simulated hardware (runs in a worker process). The output of the session is
+        suppressed. Returns the virtual duration, the wall time and the timing summary of the session.
+    """
+    from HardwareSimulator import ParticipantModel, simulate_session
+
+    # every session gets its own trial orders and participant
+    config = dict(config, sequence_seed=seed * len(config.get('conditions', experiment_start.conditions)))
+    apply_config(config)
+    simulation = dict(config.get('simulation', {}))
+    latency = simulation.pop('latency', 0.006)
+
+    ts = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        duration, results_file, timing_log = simulate_session(
+            results_folder, user_id, ParticipantModel(seed=seed, **simulation),
+            baud_rate=experiment_start.ARDUINO_BAUD_RATE, binary=experiment_start.arduino_binary, latency=latency,
+            seed=seed)
+    return {'user_id': user_id, 'duration': duration, 'wall_time': time.perf_counter() - ts,
+            'summary': timing_log.get_summary()}
+
+
+def run_batch(config, n_sessions, results_folder, n_workers=None, first_id=0, seed=0):
+    """ Runs n_sessions simulated sessions in a process pool (user ids first_id, first_id + 1, ...) """
+    Path(results_folder).mkdir(parents=True, exist_ok=True)
+    user_ids = ['{0:03d}'.format(first_id + i) for i in range(n_sessions)]
+    arguments = [[config] * n_sessions, user_ids, [results_folder] * n_sessions, range(seed, seed + n_sessions)]
+    if n_workers == 1:
+        return list(map(simulate, *arguments))
+    with ProcessPoolExecutor(n_workers) as executor:
+        return list(executor.map(simulate, *arguments))
+
+
+def print_batch_summary(sessions, wall_time):
+    n_trials = sum(session['summary'][('TrialScheduler', 'play')]['count'] for session in sessions)
+    durations = np.array([session['duration'] for session in sessions])
+    print('{0} sessions, {1} trials: {2:.1f} h virtual time in {3:.2f} s ({4:.0f} trials/s)'.format(
+        len(sessions), n_trials, durations.sum() / 3600, wall_time, n_trials / wall_time))
+    print('{0:<16}{1:<16}{2:>16}{3:>16}'.format('source', 'phase', 'median p50 [ms]', 'max p99 [ms]'))
+    for key in sessions[0]['summary']:
+        p50 = np.median([session['summary'][key]['percentiles'][50] for session in sessions])
+        p99 = np.max([session['summary'][key]['percentiles'][99] for session in sessions])
+        print('{0:<16}{1:<16}{2:>16.3f}{3:>16.3f}'.format(*key, p50, p99))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs sessions of the experiment configured by a json file')
+    parser.add_argument('config', nargs='?', default='session_config.json', help='config file')
+    parser.add_argument('-u', '--user-id', default='00', help='participant id (single session)')
+    parser.add_argument('-o', '--output', default='results', help='folder of the results')
+    parser.add_argument('--simulate', action='store_true', help='use simulated hardware (virtual time)')
+    parser.add_argument('-n', '--n-sessions', type=int, default=1, help='number of simulated sessions')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the first simulated session')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.simulate:
+        ts = time.perf_counter()
+        sessions = run_batch(config, args.n_sessions, args.output, args.workers, seed=args.seed)
+        print_batch_summary(sessions, time.perf_counter() - ts)
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        run_headless(config, args.user_id, args.output)